@@ -1,10 +1,43 @@
 import asyncio
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, filters
-from config import TELEGRAM_TOKEN
+import signal
+from telegram.ext import (
+    Application, ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, ContextTypes,
+    filters
+)
+from config import (
+    TELEGRAM_TOKEN, WORKER_PROCESSES, QUALITY_QUEUE_THRESHOLDS, QUALITY_MIN_THROUGHPUT_KBPS,
+    STATUS_UPDATE_INTERVAL, PERSISTENCE_PATH, PERSISTENCE_UPDATE_INTERVAL,
+    USER_STATE_IDLE_TTL, USER_STATE_MAX_IN_MEMORY, FILE_ID_CACHE_SIZE, PREFETCH_TTL,
+    MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_MB, DOWNLOAD_QUEUE_MAX, ADMISSION_MAX_WAIT, MAX_JOBS_PER_USER,
+    QUEUE_AGING_FACTOR, QUEUE_MAX_DELAY, HELPER_BOT_TOKENS, STORAGE_CHAT_IDS, UPLOAD_SHARD_MIN_MB,
+    PROXY_POOL, PROXY_QUARANTINE_BASE, PROXY_QUARANTINE_MAX, DRAIN_TIMEOUT,
+    LOOP_LAG_THRESHOLD, HEALTH_HOST, HEALTH_PORT, HEALTH_MAX_LAG
+)
 from utils.logger import logger, request_context
+from utils.tracing import shutdown_tracing
 from core.worker import download_worker
-from handlers.common import start_command, help_command, unknown_command
+from core.process_pool import DownloadProcessPool
+from core.quality_policy import QualityPolicy, parse_queue_thresholds
+from core.jobs import JobRegistry
+from core.progress import StatusReporter
+from core.user_state import UserState
+from core.persistence import SQLitePersistence, evict_idle_user_state
+from core.file_id_cache import FileIdCache
+from core.prefetch import InfoPrefetcher
+from core.media_cache import MediaCache
+from core.local_media import LocalVideos
+from core.admission import AdmissionController
+from core.scheduler import JobQueue
+from core.upload_pool import UploadPool
+from core.proxy_pool import ProxyPool
+from core.drain import PendingJobStore, drain, restore_pending_jobs
+from core.health import HealthServer, LoopLagMonitor
+from handlers.common import start_command, help_command, unknown_command, quality_command
 from handlers.conversation import get_conversation_handler, cancel_conversation
+from handlers.jobs import cancel_job_callback
+from handlers.inline import inline_query
+from handlers.admin import memory_command
+from utils.constants import CANCEL_JOB_CALLBACK_PREFIX
 
 async def post_init(application: Application):
     """Выполняется после инициализации приложения, до старта поллинга."""
@@ -15,19 +48,98 @@ async def main():
     with request_context('MAIN'):
         logger.info('Starting bot')
 
-        # Создание очереди
-        download_queue = asyncio.Queue()
+        # Создание очереди. Размер ограничен, чтобы поток задач не съел память.
+        # Короткие задачи выдаются раньше длинных
+        download_queue = JobQueue(DOWNLOAD_QUEUE_MAX, QUEUE_AGING_FACTOR, QUEUE_MAX_DELAY, STATUS_UPDATE_INTERVAL)
+
+        # Хранилище состояния пользователей и диалогов (переживает перезапуск)
+        persistence = SQLitePersistence(PERSISTENCE_PATH, update_interval=PERSISTENCE_UPDATE_INTERVAL)
 
         # Собираем приложение
         app_builder = ApplicationBuilder().token(TELEGRAM_TOKEN)
         app_builder.post_init(post_init)
+        app_builder.persistence(persistence)
+        # Компактная запись состояния вместо dict на каждого пользователя
+        app_builder.context_types(ContextTypes(user_data=UserState))
         app = app_builder.build()
 
         # Сохраняем очередь в bot_data для доступа из обработчиков
         app.bot_data['download_queue'] = download_queue
+        # Реестр задач для отмены
+        app.bot_data['job_registry'] = JobRegistry()
+        # Статусные сообщения задач с ограничением частоты правок
+        app.bot_data['status_reporter'] = StatusReporter(app.bot, STATUS_UPDATE_INTERVAL)
+        # file_id уже загруженных файлов для inline режима
+        app.bot_data['file_id_cache'] = FileIdCache(FILE_ID_CACHE_SIZE)
+        # Дисковый кеш готовых файлов
+        media_cache = None
+        if MEDIA_CACHE_MAX_MB > 0:
+            media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_MB * 1024 * 1024)
+            app.bot_data['media_cache'] = media_cache
+        # Боты-помощники для загрузки тяжелых файлов (свои лимиты и полоса на каждый токен)
+        upload_pool = None
+        if HELPER_BOT_TOKENS and STORAGE_CHAT_IDS:
+            upload_pool = UploadPool(HELPER_BOT_TOKENS, STORAGE_CHAT_IDS, int(UPLOAD_SHARD_MIN_MB * 1024 * 1024))
+            app.bot_data['upload_pool'] = upload_pool
+        # Исходящие адреса загрузок по платформам с карантином для ограниченных
+        proxy_pool = None
+        if PROXY_POOL:
+            proxy_pool = ProxyPool(ProxyPool.parse(PROXY_POOL), PROXY_QUARANTINE_BASE, PROXY_QUARANTINE_MAX)
+            if proxy_pool:
+                app.bot_data['proxy_pool'] = proxy_pool
+            else:
+                logger.warning("PROXY_POOL has no valid entries, downloads go direct")
+                proxy_pool = None
+        # Видео во временной папке, из которых можно взять аудио без загрузки
+        app.bot_data['local_videos'] = LocalVideos()
+
+        # Политика качества видео под нагрузкой
+        app.bot_data['quality_policy'] = QualityPolicy(
+            parse_queue_thresholds(QUALITY_QUEUE_THRESHOLDS),
+            min_throughput_bps=QUALITY_MIN_THROUGHPUT_KBPS * 1024
+        )
+
+        # Пул процессов для загрузок (опционально)
+        process_pool = None
+        if WORKER_PROCESSES > 0:
+            process_pool = DownloadProcessPool(WORKER_PROCESSES)
+            process_pool.start()
+            app.bot_data['process_pool'] = process_pool
+
+        # Предзагрузка информации о ссылках, присланных до выбора видео/аудио
+        app.bot_data['info_prefetcher'] = InfoPrefetcher(process_pool, ttl=PREFETCH_TTL, proxy_pool=proxy_pool)
+        # Фоновые задачи обработчиков: loop хранит на задачи только слабые ссылки
+        app.bot_data['background_tasks'] = set()
+
+        # Выгрузка из памяти состояния неактивных пользователей.
+        # Простой должен быть заметно больше интервала записи, чтобы не потерять изменения
+        eviction_task = asyncio.create_task(evict_idle_user_state(
+            app,
+            persistence,
+            idle_ttl=max(USER_STATE_IDLE_TTL, PERSISTENCE_UPDATE_INTERVAL * 2),
+            max_in_memory=USER_STATE_MAX_IN_MEMORY
+        ))
+
+        # Запуск воркеров: по одному на процесс пула, чтобы все ядра были заняты
+        worker_count = max(1, WORKER_PROCESSES)
+        # Контроль нагрузки: оценка ожидания и отказ при перегрузке
+        app.bot_data['admission'] = AdmissionController(worker_count, ADMISSION_MAX_WAIT, MAX_JOBS_PER_USER)
+        worker_tasks = [
+            asyncio.create_task(download_worker(app, download_queue)) # Передаем app
+            for _ in range(worker_count)
+        ]
+        # Задачи, которые не успел выполнить предыдущий экземпляр бота
+        job_store = PendingJobStore(PERSISTENCE_PATH)
+        restore_task = asyncio.create_task(restore_pending_jobs(app, download_queue, job_store))
 
-        # Запуск воркера
-        worker_task = asyncio.create_task(download_worker(app, download_queue)) # Передаем app
+        # Задержка event loop: гистограмма и стек кода, который держит loop дольше порога
+        loop_monitor = LoopLagMonitor(threshold=LOOP_LAG_THRESHOLD)
+        loop_monitor.start()
+        app.bot_data['loop_monitor'] = loop_monitor
+        # /healthz и /readyz для оркестратора
+        health_server = None
+        if HEALTH_PORT:
+            health_server = HealthServer(app, download_queue, worker_tasks, loop_monitor, HEALTH_HOST, HEALTH_PORT, HEALTH_MAX_LAG)
 
         # Регистрация обработчиков (порядок важен)
         # 1. ConversationHandler для основного диалога
@@ -37,22 +149,40 @@ async def main():
         # 2. Отдельная команда /cancel
         app.add_handler(CommandHandler('cancel', cancel_conversation))
 
-        # 3. Простые команды ConversationHandler перехватит диалог
+        # 3. Inline кнопка отмены задачи
+        app.add_handler(CallbackQueryHandler(cancel_job_callback, pattern=f'^{CANCEL_JOB_CALLBACK_PREFIX}'))
+
+        # 4. Inline запросы "@bot ссылка". Не блокируют остальные обновления на время паузы debounce
+        app.add_handler(InlineQueryHandler(inline_query, block=False))
+
+        # 5. Простые команды ConversationHandler перехватит диалог
         app.add_handler(CommandHandler('start', start_command))
         app.add_handler(CommandHandler('help', help_command))
+        app.add_handler(CommandHandler('quality', quality_command))
+        # Отчет о памяти для администраторов (ADMIN_USER_IDS)
+        app.add_handler(CommandHandler('memory', memory_command))
 
-        # 4. Обработчик неизвестных команд (должен идти после всех простых CommandHandlers)
+        # 6. Обработчик неизвестных команд (должен идти после всех простых CommandHandlers)
         app.add_handler(MessageHandler(filters.COMMAND, unknown_command))
 
         # Запуск бота
         try:
             await app.initialize()
+            if upload_pool:
+                await upload_pool.start()
+            if health_server:
+                await health_server.start()
             await app.start()
             logger.info("Bot polling started")
             await app.updater.start_polling()
 
-            # Ожидание завершения (например, по Ctrl+C)
-            await asyncio.Event().wait()
+            # Ожидание завершения: SIGTERM (остановка при деплое) или Ctrl+C
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for stop_signal in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(stop_signal, stop_event.set)
+            await stop_event.wait()
+            logger.info("Stop signal received, draining.")
 
         except (KeyboardInterrupt, SystemExit):
                 logger.info("Shutdown requested by signal.")
@@ -61,26 +191,63 @@ async def main():
         finally:
             # Остановка
             logger.info("Shutdown sequence initiated...")
+            # Новые ссылки больше не принимаем. Поллинг останавливаем сразу, чтобы новый экземпляр
+            # мог начать получать обновления, пока этот доделывает начатые задачи
+            app.bot_data['draining'] = True
             if app.updater and app.updater.running:
                 await app.updater.stop()
                 logger.info("Updater stopped.")
+            eviction_task.cancel()
+            restore_task.cancel()
+
+            # Ждущие задачи передаются следующему экземпляру, начатые доделываются до DRAIN_TIMEOUT
+            try:
+                await drain(app, download_queue, worker_tasks, job_store, DRAIN_TIMEOUT)
+                await app.bot_data['status_reporter'].flush(timeout=5.0)
+            except Exception as e:
+                logger.error(f"Error during drain: {e}", exc_info=True)
+            job_store.close()
+
             if app.running:
                 await app.stop()
                 logger.info("Application shut down.")
+            # shutdown сбрасывает отложенные изменения состояния в хранилище
+            await app.shutdown()
 
-            # Отмена воркера
-            if worker_task and not worker_task.done():
-                logger.info("Cancelling worker task...")
-                worker_task.cancel()
+            # Отмена воркеров
+            pending_workers = [task for task in worker_tasks if not task.done()]
+            if pending_workers:
+                logger.info(f"Cancelling {len(pending_workers)} worker task(s)...")
+                for task in pending_workers:
+                    task.cancel()
                 try:
-                    await asyncio.wait_for(worker_task, timeout=5.0)
-                    logger.info("Worker task successfully cancelled.")
+                    await asyncio.wait_for(asyncio.gather(*pending_workers, return_exceptions=True), timeout=5.0)
+                    logger.info("Worker tasks successfully cancelled.")
                 except asyncio.CancelledError:
-                    logger.info("Worker task already cancelled.")
+                    logger.info("Worker tasks already cancelled.")
                 except asyncio.TimeoutError:
-                    logger.warning("Worker task did not finish within timeout during cancellation.")
+                    logger.warning("Worker tasks did not finish within timeout during cancellation.")
                 except Exception as e:
                     logger.error(f"Error during worker task cancellation: {e}", exc_info=True)
+
+            if upload_pool:
+                logger.info(f"Upload pool stats: {upload_pool.stats()}")
+                await upload_pool.stop()
+            if proxy_pool:
+                logger.info(f"Proxy pool stats: {proxy_pool.stats()}")
+
+            # Остановка пула процессов
+            if process_pool:
+                process_pool.shutdown(wait=False)
+            if media_cache:
+                media_cache.flush()
+                logger.info(f"Media cache stats: {media_cache.stats()}")
+            if health_server:
+                await health_server.stop()
+            logger.info(f"Event loop lag: {loop_monitor.stats()}")
+            loop_monitor.stop()
+            # Дописываем накопленные спаны
+            shutdown_tracing()
             logger.info("Shutdown complete.")
 
 
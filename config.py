@@ -5,3 +5,121 @@ from dotenv import load_dotenv
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+
+# Количество процессов в пуле загрузок.
+# 0 - загрузки выполняются в потоках основного процесса, auto - по числу ядер
+_worker_processes = os.getenv('WORKER_PROCESSES', '0').strip().lower()
+WORKER_PROCESSES = (os.cpu_count() or 1) if _worker_processes == 'auto' else int(_worker_processes or 0)
+
+# Пороги глубины очереди для снижения качества видео, например "3:720p,6:480p,12:360p"
+QUALITY_QUEUE_THRESHOLDS = os.getenv('QUALITY_QUEUE_THRESHOLDS', '3:720p,6:480p,12:360p')
+# Если недавняя скорость загрузок ниже этого значения (КБ/с), качество понижается еще на уровень
+QUALITY_MIN_THROUGHPUT_KBPS = float(os.getenv('QUALITY_MIN_THROUGHPUT_KBPS', '0'))
+
+# Параллельная загрузка фрагментов DASH/HLS: соединений на одну задачу
+FRAGMENT_CONCURRENCY = int(os.getenv('FRAGMENT_CONCURRENCY', '4'))
+# Общий лимит соединений для всех одновременных загрузок (делится между процессами пула)
+MAX_FRAGMENT_CONNECTIONS = int(os.getenv('MAX_FRAGMENT_CONNECTIONS', '16'))
+# Внешний загрузчик (например aria2c). Пусто - встроенный загрузчик yt-dlp
+EXTERNAL_DOWNLOADER = os.getenv('EXTERNAL_DOWNLOADER', '').strip()
+
+# Таймауты стадий задачи (секунды)
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', '60'))
+DOWNLOAD_TIMEOUT = float(os.getenv('DOWNLOAD_TIMEOUT', '600'))
+POSTPROCESS_TIMEOUT = float(os.getenv('POSTPROCESS_TIMEOUT', '300'))
+UPLOAD_TIMEOUT = float(os.getenv('UPLOAD_TIMEOUT', '300'))
+# Загрузка считается зависшей, если за это время не пришло ни одного байта
+STALL_TIMEOUT = float(os.getenv('STALL_TIMEOUT', '60'))
+
+# Минимальный интервал между правками статусных сообщений в одном чате (секунды)
+STATUS_UPDATE_INTERVAL = float(os.getenv('STATUS_UPDATE_INTERVAL', '3'))
+
+# Максимум ссылок (включая элементы плейлистов) в одной пакетной задаче
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '10'))
+# Разворачивать ли плейлисты YouTube в пакетную задачу
+BATCH_EXPAND_PLAYLISTS = os.getenv('BATCH_EXPAND_PLAYLISTS', 'true').lower() == 'true'
+
+# Каталог дискового кеша yt-dlp (код плеера YouTube, функции подписи)
+YDL_CACHE_DIR = os.getenv('YDL_CACHE_DIR', 'cache/yt-dlp')
+
+# Файл SQLite для состояния пользователей и диалогов
+PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'data/bot_state.sqlite3')
+# Как часто PTB сбрасывает изменения состояния в хранилище (секунды)
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '30'))
+# Через сколько секунд простоя состояние пользователя выгружается из памяти
+USER_STATE_IDLE_TTL = float(os.getenv('USER_STATE_IDLE_TTL', '3600'))
+# Максимум пользователей, чье состояние одновременно держится в памяти
+USER_STATE_MAX_IN_MEMORY = int(os.getenv('USER_STATE_MAX_IN_MEMORY', '50000'))
+# Через сколько секунд простоя незавершенный диалог сбрасывается
+CONVERSATION_TIMEOUT = float(os.getenv('CONVERSATION_TIMEOUT', '900'))
+
+# Сколько file_id загруженных файлов помнить для повторной отправки и inline режима
+FILE_ID_CACHE_SIZE = int(os.getenv('FILE_ID_CACHE_SIZE', '10000'))
+# Пауза перед обработкой inline запроса, пока пользователь допечатывает ссылку (секунды)
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', '0.6'))
+# Сколько секунд телеграм может кешировать ответ на inline запрос из кеша
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '300'))
+
+# Сколько секунд хранится предзагруженная информация о ссылке, присланной до выбора видео/аудио.
+# Если по ссылке поставлена задача, информация хранится, пока задача ждет в очереди
+PREFETCH_TTL = float(os.getenv('PREFETCH_TTL', '300'))
+
+# Дисковый кеш готовых файлов (повторная отправка без загрузки)
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', 'cache/media')
+# Лимит размера кеша в МБ, 0 - кеш выключен
+MEDIA_CACHE_MAX_MB = int(os.getenv('MEDIA_CACHE_MAX_MB', '2048'))
+
+# Длинное аудио больше лимита телеграма отправляется частями, но не больше стольких частей
+AUDIO_MAX_PARTS = int(os.getenv('AUDIO_MAX_PARTS', '8'))
+
+# Максимум задач в очереди загрузок, сверх этого новые задачи не принимаются
+DOWNLOAD_QUEUE_MAX = int(os.getenv('DOWNLOAD_QUEUE_MAX', '200'))
+# Короткие задачи идут раньше длинных: задача откладывается на QUEUE_AGING_FACTOR секунд
+# за секунду своей оценки, но не больше чем на QUEUE_MAX_DELAY секунд
+QUEUE_AGING_FACTOR = float(os.getenv('QUEUE_AGING_FACTOR', '1.0'))
+QUEUE_MAX_DELAY = float(os.getenv('QUEUE_MAX_DELAY', '600'))
+# Если ожидаемое ожидание больше этого (секунды), бот просит попробовать позже. 0 - без ограничения
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '1800'))
+# Начиная с какого ожидания (секунды) бот сообщает примерное время готовности
+ADMISSION_ETA_NOTICE = float(os.getenv('ADMISSION_ETA_NOTICE', '60'))
+# Максимум задач одного пользователя в очереди и в работе. 0 - без ограничения
+MAX_JOBS_PER_USER = int(os.getenv('MAX_JOBS_PER_USER', '3'))
+
+# Экспорт спанов стадий задач: пусто - выключен, file - в файл JSON Lines, otlp - на OTLP/HTTP коллектор
+TRACING_EXPORT = os.getenv('TRACING_EXPORT', '').strip().lower()
+TRACING_FILE = os.getenv('TRACING_FILE', 'data/traces.jsonl')
+TRACING_OTLP_ENDPOINT = os.getenv('TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+
+# Перезапуск процессов пула загрузок: после стольких задач на процесс (0 - без ограничения)
+POOL_RECYCLE_JOBS = int(os.getenv('POOL_RECYCLE_JOBS', '100'))
+# и при росте RSS процесса на столько МБ от его памяти после первой задачи (0 - без ограничения)
+POOL_RECYCLE_RSS_MB = int(os.getenv('POOL_RECYCLE_RSS_MB', '512'))
+# Telegram ID администраторов через запятую (команда /memory)
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').replace(' ', '').split(',') if user_id}
+
+# Токены ботов-помощников через запятую: они загружают тяжелые файлы в канал-хранилище параллельно основному боту
+HELPER_BOT_TOKENS = [token for token in os.getenv('HELPER_BOT_TOKENS', '').replace(' ', '').split(',') if token]
+# ID приватных каналов-хранилищ через запятую (основной бот и помощники - их администраторы).
+# В канал телеграм пропускает около 20 сообщений в минуту (около 10 загрузок), несколько каналов поднимают предел
+STORAGE_CHAT_IDS = [int(chat_id) for chat_id in os.getenv('STORAGE_CHAT_ID', '').replace(' ', '').split(',') if chat_id]
+# Файлы меньше этого размера (МБ) основной бот отправляет сам
+UPLOAD_SHARD_MIN_MB = float(os.getenv('UPLOAD_SHARD_MIN_MB', '5'))
+
+# Исходящие адреса загрузок по платформам: "YouTube=http://a:8080,socks5://b:1080;Instagram=source:10.0.0.2;*=direct".
+# source:IP - локальный адрес источника, direct - прямое соединение, * - для остальных платформ. Пусто - пул выключен
+PROXY_POOL = os.getenv('PROXY_POOL', '').strip()
+# Карантин адреса, который платформа начала ограничивать: начальный и максимальный срок (секунды)
+PROXY_QUARANTINE_BASE = float(os.getenv('PROXY_QUARANTINE_BASE', '60'))
+PROXY_QUARANTINE_MAX = float(os.getenv('PROXY_QUARANTINE_MAX', '1800'))
+
+# При остановке (SIGTERM) начатые задачи доделываются не дольше стольких секунд, остальные
+# сохраняются в базу PERSISTENCE_PATH, и их забирает следующий экземпляр бота
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '120'))
+
+# Задержка event loop (секунды), после которой в лог пишется стек зависшего кода
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.25'))
+# Порт эндпоинтов /healthz и /readyz для оркестратора, 0 - выключены
+HEALTH_HOST = os.getenv('HEALTH_HOST', '0.0.0.0')
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '0'))
+# При задержке event loop больше этого (секунды) /healthz отвечает 503
+HEALTH_MAX_LAG = float(os.getenv('HEALTH_MAX_LAG', '5'))
@@ -0,0 +1,95 @@
+from typing import Dict, NamedTuple, Optional
+from core.metrics import RateMeter
+
+# Базовая стоимость задачи в секундах работы воркера и добавка за минуту длительности медиа
+BASE_COSTS = {
+    ('YouTube', 'video'): 20.0,
+    ('YouTube', 'audio'): 15.0,
+    ('Twitter', 'video'): 8.0,
+    ('Twitter', 'audio'): 8.0,
+    ('Instagram', 'video'): 10.0,
+    ('Instagram', 'audio'): 10.0,
+}
+DEFAULT_BASE_COST = 15.0
+COST_PER_MINUTE = {'video': 6.0, 'audio': 3.0}
+# Добавка за мегабайт ожидаемого размера файла (загрузка и отправка)
+COST_PER_MB = 0.3
+# Длительность, которую предполагаем, если она неизвестна (секунды)
+DEFAULT_DURATION = 180
+
+# Решение о приеме задачи
+class Admission(NamedTuple):
+    admitted: bool
+    reason: str # ok | busy | user_limit
+    cost: float
+    eta: float # ожидаемое время до готовности задачи (секунды)
+
+# Оценка стоимости задачи (в секундах работы воркера) по платформе, типу, длительности и размеру.
+# Элементы плейлиста заранее неизвестны, поэтому считаем плейлист полным
+def estimate_job_cost(job: dict, duration: Optional[float] = None, playlist_size: int = 1, size_bytes: Optional[int] = None) -> float:
+    command_type = job.get('type', 'video')
+    items = job.get('items') or [{'platform': job.get('platform'), 'playlist': False}]
+    single = len(items) == 1
+    total = 0.0
+    for item in items:
+        base = BASE_COSTS.get((item.get('platform'), command_type), DEFAULT_BASE_COST)
+        item_duration = duration if single and duration else DEFAULT_DURATION
+        cost = base + COST_PER_MINUTE.get(command_type, 0) * item_duration / 60
+        if single and size_bytes:
+            cost += COST_PER_MB * size_bytes / (1024 * 1024)
+        total += cost * (playlist_size if item.get('playlist') else 1)
+    return total
+
+# Оценка стоимости по уже полученной информации о медиа (длительность и размер, если известен)
+def estimate_from_info(job: dict, info: Optional[dict], playlist_size: int = 1) -> float:
+    info = info or {}
+    size = info.get('filesize') or info.get('filesize_approx')
+    return estimate_job_cost(job, duration=info.get('duration'), playlist_size=playlist_size, size_bytes=size)
+
+# Контроль приема задач.
+# Помнит оценки задач в очереди и в работе и калибрует их по фактическому времени выполнения,
+# из этого получает ожидаемое время ожидания. Если оно больше max_wait, задача не принимается.
+# Также ограничивает число одновременных задач одного пользователя
+class AdmissionController:
+    def __init__(self, workers: int, max_wait: float, max_jobs_per_user: int):
+        self.workers = max(1, workers)
+        self.max_wait = max_wait
+        self.max_jobs_per_user = max_jobs_per_user
+        # Фактических секунд на единицу оценки (1.0 - оценки точны)
+        self.calibration = RateMeter(alpha=0.2)
+        self._pending: Dict[str, float] = {}
+
+    @property
+    def seconds_per_unit(self) -> float:
+        return self.calibration.rate or 1.0
+
+    # Сколько ждать задаче стоимостью cost, если поставить её сейчас
+    def eta(self, cost: float = 0.0) -> float:
+        backlog = sum(self._pending.values())
+        return (backlog / self.workers + cost) * self.seconds_per_unit
+
+    def check(self, cost: float, user_active_jobs: int) -> Admission:
+        eta = self.eta(cost)
+        if self.max_jobs_per_user and user_active_jobs >= self.max_jobs_per_user:
+            return Admission(False, 'user_limit', cost, eta)
+        if self.max_wait and self._pending and eta > self.max_wait:
+            return Admission(False, 'busy', cost, eta)
+        return Admission(True, 'ok', cost, eta)
+
+    # Задача принята в очередь
+    def admit(self, request_id: str, cost: float):
+        self._pending[request_id] = cost
+
+    # Уточняет оценку задачи, которая еще не завершена
+    def update(self, request_id: str, cost: float):
+        if request_id in self._pending:
+            self._pending[request_id] = cost
+
+    # Задача завершена. seconds - фактическое время работы (None, если задача отменена или упала)
+    def finish(self, request_id: str, seconds: Optional[float] = None):
+        cost = self._pending.pop(request_id, None)
+        if cost and seconds is not None:
+            self.calibration.record(seconds, cost)
+
+    def __len__(self) -> int:
+        return len(self._pending)
@@ -0,0 +1,27 @@
+from typing import Dict, Optional
+from utils.downloader_base import BaseDownloader
+from utils.downloader_youtube import YouTubeDownloader
+from utils.downloader_twitter import TwitterDownloader
+from utils.downloader_instagram import InstagramDownloader
+
+# Классы downloader'ов по платформам
+DOWNLOADER_CLASSES = {
+    'YouTube': YouTubeDownloader,
+    'Twitter': TwitterDownloader,
+    'Instagram': InstagramDownloader,
+}
+
+# Экземпляры downloader'ов создаются лениво, по одному на процесс
+# (в пуле процессов у каждого дочернего процесса свои экземпляры)
+_downloaders: Dict[str, BaseDownloader] = {}
+
+# Выбирает подходящий downloader для заданной платформы
+def select_downloader(platform: str) -> Optional[BaseDownloader]:
+    downloader = _downloaders.get(platform)
+    if downloader is None:
+        downloader_class = DOWNLOADER_CLASSES.get(platform)
+        if downloader_class is None:
+            return None
+        downloader = downloader_class()
+        _downloaders[platform] = downloader
+    return downloader
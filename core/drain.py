@@ -0,0 +1,166 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+from telegram.ext import Application
+from utils.logger import logger
+from utils.constants import STATUS_RESTART_MESSAGE
+from core.jobs import JobRegistry
+from core.progress import StatusReporter, render_status
+from core.scheduler import JobQueue
+from ui.keyboards import get_job_cancel_markup
+
+# Задачи старше этого (секунды) после перезапуска уже не нужны пользователю
+PENDING_JOB_MAX_AGE = 24 * 3600
+
+# Задача, переданная следующему экземпляру бота
+class PendingJob(NamedTuple):
+    job: dict
+    user_id: Optional[int] = None
+    status_message_id: Optional[int] = None
+
+# Задачи, которые экземпляр бота не успел выполнить до остановки.
+# Лежат в той же базе SQLite, что и состояние пользователей. Следующий экземпляр
+# (или соседняя реплика с той же базой) забирает их атомарно и ставит в свою очередь
+class PendingJobStore:
+    def __init__(self, filepath: str):
+        Path(filepath).parent.mkdir(parents=True, exist_ok=True)
+        self.filepath = filepath
+        self._connection = sqlite3.connect(filepath, check_same_thread=False, timeout=10)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS pending_jobs ('
+                'request_id TEXT PRIMARY KEY, job TEXT NOT NULL, user_id INTEGER, status_message_id INTEGER, saved_at REAL NOT NULL)'
+            )
+
+    def save(self, jobs: List[PendingJob]):
+        if not jobs:
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO pending_jobs (request_id, job, user_id, status_message_id, saved_at) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (pending.job['request_id'], json.dumps(pending.job), pending.user_id, pending.status_message_id, now)
+                    for pending in jobs
+                ]
+            )
+
+    # Забирает все задачи (одним DELETE, чтобы две реплики не взяли одну задачу дважды).
+    # Слишком старые задачи выбрасываются
+    def take_all(self) -> List[PendingJob]:
+        with self._lock, self._connection:
+            rows = self._connection.execute(
+                'DELETE FROM pending_jobs RETURNING job, user_id, status_message_id, saved_at'
+            ).fetchall()
+        since = time.time() - PENDING_JOB_MAX_AGE
+        jobs = [PendingJob(json.loads(job), user_id, status_message_id) for job, user_id, status_message_id, saved_at in rows if saved_at >= since]
+        if len(jobs) < len(rows):
+            logger.info(f"Dropped {len(rows) - len(jobs)} stale pending job(s)")
+        return jobs
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+# Снимки задач для передачи: вместе с задачей сохраняются владелец и статусное сообщение,
+# чтобы после перезапуска работала кнопка отмены. Статусное сообщение отвязывается от задачи,
+# иначе воркер прерванной задачи удалит его
+def _snapshot(jobs: List[dict], job_registry: Optional[JobRegistry]) -> List[PendingJob]:
+    pending = []
+    for job in jobs:
+        handle = job_registry.get(job['request_id']) if job_registry else None
+        if not handle:
+            pending.append(PendingJob(job))
+            continue
+        if handle.cancelled:
+            continue
+        pending.append(PendingJob(job, handle.user_id, handle.status_message_id))
+        handle.status_message_id = None
+    return pending
+
+# Сохраняет задачи в хранилище и сообщает пользователям, что они продолжатся после перезапуска
+async def _handoff(application: Application, store: PendingJobStore, pending: List[PendingJob]) -> int:
+    job_registry: Optional[JobRegistry] = application.bot_data.get('job_registry')
+    status_reporter: Optional[StatusReporter] = application.bot_data.get('status_reporter')
+    await asyncio.to_thread(store.save, pending)
+    for item in pending:
+        if job_registry:
+            job_registry.remove(item.job['request_id'])
+        if status_reporter and item.status_message_id:
+            status_reporter.update(item.job['chat_id'], item.status_message_id, STATUS_RESTART_MESSAGE)
+    return len(pending)
+
+# Режим остановки без потери задач.
+# Ждущие задачи сразу уходят в хранилище (их может забрать уже запущенный новый экземпляр),
+# начатые доделываются до deadline, а недоделанные к этому времени тоже сохраняются и начнутся заново
+async def drain(application: Application, queue: JobQueue, worker_tasks: List[asyncio.Task], store: PendingJobStore, timeout: float):
+    job_registry: Optional[JobRegistry] = application.bot_data.get('job_registry')
+    running_jobs: dict = application.bot_data.setdefault('running_jobs', {})
+    queued = await _handoff(application, store, _snapshot(queue.take_all(), job_registry))
+    logger.info(f"Drain: handed off {queued} queued job(s), waiting up to {timeout:.0f}s for {len(running_jobs)} running job(s)")
+
+    try:
+        await asyncio.wait_for(queue.join(), timeout)
+        logger.info("Drain: all running jobs finished")
+    except asyncio.TimeoutError:
+        # Снимок берется до отмены: отмененный воркер уберет задачу из running_jobs
+        interrupted = _snapshot(list(running_jobs.values()), job_registry)
+        for task in worker_tasks:
+            task.cancel()
+        await asyncio.gather(*worker_tasks, return_exceptions=True)
+        handed_off = await _handoff(application, store, interrupted)
+        logger.warning(f"Drain: deadline reached, {handed_off} running job(s) handed off to restart from scratch")
+
+# Забирает задачи из хранилища в потоке. Если ожидание отменили (бот останавливается),
+# уже забранные задачи возвращаются в хранилище, а не теряются
+async def _take_pending(store: PendingJobStore) -> List[PendingJob]:
+    take = asyncio.ensure_future(asyncio.to_thread(store.take_all))
+    try:
+        return await asyncio.shield(take)
+    except asyncio.CancelledError:
+        store.save(await take)
+        raise
+
+# Забирает из хранилища задачи, оставленные предыдущим экземпляром, и ставит их в очередь.
+# Работает постоянно: при перекрывающемся деплое старый экземпляр сохраняет задачи уже после старта нового
+async def restore_pending_jobs(application: Application, queue: JobQueue, store: PendingJobStore, interval: float = 10):
+    job_registry: Optional[JobRegistry] = application.bot_data.get('job_registry')
+    status_reporter: Optional[StatusReporter] = application.bot_data.get('status_reporter')
+    while True:
+        try:
+            if not application.bot_data.get('draining'):
+                jobs = await _take_pending(store)
+                leftover = []
+                for pending in jobs:
+                    job = pending.job
+                    try:
+                        queue.put_nowait(job)
+                    except asyncio.QueueFull:
+                        leftover.append(pending)
+                        continue
+                    admission = application.bot_data.get('admission')
+                    if admission:
+                        admission.admit(job['request_id'], job.get('cost') or 0)
+                    handle = job_registry.register(job['request_id'], job['chat_id'], pending.user_id) if job_registry else None
+                    if handle and pending.status_message_id:
+                        handle.status_message_id = pending.status_message_id
+                        if status_reporter:
+                            status_reporter.update(
+                                job['chat_id'],
+                                pending.status_message_id,
+                                render_status({'stage': 'queued'}, queue.position(job['request_id'])),
+                                reply_markup=get_job_cancel_markup(job['request_id'])
+                            )
+                # Не влезло в очередь - вернем в хранилище до следующей проверки
+                await asyncio.to_thread(store.save, leftover)
+                if jobs:
+                    logger.info(f"Restored {len(jobs) - len(leftover)} pending job(s) from previous instance")
+        except Exception as e:
+            logger.error(f"Failed to restore pending jobs: {e}", exc_info=True)
+        await asyncio.sleep(interval)
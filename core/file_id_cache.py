@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Set
+from utils.validate_url import canonicalize_url
+
+# Уже загруженный в телеграм файл: его можно отправить повторно по file_id без скачивания
+class CachedMedia(NamedTuple):
+    file_id: str
+    media_type: str # video | audio
+    title: Optional[str] = None
+
+# Ключ кеша: каноническая ссылка + тип задачи
+def make_cache_key(url: str, command_type: str) -> Optional[str]:
+    canonical = canonicalize_url(url)
+    return f"{canonical}|{command_type}" if canonical else None
+
+# LRU кеш file_id по каноническим ссылкам.
+# Поиск - одно обращение к словарю, поэтому inline запросы из кеша отвечают сразу.
+# Также помнит ключи, загрузка которых уже идет, чтобы не ставить одну ссылку в очередь дважды
+class FileIdCache:
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, CachedMedia]' = OrderedDict()
+        self._pending: Set[str] = set()
+
+    def get(self, key: Optional[str]) -> Optional[CachedMedia]:
+        media = self._entries.get(key) if key else None
+        if media:
+            self._entries.move_to_end(key)
+        return media
+
+    def put(self, key: Optional[str], media: CachedMedia):
+        if not key:
+            return
+        self._entries[key] = media
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Отмечает, что загрузка по ключу поставлена в очередь.
+    # Возвращает False, если она уже идет
+    def mark_pending(self, key: str) -> bool:
+        if key in self._pending:
+            return False
+        self._pending.add(key)
+        return True
+
+    def discard_pending(self, key: Optional[str]):
+        if key:
+            self._pending.discard(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
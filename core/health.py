@@ -0,0 +1,180 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from typing import List, Optional
+from aiohttp import web
+from telegram.ext import Application
+from utils.logger import logger
+from core.metrics import Histogram
+from core.scheduler import JobQueue
+
+# Границы корзин гистограммы задержки event loop (секунды)
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Как часто проверять связь с телеграмом (секунды)
+TELEGRAM_PROBE_INTERVAL = 30
+TELEGRAM_PROBE_TIMEOUT = 10
+# Очередь заполнена на столько, что новые задачи лучше отправлять другой реплике
+READY_QUEUE_RATIO = 0.9
+
+# Задержка event loop.
+# Задача в loop каждые interval секунд отмечается и меряет, насколько позже срока она проснулась.
+# Отдельный поток-сторож следит за отметками: если loop не отмечался дольше threshold,
+# значит его держит синхронный вызов, и сторож пишет в лог стек loop прямо во время зависания,
+# то есть стек виновного колбэка, а не того, что выполнялось после
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.5, threshold: float = 0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self.histogram = Histogram(LAG_BUCKETS)
+        self.last_lag = 0.0
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._sample())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    # Сколько loop не отмечался к этому моменту (растет, пока loop чем-то занят)
+    def current_lag(self) -> float:
+        return max(0.0, time.monotonic() - self._heartbeat - self.interval)
+
+    async def _sample(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            self.last_lag = max(0.0, now - expected)
+            self.histogram.observe(self.last_lag)
+
+    def _watch(self):
+        reported_heartbeat = None
+        while not self._stop.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            # Одно сообщение на зависание
+            if blocked < self.threshold or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else 'unavailable'
+            logger.warning(f"Event loop blocked for {blocked:.2f}s, loop thread stack:\n{stack}")
+
+    def stats(self) -> dict:
+        return {
+            'last': round(self.last_lag, 4),
+            'current': round(self.current_lag(), 4),
+            'p50': self.histogram.quantile(0.5),
+            'p99': self.histogram.quantile(0.99),
+            'max': round(self.histogram.max, 4),
+            'stalls': self.stalls,
+            'buckets': self.histogram.buckets(),
+        }
+
+# Эндпоинты для оркестратора.
+# /healthz (жив ли процесс): loop не завис дольше max_lag и все воркеры работают. 503 - процесс надо перезапустить.
+# /readyz (можно ли слать новые задачи): бот не останавливается, получает обновления, телеграм отвечает
+# и очередь не переполнена. 503 - трафик лучше направить на другую реплику
+class HealthServer:
+    def __init__(
+        self,
+        application: Application,
+        queue: JobQueue,
+        worker_tasks: List[asyncio.Task],
+        monitor: LoopLagMonitor,
+        host: str,
+        port: int,
+        max_lag: float
+    ):
+        self.application = application
+        self.queue = queue
+        self.worker_tasks = worker_tasks
+        self.monitor = monitor
+        self.host = host
+        self.port = port
+        self.max_lag = max_lag
+        self.telegram_ok = False
+        self.telegram_checked_at: Optional[float] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._probe_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/healthz', self.healthz)
+        app.router.add_get('/readyz', self.readyz)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._probe_task = asyncio.create_task(self._probe_telegram())
+        logger.info(f"Health endpoints listening on http://{self.host}:{self.port}")
+
+    async def stop(self):
+        if self._probe_task:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+        if self._runner:
+            await self._runner.cleanup()
+
+    # Связь с телеграмом: последний запрос getMe удался
+    async def _probe_telegram(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.application.bot.get_me(), TELEGRAM_PROBE_TIMEOUT)
+                self.telegram_ok = True
+            except Exception as e:
+                if self.telegram_ok:
+                    logger.warning(f"Telegram API is unreachable: {e}")
+                self.telegram_ok = False
+            self.telegram_checked_at = time.time()
+            await asyncio.sleep(TELEGRAM_PROBE_INTERVAL)
+
+    def _health(self) -> dict:
+        dead_workers = sum(1 for task in self.worker_tasks if task.done())
+        lag = max(self.monitor.last_lag, self.monitor.current_lag())
+        return {
+            'ok': dead_workers == 0 and lag < self.max_lag,
+            'workers': len(self.worker_tasks),
+            'dead_workers': dead_workers,
+            'running_jobs': len(self.application.bot_data.get('running_jobs') or {}),
+            'loop_lag': self.monitor.stats(),
+        }
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        health = self._health()
+        return web.json_response(health, status=200 if health['ok'] else 503)
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        health = self._health()
+        updater = self.application.updater
+        draining = bool(self.application.bot_data.get('draining'))
+        polling = bool(updater and updater.running)
+        depth = self.queue.qsize()
+        queue_full = bool(self.queue.maxsize) and depth >= self.queue.maxsize * READY_QUEUE_RATIO
+        ready = health['ok'] and not draining and polling and self.telegram_ok and not queue_full
+        body = {
+            'ready': ready,
+            'draining': draining,
+            'polling': polling,
+            'telegram': self.telegram_ok,
+            'telegram_checked_at': self.telegram_checked_at,
+            'queue_depth': depth,
+            'queue_max': self.queue.maxsize,
+            'lanes': self.queue.lane_sizes(),
+            **health,
+        }
+        return web.json_response(body, status=200 if ready else 503)
@@ -0,0 +1,82 @@
+import time
+from typing import Dict, List, Optional, Tuple
+from core.file_id_cache import make_cache_key
+from utils.job_control import JobControl
+
+# Состояние одной задачи в очереди бота
+class JobHandle:
+    def __init__(self, request_id: str, chat_id: int, user_id: Optional[int]):
+        self.request_id = request_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.status = 'queued' # queued -> running
+        self.cancelled = False
+        self.control: Optional[JobControl] = None
+        # Сообщение со статусом задачи и кнопкой отмены
+        self.status_message_id: Optional[int] = None
+        # Для пакетной задачи: (номер текущего элемента, всего элементов)
+        self.batch_position: Optional[Tuple[int, int]] = None
+        self.created_at = time.time()
+
+    # Привязывает управление загрузкой, когда воркер взял задачу
+    def attach_control(self, control: JobControl):
+        self.control = control
+        if self.cancelled:
+            control.cancel()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.control:
+            self.control.cancel()
+
+# Реестр задач в очереди и в работе.
+# Отмененная задача перестает считаться активной сразу, а воркер пропускает её,
+# когда достает из очереди, и только тогда удаляет из реестра
+class JobRegistry:
+    def __init__(self):
+        self._jobs: Dict[str, JobHandle] = {}
+
+    def register(self, request_id: str, chat_id: int, user_id: Optional[int]) -> JobHandle:
+        handle = JobHandle(request_id, chat_id, user_id)
+        self._jobs[request_id] = handle
+        return handle
+
+    def get(self, request_id: str) -> Optional[JobHandle]:
+        return self._jobs.get(request_id)
+
+    def remove(self, request_id: str):
+        self._jobs.pop(request_id, None)
+
+    # Отменяет активную задачу. Возвращает отмененную задачу или None
+    def cancel(self, request_id: str) -> Optional[JobHandle]:
+        handle = self._jobs.get(request_id)
+        if not handle or handle.cancelled:
+            return None
+        handle.cancel()
+        return handle
+
+    # Активные (не отмененные) задачи в порядке постановки в очередь
+    def active(self) -> List[JobHandle]:
+        return [handle for handle in self._jobs.values() if not handle.cancelled]
+
+    # Активные задачи пользователя
+    def for_user(self, user_id: int) -> List[JobHandle]:
+        return [handle for handle in self.active() if handle.user_id == user_id]
+
+# Снимает отмененную задачу, которая еще ждет в очереди: место в очереди и её оценка
+# в контроле нагрузки освобождаются сразу, а не когда воркер до нее дойдет.
+# Возвращает задачу или None, если её уже взял воркер (тогда он сам все уберет)
+def withdraw_queued_job(bot_data: dict, request_id: str) -> Optional[dict]:
+    queue = bot_data.get('download_queue')
+    job = queue.remove(request_id) if queue else None
+    if not job:
+        return None
+    if bot_data.get('job_registry'):
+        bot_data['job_registry'].remove(request_id)
+    if bot_data.get('admission'):
+        bot_data['admission'].finish(request_id)
+    if bot_data.get('file_id_cache'):
+        bot_data['file_id_cache'].discard_pending(make_cache_key(job['url'], job['type']))
+    if bot_data.get('info_prefetcher'):
+        bot_data['info_prefetcher'].discard(job['url'])
+    return job
@@ -0,0 +1,30 @@
+from typing import Dict, NamedTuple, Optional
+from utils.validate_url import canonicalize_url
+
+class LocalVideo(NamedTuple):
+    filepath: str
+    title: str
+    duration: Optional[int] = None
+
+# Видео, которые прямо сейчас лежат во временной папке (скачаны и еще не удалены после отправки).
+# Аудио задача по той же ссылке может взять дорожку из такого файла, не дожидаясь кеша
+class LocalVideos:
+    def __init__(self):
+        self._videos: Dict[str, LocalVideo] = {}
+
+    def register(self, url: str, video: LocalVideo):
+        key = canonicalize_url(url)
+        if key:
+            self._videos[key] = video
+
+    # Убирает файл перед его удалением
+    def discard(self, filepath: str):
+        for key in [key for key, video in self._videos.items() if video.filepath == filepath]:
+            del self._videos[key]
+
+    def get(self, url: str) -> Optional[LocalVideo]:
+        key = canonicalize_url(url)
+        return self._videos.get(key) if key else None
+
+    def __len__(self) -> int:
+        return len(self._videos)
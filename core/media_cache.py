@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from utils.logger import logger
+from utils.validate_url import canonicalize_url
+
+# Запись кеша: ключ медиа указывает на файл с содержимым (blob) по его sha256
+class CacheEntry(NamedTuple):
+    blob: str # sha256 содержимого
+    ext: str
+    title: str
+    size: int
+    last_used: float
+    # Метаданные для отправки: длительность и размеры
+    meta: Optional[dict] = None
+
+# Дисковый кеш готовых файлов.
+# Ключ - каноническая ссылка + тип задачи + уровень качества, файл хранится один раз
+# по хешу содержимого (разные ключи с одинаковым результатом делят один blob).
+# Файлы попадают в кеш и выдаются из него жесткими ссылками, без копирования.
+# Индекс и blob'ы пишутся через временный файл и os.replace, поэтому после падения
+# в кеше не бывает недописанных файлов. При превышении лимита вытесняются давно не использованные записи.
+# Под _lock только работа с памятью и переименования: копирование файлов, fsync, запись индекса
+# и удаление blob'ов идут вне его, чтобы get и stats (его зовут из event loop) не ждали диск
+class MediaCache:
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = Path(root)
+        self.blobs_dir = self.root / 'blobs'
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Запись индекса на диск: версия снимка защищает от записи старого снимка поверх нового
+        self._index_lock = threading.Lock()
+        self._index_version = 0
+        self._written_version = 0
+        self._entries: Dict[str, CacheEntry] = {}
+        self.hits = 0
+        self.misses = 0
+        self._load_index()
+
+    # Ключ кеша для ссылки. Для аудио качество видео не важно
+    @staticmethod
+    def make_key(url: str, command_type: str, quality: Optional[str] = None) -> Optional[str]:
+        canonical = canonicalize_url(url)
+        if not canonical:
+            return None
+        tier = (quality or 'best') if command_type == 'video' else '-'
+        return f"{canonical}|{command_type}|{tier}"
+
+    # Выдает файл из кеша жесткой ссылкой в target_dir.
+    # Возвращает (путь, заголовок, метаданные) или None при промахе
+    def get(self, key: str, target_dir: Path, prefix: str) -> Optional[Tuple[str, str, dict]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                self.misses += 1
+                return None
+
+        # Ссылка (или копия между файловыми системами) делается вне блокировки
+        target = target_dir / f"{prefix}_{entry.blob[:16]}.{entry.ext}"
+        try:
+            self._link_or_copy(self._blob_path(entry.blob, entry.ext), target)
+        except OSError as e:
+            # blob пропал с диска (удалили руками или его только что вытеснили)
+            logger.warning(f"Media cache entry is broken, dropping it: {e}")
+            with self._lock:
+                if self._entries.get(key) == entry:
+                    del self._entries[key]
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            current = self._entries.get(key)
+            if current and current.blob == entry.blob:
+                self._entries[key] = current._replace(last_used=time.time())
+        return str(target), entry.title, entry.meta or {}
+
+    # Файл в кеше для ссылки и типа задачи с любым уровнем качества (самый недавно использованный).
+    # Возвращает (путь к blob'у, заголовок, метаданные) или None. Файл не выдается и в статистику не идет:
+    # его только читают, например чтобы вынуть аудио из видео
+    def find(self, url: str, command_type: str) -> Optional[Tuple[str, str, dict]]:
+        canonical = canonicalize_url(url)
+        if not canonical:
+            return None
+        prefix = f"{canonical}|{command_type}|"
+        with self._lock:
+            matches = [(key, entry) for key, entry in self._entries.items() if key.startswith(prefix)]
+            if not matches:
+                return None
+            key, entry = max(matches, key=lambda item: item[1].last_used)
+            self._entries[key] = entry._replace(last_used=time.time())
+            return str(self._blob_path(entry.blob, entry.ext)), entry.title, entry.meta or {}
+
+    # Кладет готовый файл в кеш. Сам файл остается на месте
+    def put(self, key: str, filepath: str, title: str, meta: Optional[dict] = None):
+        blob = self._hash_file(filepath)
+        ext = Path(filepath).suffix.lstrip('.') or 'bin'
+        blob_path = self._blob_path(blob, ext)
+
+        # Если такое же содержимое уже лежит в кеше под другим ключом, blob не нужен.
+        # Иначе он готовится во временном файле до блокировки (копия между файловыми системами
+        # может быть долгой), а под блокировкой только переименовывается
+        staged = None
+        while True:
+            if staged is None and not blob_path.exists():
+                staged = self._stage_blob(Path(filepath))
+            with self._lock:
+                if staged:
+                    os.replace(staged, blob_path)
+                elif not blob_path.exists():
+                    # blob вытеснили после проверки: готовим его заново вне блокировки
+                    continue
+                self._entries[key] = CacheEntry(blob, ext, title, blob_path.stat().st_size, time.time(), meta)
+                evicted = self._evict()
+                snapshot = self._index_snapshot()
+            break
+        for path in evicted:
+            path.unlink(missing_ok=True)
+        # Содержимое blob'а сброшено на диск в _stage_blob, а его переименование - здесь,
+        # до записи индекса, который на него ссылается
+        if staged:
+            self._fsync_dir(self.blobs_dir)
+        self._write_index(*snapshot)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            blobs = {(entry.blob, entry.ext): entry.size for entry in self._entries.values()}
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'blobs': len(blobs),
+                'bytes': sum(blobs.values()),
+            }
+
+    # Сохраняет индекс (например, чтобы не потерять время последнего использования при остановке)
+    def flush(self):
+        with self._lock:
+            snapshot = self._index_snapshot()
+        self._write_index(*snapshot)
+
+    def _blob_path(self, blob: str, ext: str) -> Path:
+        return self.blobs_dir / f"{blob}.{ext}"
+
+    # Вытесняет записи по LRU, пока blob'ы не влезут в лимит.
+    # blob, на который не ссылается ни одна запись, переименовывается (новый put его уже не найдет),
+    # а удаляет файлы вызывающий после снятия блокировки. Возвращает файлы для удаления
+    def _evict(self) -> List[Path]:
+        evicted: List[Path] = []
+        blobs = {(entry.blob, entry.ext): entry.size for entry in self._entries.values()}
+        total = sum(blobs.values())
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1].last_used):
+            if total <= self.max_bytes:
+                break
+            del self._entries[key]
+            blob_key = (entry.blob, entry.ext)
+            if any((other.blob, other.ext) == blob_key for other in self._entries.values()):
+                continue
+            total -= blobs[blob_key]
+            trash_path = self.blobs_dir / f".evicted-{uuid.uuid4().hex}"
+            try:
+                os.rename(self._blob_path(entry.blob, entry.ext), trash_path)
+                evicted.append(trash_path)
+            except FileNotFoundError:
+                pass
+            logger.info(f"Media cache evicted {entry.blob[:16]} ({entry.size / (1024 * 1024):.1f}MB)")
+        return evicted
+
+    def _load_index(self):
+        index_path = self.root / self.INDEX_FILE
+        try:
+            with open(index_path, encoding='utf-8') as index_file:
+                data = json.load(index_file)
+            self._entries = {key: CacheEntry(*value) for key, value in data.items()}
+        except FileNotFoundError:
+            self._entries = {}
+        except Exception as e:
+            logger.warning(f"Media cache index is damaged, starting empty: {e}")
+            self._entries = {}
+
+        # Чистим то, что осталось от прерванных записей, и blob'ы без записей
+        known = {self._blob_path(entry.blob, entry.ext).name for entry in self._entries.values()}
+        for path in self.blobs_dir.iterdir():
+            if path.name not in known:
+                path.unlink(missing_ok=True)
+        logger.info(f"Media cache loaded: {len(self._entries)} entries")
+
+    # Снимок индекса для записи (вызывается под _lock)
+    def _index_snapshot(self) -> Tuple[int, Dict[str, list]]:
+        self._index_version += 1
+        return self._index_version, {key: list(entry) for key, entry in self._entries.items()}
+
+    def _write_index(self, version: int, data: Dict[str, list]):
+        index_path = self.root / self.INDEX_FILE
+        tmp_path = self.root / f".{self.INDEX_FILE}.tmp"
+        with self._index_lock:
+            # Более свежий снимок уже записан
+            if version <= self._written_version:
+                return
+            with open(tmp_path, 'w', encoding='utf-8') as index_file:
+                json.dump(data, index_file)
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            os.replace(tmp_path, index_path)
+            self._written_version = version
+
+    # Временный файл с содержимым blob'а, сброшенный на диск
+    def _stage_blob(self, source: Path) -> Path:
+        tmp_path = self.blobs_dir / f".tmp-{uuid.uuid4().hex}"
+        self._link_or_copy(source, tmp_path)
+        with open(tmp_path, 'rb') as tmp_file:
+            os.fsync(tmp_file.fileno())
+        return tmp_path
+
+    @staticmethod
+    def _fsync_dir(path: Path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _hash_file(filepath: str) -> str:
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # Жесткая ссылка, а если файловые системы разные - копия.
+    # Файл на месте target мог остаться от прошлой задачи с другим содержимым, поэтому он заменяется
+    @classmethod
+    def _link_or_copy(cls, source: Path, target: Path):
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            target.unlink(missing_ok=True)
+            cls._link_or_copy(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
@@ -0,0 +1,57 @@
+import bisect
+import time
+from typing import Dict, Optional, Sequence
+
+# Экспоненциально сглаженная скорость (единиц в секунду).
+# Используется для оценки недавней пропускной способности загрузок
+class RateMeter:
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.rate: Optional[float] = None
+        self.updated_at: Optional[float] = None
+
+    # Учитывает очередное измерение: amount единиц за seconds секунд
+    def record(self, amount: float, seconds: float):
+        if seconds <= 0:
+            return
+        sample = amount / seconds
+        if self.rate is None:
+            self.rate = sample
+        else:
+            self.rate = self.alpha * sample + (1 - self.alpha) * self.rate
+        self.updated_at = time.monotonic()
+
+# Гистограмма значений с фиксированными верхними границами корзин (последняя - бесконечность)
+class Histogram:
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = list(bounds) + [float('inf')]
+        self.counts = [0] * len(self.bounds)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Верхняя граница корзины, в которую попадает квантиль q (0..1)
+    def quantile(self, q: float) -> float:
+        if not self.total:
+            return 0.0
+        rank = q * self.total
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float('inf') else self.max
+        return self.max
+
+    # Число значений не больше каждой границы (накопительно, как в Prometheus)
+    def buckets(self) -> Dict[str, int]:
+        result, seen = {}, 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            result['+Inf' if bound == float('inf') else f"{bound:g}"] = seen
+        return result
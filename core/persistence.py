@@ -0,0 +1,216 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+from telegram.ext import Application, BasePersistence, PersistenceInput
+from utils.logger import logger
+from core.user_state import UserState
+
+# Хранилище состояния бота в SQLite: состояние пользователей и диалогов.
+# Запись отложенная: изменения копятся и пишутся одной транзакцией.
+# В память при старте поднимаются только недавно активные пользователи,
+# остальные догружаются лениво при первом апдейте (refresh_user_data)
+class SQLitePersistence(BasePersistence):
+    def __init__(
+        self,
+        filepath: str,
+        update_interval: float = 60,
+        write_delay: float = 1.0,
+        preload_window: float = 3600
+    ):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        Path(filepath).parent.mkdir(parents=True, exist_ok=True)
+        self.filepath = filepath
+        self.write_delay = write_delay
+        self.preload_window = preload_window
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._init_schema()
+
+        # Отложенные записи: None означает удаление
+        self._pending_users: Dict[int, Optional[Tuple[str, float]]] = {}
+        self._pending_conversations: Dict[Tuple[str, str], Optional[int]] = {}
+        self._commit_task: Optional[asyncio.Task] = None
+        # Пользователи, выгруженные из памяти по простою: их данные в базе не удаляем
+        self._evicted: Set[int] = set()
+
+    def _init_schema(self):
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state INTEGER NOT NULL, PRIMARY KEY (name, key))'
+            )
+
+    # --- Чтение ---
+
+    async def get_user_data(self) -> Dict[int, UserState]:
+        since = time.time() - self.preload_window
+        rows = await asyncio.to_thread(self._query, 'SELECT user_id, data FROM user_data WHERE updated_at >= ?', (since,))
+        result = {}
+        for user_id, data in rows:
+            state = UserState()
+            state.update_from(json.loads(data))
+            state.loaded = True
+            result[user_id] = state
+        logger.info(f"Loaded state of {len(result)} recently active user(s)")
+        return result
+
+    async def refresh_user_data(self, user_id: int, user_data: UserState):
+        user_data.touch()
+        if user_data.loaded:
+            return
+        # Сначала смотрим в еще не записанные изменения, потом в базу
+        if user_id in self._pending_users:
+            pending = self._pending_users[user_id]
+            data = pending[0] if pending else None
+        else:
+            rows = await asyncio.to_thread(self._query, 'SELECT data FROM user_data WHERE user_id = ?', (user_id,))
+            data = rows[0][0] if rows else None
+        if data:
+            user_data.update_from(json.loads(data))
+        user_data.loaded = True
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+        rows = await asyncio.to_thread(self._query, 'SELECT key, state FROM conversations WHERE name = ?', (name,))
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def get_chat_data(self) -> Dict:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    # --- Запись ---
+
+    async def update_user_data(self, user_id: int, data: UserState):
+        self._pending_users[user_id] = (json.dumps(data.to_dict()), data.last_seen)
+        self._schedule_commit()
+
+    async def drop_user_data(self, user_id: int):
+        if user_id in self._evicted:
+            self._evicted.discard(user_id)
+            return
+        self._pending_users[user_id] = None
+        self._schedule_commit()
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]):
+        self._pending_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_commit()
+
+    async def update_chat_data(self, chat_id: int, data: Dict):
+        pass
+
+    async def update_bot_data(self, data: Dict):
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict):
+        pass
+
+    async def flush(self):
+        if self._commit_task and not self._commit_task.done():
+            self._commit_task.cancel()
+        await asyncio.to_thread(self._commit, *self._take_pending())
+        with self._lock:
+            self._connection.close()
+        logger.info("Persistence flushed and closed")
+
+    # Помечает пользователя как выгруженного из памяти, чтобы последующий drop не удалил его из базы
+    def mark_evicted(self, user_id: int):
+        self._evicted.add(user_id)
+
+    def _schedule_commit(self):
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._commit_later())
+
+    async def _commit_later(self):
+        # Небольшая задержка, чтобы собрать в одну транзакцию все изменения пачки апдейтов
+        await asyncio.sleep(self.write_delay)
+        try:
+            await asyncio.to_thread(self._commit, *self._take_pending())
+        except Exception as e:
+            logger.error(f"Failed to commit persistence changes: {e}", exc_info=True)
+
+    def _take_pending(self):
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        return users, conversations
+
+    def _commit(self, users: Dict, conversations: Dict):
+        if not users and not conversations:
+            return
+        with self._lock, self._connection:
+            for user_id, value in users.items():
+                if value is None:
+                    self._connection.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+                else:
+                    self._connection.execute(
+                        'INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)',
+                        (user_id, value[0], value[1])
+                    )
+            for (name, key), state in conversations.items():
+                if state is None:
+                    self._connection.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, key))
+                else:
+                    self._connection.execute(
+                        'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                        (name, key, state)
+                    )
+        logger.debug(f"Persisted {len(users)} user(s) and {len(conversations)} conversation(s)")
+
+    def _query(self, sql: str, params: tuple = ()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+# Периодически выгружает из памяти состояние давно неактивных пользователей
+# (в базе оно остается и догрузится при следующем апдейте) и логирует расход памяти
+async def evict_idle_user_state(
+    application: Application,
+    persistence: SQLitePersistence,
+    idle_ttl: float,
+    max_in_memory: int,
+    interval: float = 300
+):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            now = time.time()
+            states = sorted(application.user_data.items(), key=lambda item: item[1].last_seen)
+            overflow = max(0, len(states) - max_in_memory)
+            evicted = 0
+            for index, (user_id, state) in enumerate(states):
+                if index >= overflow and now - state.last_seen < idle_ttl:
+                    break
+                persistence.mark_evicted(user_id)
+                application.drop_user_data(user_id)
+                evicted += 1
+
+            remaining = len(application.user_data)
+            total_bytes = sum(state.approx_size() for state in application.user_data.values())
+            per_user = total_bytes / remaining if remaining else 0
+            logger.info(
+                f"User state: evicted {evicted}, in memory {remaining} "
+                f"(~{total_bytes / 1024:.1f}KB, ~{per_user:.0f}B per user)"
+            )
+        except Exception as e:
+            logger.error(f"User state eviction failed: {e}", exc_info=True)
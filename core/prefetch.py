@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from utils.logger import logger
+from utils.validate_url import canonicalize_url
+from utils.downloader_base import DownloadError
+from core.downloaders import select_downloader
+from core.process_pool import DownloadProcessPool
+from core.proxy_pool import OUTCOME_OK, ProxyEntry, ProxyPool, classify_error
+
+# Предзагруженная информация и адрес, через который её получили.
+# Ссылки на файлы в ней привязаны к этому адресу, качать нужно через него же
+class Prefetched(NamedTuple):
+    info: dict
+    proxy: Optional[ProxyEntry] = None
+
+# Сколько дешевых оценок медиа (probe) выполняется одновременно. Они идут в потоках основного
+# процесса, а не в пуле загрузок, чтобы не занимать процессы, которые качают
+PROBE_CONCURRENCY = 2
+
+# Запись предзагрузки. pinned - по ссылке есть задача в очереди, запись живет до её выполнения
+class _Entry:
+    __slots__ = ('task', 'created_at', 'pinned')
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.created_at = time.monotonic()
+        self.pinned = False
+
+# Спекулятивное получение информации о ссылке.
+# Пользователь прислал ссылку раньше, чем выбрал видео или аудио: пока он нажимает кнопку,
+# yt-dlp уже разбирает страницу, а загрузка потом берет готовую информацию.
+# Если по ссылке поставлена задача, информация хранится, пока задача ждет в очереди.
+# Остальные результаты живут ttl секунд, ошибки предзагрузки просто игнорируются
+class InfoPrefetcher:
+    def __init__(
+        self,
+        process_pool: Optional[DownloadProcessPool] = None,
+        ttl: float = 300,
+        max_entries: int = 256,
+        proxy_pool: Optional[ProxyPool] = None
+    ):
+        self.process_pool = process_pool
+        self.proxy_pool = proxy_pool
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._tasks: 'OrderedDict[str, _Entry]' = OrderedDict()
+        self._probe_slots = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return canonicalize_url(url) or url
+
+    # Запускает получение информации в фоне, если для этой ссылки его еще нет
+    def start(self, url: str, platform: str):
+        self._expire()
+        key = self._key(url)
+        if key in self._tasks:
+            return
+        self._tasks[key] = _Entry(asyncio.create_task(self._extract(url, platform)))
+        # Лишние записи вытесняются с самых старых, записи задач из очереди не трогаем
+        overflow = len(self._tasks) - self.max_entries
+        if overflow > 0:
+            for old_key in [old_key for old_key, entry in self._tasks.items() if not entry.pinned][:overflow]:
+                self._tasks.pop(old_key).task.cancel()
+
+    # По ссылке поставлена задача: информация нужна, пока задача не дойдет до загрузки
+    def pin(self, url: str) -> bool:
+        entry = self._tasks.get(self._key(url))
+        if entry:
+            entry.pinned = True
+        return bool(entry)
+
+    # Задача по ссылке завершилась, не забрав информацию (отменена или упала раньше загрузки)
+    def discard(self, url: str):
+        entry = self._tasks.pop(self._key(url), None)
+        if entry:
+            entry.task.cancel()
+
+    # Уже готовая предзагруженная информация (без ожидания и без изъятия)
+    def peek(self, url: str) -> Optional[dict]:
+        entry = self._tasks.get(self._key(url))
+        if not entry or not entry.task.done() or entry.task.cancelled() or not entry.task.result():
+            return None
+        return entry.task.result().info
+
+    # Дожидается предзагрузки, не забирая её (загрузка потом возьмет ту же информацию)
+    async def wait(self, url: str, timeout: Optional[float] = None) -> Optional[dict]:
+        entry = self._tasks.get(self._key(url))
+        if not entry:
+            return None
+        try:
+            prefetched = await asyncio.wait_for(asyncio.shield(entry.task), timeout)
+        except Exception:
+            return None
+        return prefetched.info if prefetched else None
+
+    # Забирает предзагруженную информацию, дожидаясь незавершенной предзагрузки.
+    # Возвращает None, если предзагрузки не было или она не удалась
+    async def take(self, url: str, timeout: Optional[float] = None) -> Optional[Prefetched]:
+        self._expire()
+        entry = self._tasks.pop(self._key(url), None)
+        if not entry:
+            return None
+        try:
+            return await asyncio.wait_for(entry.task, timeout)
+        except Exception as e:
+            logger.debug(f"Prefetched info for {url} is not usable: {e}")
+            return None
+
+    # Дешевая оценка длительности и размера для места задачи в очереди (без полной обработки yt-dlp).
+    # Результат не кешируется и для загрузки не годится. None - оценить не удалось
+    async def probe(self, url: str, platform: str, timeout: Optional[float] = None) -> Optional[dict]:
+        downloader = select_downloader(platform)
+        if not downloader:
+            return None
+        async with self._probe_slots:
+            lease = self.proxy_pool.acquire(platform) if self.proxy_pool else None
+            outcome = None
+            try:
+                info = await asyncio.wait_for(downloader.probe_info(url, lease.entry.session() if lease else None), timeout)
+                outcome = OUTCOME_OK
+                return info
+            except Exception as e:
+                if isinstance(e, DownloadError):
+                    outcome = classify_error(str(e))
+                logger.info(f"Probe for {url} failed: {e}")
+                return None
+            finally:
+                if self.proxy_pool:
+                    self.proxy_pool.release(lease, outcome)
+
+    async def _extract(self, url: str, platform: str) -> Optional[Prefetched]:
+        started = time.monotonic()
+        lease = self.proxy_pool.acquire(platform) if self.proxy_pool else None
+        session = lease.entry.session() if lease else None
+        try:
+            if self.process_pool:
+                info = await self.process_pool.extract_info(platform, url, session)
+            else:
+                downloader = select_downloader(platform)
+                if not downloader:
+                    return None
+                info = await downloader.extract_info(url, session)
+        except Exception as e:
+            if self.proxy_pool:
+                self.proxy_pool.release(lease, classify_error(str(e)) if isinstance(e, DownloadError) else None)
+            logger.info(f"Prefetch for {url} failed: {e}")
+            return None
+        except BaseException:
+            if self.proxy_pool:
+                self.proxy_pool.release(lease, None)
+            raise
+        seconds = time.monotonic() - started
+        if self.proxy_pool:
+            # Задержку адреса считаем по загрузкам, здесь учитываем только успех
+            self.proxy_pool.release(lease, OUTCOME_OK)
+        logger.info(f"Prefetched info for {url} in {seconds:.1f}s" + (f" via {lease.entry}" if lease else ""))
+        return Prefetched(info, lease.entry if lease else None)
+
+    # Выбрасывает неиспользованные записи старше ttl. Записи задач из очереди живут до take или discard
+    def _expire(self):
+        now = time.monotonic()
+        for key, entry in list(self._tasks.items()):
+            if now - entry.created_at <= self.ttl:
+                break
+            if entry.pinned:
+                continue
+            del self._tasks[key]
+            entry.task.cancel()
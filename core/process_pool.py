@@ -0,0 +1,178 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+from utils.logger import logger, request_context
+from utils.memory import current_rss, format_mb
+from config import MAX_FRAGMENT_CONNECTIONS, POOL_RECYCLE_JOBS, POOL_RECYCLE_RSS_MB
+from utils.downloader_base import DownloadError, DownloadResult, DownloadSession, connection_budget
+from utils.job_control import JobControl, JobCancelledError
+from core.downloaders import select_downloader
+
+# Event loop дочернего процесса. Создается один раз на процесс,
+# чтобы не пересоздавать loop и его пул потоков на каждую задачу
+_process_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def _init_process(fragment_connections: int):
+    global _process_loop
+    _process_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_process_loop)
+    # Общий лимит соединений делится поровну между процессами пула
+    connection_budget.resize(fragment_connections)
+
+# Выполняет загрузку внутри дочернего процесса.
+# Наружу уходит только DownloadResult или DownloadError, объекты yt-dlp остаются в процессе
+def _run_download_job(
+    platform: str,
+    url: str,
+    command_type: str,
+    request_id: str,
+    quality: Optional[str] = None,
+    control: Optional[JobControl] = None,
+    session: Optional[DownloadSession] = None,
+    info: Optional[dict] = None
+) -> Optional[DownloadResult]:
+    with request_context(request_id):
+        downloader = select_downloader(platform)
+        if not downloader:
+            raise DownloadError(f"Unsupported platform: {platform}")
+
+        if command_type == "video":
+            coro = downloader.download_video(url, request_id=request_id, quality=quality, control=control, session=session, info=info)
+        elif command_type == "audio":
+            coro = downloader.download_audio(url, request_id=request_id, control=control, session=session, info=info)
+        else:
+            return None
+
+        try:
+            return _process_loop.run_until_complete(coro)
+        except (DownloadError, JobCancelledError):
+            raise
+        except Exception as e:
+            # Произвольные исключения могут не пережить pickle, поэтому оборачиваем в нашу ошибку
+            logger.error(f"Unexpected error in download process: {e}", exc_info=True)
+            raise DownloadError(f"Unexpected error in download process: {e}")
+
+# Выполняет функцию в дочернем процессе и возвращает вместе с результатом pid и RSS процесса,
+# чтобы основной процесс видел память каждого процесса пула
+def _run_measured(func, *args) -> Tuple[object, int, int]:
+    result = func(*args)
+    return result, os.getpid(), current_rss()
+
+# Получает информацию о медиа внутри дочернего процесса (для предзагрузки)
+def _run_extract_job(platform: str, url: str, session: Optional[DownloadSession] = None) -> dict:
+    downloader = select_downloader(platform)
+    if not downloader:
+        raise DownloadError(f"Unsupported platform: {platform}")
+    try:
+        return _process_loop.run_until_complete(downloader.extract_info(url, session))
+    except DownloadError:
+        raise
+    except Exception as e:
+        raise DownloadError(f"Unexpected error in extract process: {e}")
+
+# Пул процессов для CPU-нагруженной работы yt-dlp (парсинг, расшифровка подписей).
+# В основном процессе остается только I/O телеграма.
+# Бот работает неделями, а память процессов yt-dlp со временем растет, поэтому процессы
+# перезапускаются: каждый после recycle_jobs задач, и весь пул, если RSS какого-то процесса
+# вырос больше чем на recycle_rss_bytes. Перезапуск плавный: новые задачи идут в новый пул,
+# а старый доделывает начатые и только потом завершается
+class DownloadProcessPool:
+    def __init__(self, processes: int, recycle_jobs: int = POOL_RECYCLE_JOBS, recycle_rss_mb: int = POOL_RECYCLE_RSS_MB):
+        self.processes = processes
+        self.recycle_jobs = recycle_jobs
+        self.recycle_rss_bytes = recycle_rss_mb * 1024 * 1024
+        self.recycles = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._context = None
+        self._manager = None
+        # RSS процессов текущего пула: после первой задачи (точка отсчета) и последний
+        self._baseline_rss: Dict[int, int] = {}
+        self._last_rss: Dict[int, int] = {}
+
+    def start(self):
+        # spawn вместо fork: форкать процесс с работающим event loop и потоками небезопасно
+        self._context = multiprocessing.get_context('spawn')
+        # Manager нужен для флага отмены и прогресса, общих с дочерними процессами
+        self._manager = self._context.Manager()
+        self._executor = self._create_executor()
+        logger.info(f"Download process pool started with {self.processes} processes")
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=self._context,
+            initializer=_init_process,
+            initargs=(max(1, MAX_FRAGMENT_CONNECTIONS // self.processes),),
+            # Процесс сам завершается после стольких задач, пул запускает вместо него новый
+            max_tasks_per_child=self.recycle_jobs or None
+        )
+
+    # Заменяет пул новым. Старый пул доделывает уже начатые задачи и завершает свои процессы
+    def recycle(self, reason: str):
+        if not self._executor:
+            return
+        old_executor = self._executor
+        self._executor = self._create_executor()
+        self._baseline_rss.clear()
+        self._last_rss.clear()
+        self.recycles += 1
+        old_executor.shutdown(wait=False, cancel_futures=False)
+        logger.warning(f"Download process pool recycled: {reason}")
+
+    # Учитывает RSS процесса после задачи и перезапускает пул, если память процесса слишком выросла
+    def _record_rss(self, executor: ProcessPoolExecutor, pid: int, rss: int):
+        # Процесс уже замененного пула: он скоро завершится сам
+        if executor is not self._executor:
+            return
+        baseline = self._baseline_rss.setdefault(pid, rss)
+        self._last_rss[pid] = rss
+        growth = rss - baseline
+        logger.info(f"Pool process {pid} RSS {format_mb(rss)} ({'+' if growth >= 0 else ''}{format_mb(growth)})")
+        if self.recycle_rss_bytes and growth > self.recycle_rss_bytes:
+            self.recycle(f"process {pid} grew by {format_mb(growth)}")
+
+    # Память процессов пула для отчета администратору
+    def memory_stats(self) -> Dict[str, object]:
+        return {
+            'processes': {pid: (rss, rss - self._baseline_rss.get(pid, rss)) for pid, rss in self._last_rss.items()},
+            'recycles': self.recycles,
+        }
+
+    # Создает управление задачей, которое можно передать в дочерний процесс
+    def create_control(self) -> JobControl:
+        return JobControl(self._manager.Event(), self._manager.dict())
+
+    # Запускает произвольную picklable функцию в пуле
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        result, pid, rss = await loop.run_in_executor(executor, _run_measured, func, *args)
+        self._record_rss(executor, pid, rss)
+        return result
+
+    async def download(
+        self,
+        platform: str,
+        url: str,
+        command_type: str,
+        request_id: str,
+        quality: Optional[str] = None,
+        control: Optional[JobControl] = None,
+        session: Optional[DownloadSession] = None,
+        info: Optional[dict] = None
+    ) -> Optional[DownloadResult]:
+        return await self.run(_run_download_job, platform, url, command_type, request_id, quality, control, session, info)
+
+    async def extract_info(self, platform: str, url: str, session: Optional[DownloadSession] = None) -> dict:
+        return await self.run(_run_extract_job, platform, url, session)
+
+    def shutdown(self, wait: bool = True):
+        if self._executor:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+            logger.info("Download process pool stopped")
+        if self._manager:
+            self._manager.shutdown()
+            self._manager = None
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from typing import Dict, Optional, Set, Tuple
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
+from utils.logger import logger
+from utils.constants import (
+    STATUS_QUEUED_MESSAGE,
+    STATUS_EXTRACT_MESSAGE,
+    STATUS_DOWNLOAD_MESSAGE,
+    STATUS_POSTPROCESS_MESSAGE,
+    STATUS_UPLOAD_MESSAGE
+)
+
+# Текст статуса задачи по состоянию прогресса из JobControl
+def render_status(progress: dict, position: Optional[int] = None) -> str:
+    stage = progress.get('stage')
+    if stage == 'extract':
+        return STATUS_EXTRACT_MESSAGE
+    if stage == 'download':
+        downloaded = progress.get('downloaded')
+        total = progress.get('total')
+        if downloaded and total:
+            details = f"{min(downloaded / total, 1.0) * 100:.0f}% ({downloaded / (1024 * 1024):.1f} / {total / (1024 * 1024):.1f} MB)"
+        elif downloaded:
+            details = f"{downloaded / (1024 * 1024):.1f} MB"
+        else:
+            details = "..."
+        return STATUS_DOWNLOAD_MESSAGE.format(details)
+    if stage == 'postprocess':
+        return STATUS_POSTPROCESS_MESSAGE
+    if stage == 'upload':
+        return STATUS_UPLOAD_MESSAGE
+    return STATUS_QUEUED_MESSAGE.format(position or 1)
+
+# Правки статусных сообщений с ограничением частоты.
+# Обновления копятся (для каждого сообщения хранится только последний текст),
+# а в каждый чат уходит не больше одной правки за min_interval секунд
+class StatusReporter:
+    def __init__(self, bot: Bot, min_interval: float):
+        self.bot = bot
+        self.min_interval = min_interval
+        # chat_id -> {message_id: (text, reply_markup)}
+        self._pending: Dict[int, Dict[int, Tuple[str, Optional[InlineKeyboardMarkup]]]] = {}
+        self._last_text: Dict[Tuple[int, int], str] = {}
+        self._next_edit_at: Dict[int, float] = {}
+        self._flush_tasks: Dict[int, asyncio.Task] = {}
+        # Сообщения с окончательным текстом (например, "задача отменена"), их правки больше не принимаются
+        self._final: Set[Tuple[int, int]] = set()
+
+    # Ставит правку сообщения в очередь. Одинаковый текст повторно не отправляется
+    def update(self, chat_id: int, message_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        if (chat_id, message_id) in self._final:
+            return
+        if self._last_text.get((chat_id, message_id)) == text:
+            self._pending.get(chat_id, {}).pop(message_id, None)
+            return
+        self._pending.setdefault(chat_id, {})[message_id] = (text, reply_markup)
+        if chat_id not in self._flush_tasks:
+            self._flush_tasks[chat_id] = asyncio.create_task(self._flush_chat(chat_id))
+
+    # Отправляет накопленные правки чата. После последней правки задача дожидается конца интервала:
+    # пришедшие за это время правки отправляет она же, а если их нет, время следующей правки
+    # чату больше не нужно и удаляется (иначе словарь рос бы на каждый чат, где был статус)
+    async def _flush_chat(self, chat_id: int):
+        try:
+            while True:
+                if not self._pending.get(chat_id):
+                    delay = self._next_edit_at.get(chat_id, 0) - time.monotonic()
+                    if delay <= 0:
+                        self._next_edit_at.pop(chat_id, None)
+                        break
+                    await asyncio.sleep(delay)
+                    continue
+
+                delay = self._next_edit_at.get(chat_id, 0) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                pending = self._pending.get(chat_id)
+                if not pending:
+                    continue
+                message_id = next(iter(pending))
+                text, reply_markup = pending.pop(message_id)
+                self._next_edit_at[chat_id] = time.monotonic() + self.min_interval
+
+                try:
+                    await self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+                    self._last_text[(chat_id, message_id)] = text
+                except RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                    logger.warning(f"Status edits in chat {chat_id} throttled for {retry_after}s")
+                    self._next_edit_at[chat_id] = time.monotonic() + retry_after
+                    # Возвращаем правку, если за это время не пришла более свежая
+                    pending.setdefault(message_id, (text, reply_markup))
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        logger.debug(f"Failed to edit status message {message_id} in chat {chat_id}: {e}")
+                except Exception as e:
+                    logger.warning(f"Failed to edit status message {message_id} in chat {chat_id}: {e}")
+        finally:
+            self._flush_tasks.pop(chat_id, None)
+            if not self._pending.get(chat_id):
+                self._pending.pop(chat_id, None)
+
+    # Дожидается отправки накопленных правок (например, перед остановкой бота)
+    async def flush(self, timeout: float):
+        tasks = list(self._flush_tasks.values())
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    # Окончательный текст сообщения ставит вызывающий: накопленные правки отбрасываются,
+    # а новые (от опоздавшего прогресса) игнорируются до close
+    def finalize(self, chat_id: int, message_id: int):
+        self._final.add((chat_id, message_id))
+        self._pending.get(chat_id, {}).pop(message_id, None)
+
+    # Прекращает обновления сообщения и по желанию удаляет его
+    async def close(self, chat_id: int, message_id: int, delete: bool = True):
+        self._pending.get(chat_id, {}).pop(message_id, None)
+        self._last_text.pop((chat_id, message_id), None)
+        self._final.discard((chat_id, message_id))
+        if delete:
+            try:
+                await self.bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except Exception as e:
+                logger.debug(f"Failed to delete status message {message_id} in chat {chat_id}: {e}")
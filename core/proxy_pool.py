@@ -0,0 +1,179 @@
+import re
+import time
+from typing import Dict, List, NamedTuple, Optional
+from utils.downloader_base import DownloadSession
+from utils.logger import logger
+
+# Признаки того, что платформа ограничивает адрес (после них адрес сразу уходит в карантин).
+# 403 сюда не входит: это чаще закрытое или удаленное видео, чем блокировка адреса
+THROTTLE_PATTERN = re.compile(
+    r'HTTP Error 429|Too Many Requests|rate[- ]limit(?:ed|ing)?\b'
+    r'|Sign in to confirm you.re not a bot|Please wait a few minutes',
+    re.IGNORECASE
+)
+# Признаки сетевой ошибки самого прокси или адреса
+NETWORK_PATTERN = re.compile(
+    r'Unable to connect to proxy|Tunnel connection failed|ProxyError|SOCKS\w* ?(?:error|proxy)'
+    r'|timed out|Connection (?:reset|refused|aborted)|Network is unreachable|No route to host'
+    r'|Remote end closed connection',
+    re.IGNORECASE
+)
+# Столько сетевых ошибок подряд отправляют адрес в карантин
+MAX_CONSECUTIVE_FAILURES = 3
+# Задержка (секунд на мегабайт загрузки), при которой оценка адреса падает вдвое
+LATENCY_REFERENCE = 10.0
+# Доля успешных запросов, с которой адрес возвращается из карантина
+PROBATION_SUCCESS_RATE = 0.5
+
+# Исход запроса через адрес пула
+OUTCOME_OK = 'ok'
+OUTCOME_THROTTLED = 'throttled'
+OUTCOME_FAILED = 'failed'
+
+# Определяет по тексту ошибки загрузки, виноват ли в ней адрес.
+# None - ошибка не связана с сетью (файл слишком большой, нужен логин и т.п.)
+def classify_error(message: str) -> Optional[str]:
+    if THROTTLE_PATTERN.search(message):
+        return OUTCOME_THROTTLED
+    if NETWORK_PATTERN.search(message):
+        return OUTCOME_FAILED
+    return None
+
+# Исходящий адрес: прокси (http://, socks5://), локальный адрес источника (source:IP) или прямое соединение (direct)
+class ProxyEntry:
+    def __init__(self, spec: str):
+        self.spec = spec
+        self.proxy: Optional[str] = None
+        self.source_address: Optional[str] = None
+        if spec.startswith('source:'):
+            self.source_address = spec[len('source:'):]
+        elif spec != 'direct':
+            self.proxy = spec
+        # Сглаженные доля успешных запросов и задержка (секунд на мегабайт, вместе с извлечением)
+        self.success_rate = 1.0
+        self.latency: Optional[float] = None
+        self.inflight = 0
+        self.consecutive_failures = 0
+        # Сколько раз подряд адрес попадал в карантин (от этого растет срок карантина)
+        self.strikes = 0
+        self.quarantined_until = 0.0
+
+    def quarantined(self, now: float) -> bool:
+        return self.quarantined_until > now
+
+    # Ожидаемое качество адреса для новой задачи
+    def score(self) -> float:
+        latency_factor = 1 + (self.latency or 0) / LATENCY_REFERENCE
+        return self.success_rate / latency_factor / (self.inflight + 1)
+
+    def session(self, base: Optional[DownloadSession] = None) -> DownloadSession:
+        return (base or DownloadSession())._replace(proxy=self.proxy, source_address=self.source_address)
+
+    def __repr__(self) -> str:
+        return self.spec
+
+# Назначенный задаче адрес
+class ProxyLease(NamedTuple):
+    platform: str
+    entry: ProxyEntry
+
+# Пул исходящих адресов по платформам.
+# Каждой задаче выдается здоровый адрес с лучшей оценкой (успешность, задержка, текущая нагрузка).
+# Адрес, который платформа начала ограничивать (429, "подтвердите, что вы не бот") или который
+# несколько раз подряд не смог соединиться, уходит в карантин. Срок карантина удваивается при
+# каждом повторном попадании. После карантина адрес снова получает задачи, а первая успешная
+# загрузка сбрасывает счетчик
+class ProxyPool:
+    def __init__(self, entries: Dict[str, List[str]], quarantine_base: float = 60, quarantine_max: float = 1800, alpha: float = 0.2):
+        self.quarantine_base = quarantine_base
+        self.quarantine_max = quarantine_max
+        self.alpha = alpha
+        self._entries: Dict[str, List[ProxyEntry]] = {
+            platform: [ProxyEntry(spec) for spec in specs] for platform, specs in entries.items()
+        }
+
+    # Разбирает конфигурацию вида "YouTube=http://a:8080,socks5://b:1080;Instagram=source:10.0.0.2,direct;*=direct".
+    # Платформа * задает адреса для платформ без своего списка
+    @staticmethod
+    def parse(config: str) -> Dict[str, List[str]]:
+        entries = {}
+        for group in config.split(';'):
+            if '=' not in group:
+                continue
+            platform, specs = group.split('=', 1)
+            specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+            if platform.strip() and specs:
+                entries[platform.strip()] = specs
+        return entries
+
+    def __bool__(self) -> bool:
+        return bool(self._entries)
+
+    def _platform_entries(self, platform: str) -> List[ProxyEntry]:
+        return self._entries.get(platform) or self._entries.get('*') or []
+
+    # Выдает адрес для задачи. Если все адреса в карантине, берется тот, чей карантин кончится раньше:
+    # задача лучше подождет троттлинга, чем не выполнится совсем
+    def acquire(self, platform: str, exclude: Optional[ProxyEntry] = None) -> Optional[ProxyLease]:
+        entries = [entry for entry in self._platform_entries(platform) if entry is not exclude]
+        if not entries:
+            return None
+        now = time.monotonic()
+        healthy = [entry for entry in entries if not entry.quarantined(now)]
+        if healthy:
+            entry = max(healthy, key=lambda item: item.score())
+        else:
+            entry = min(entries, key=lambda item: item.quarantined_until)
+        return self.lease(platform, entry)
+
+    # Назначает задаче конкретный адрес (например, тот, через который уже получена информация о ссылке)
+    def lease(self, platform: str, entry: ProxyEntry) -> ProxyLease:
+        entry.inflight += 1
+        return ProxyLease(platform, entry)
+
+    # Учитывает исход запроса через адрес. outcome None - задача завершилась не из-за сети
+    def release(self, lease: Optional[ProxyLease], outcome: Optional[str], seconds: Optional[float] = None):
+        if not lease:
+            return
+        entry = lease.entry
+        entry.inflight = max(0, entry.inflight - 1)
+        if outcome is None:
+            return
+
+        success = 1.0 if outcome == OUTCOME_OK else 0.0
+        entry.success_rate = self.alpha * success + (1 - self.alpha) * entry.success_rate
+        if outcome == OUTCOME_OK:
+            if seconds is not None:
+                entry.latency = seconds if entry.latency is None else self.alpha * seconds + (1 - self.alpha) * entry.latency
+            entry.consecutive_failures = 0
+            entry.strikes = 0
+            return
+
+        entry.consecutive_failures += 1
+        if outcome == OUTCOME_THROTTLED or entry.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            self._quarantine(lease.platform, entry, outcome)
+
+    def _quarantine(self, platform: str, entry: ProxyEntry, reason: str):
+        duration = min(self.quarantine_base * (2 ** entry.strikes), self.quarantine_max)
+        entry.strikes += 1
+        entry.consecutive_failures = 0
+        entry.quarantined_until = time.monotonic() + duration
+        # После карантина адрес начинает с пониженной оценкой и набирает ее успешными загрузками
+        entry.success_rate = min(entry.success_rate, PROBATION_SUCCESS_RATE)
+        logger.warning(f"{platform} address {entry} quarantined for {duration:.0f}s ({reason}, strike {entry.strikes})")
+
+    def stats(self) -> Dict[str, List[Dict[str, object]]]:
+        now = time.monotonic()
+        return {
+            platform: [
+                {
+                    'address': entry.spec,
+                    'success_rate': round(entry.success_rate, 2),
+                    'latency': round(entry.latency, 1) if entry.latency is not None else None,
+                    'inflight': entry.inflight,
+                    'quarantined_for': max(0, round(entry.quarantined_until - now)),
+                }
+                for entry in entries
+            ]
+            for platform, entries in self._entries.items()
+        }
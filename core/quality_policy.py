@@ -0,0 +1,49 @@
+from typing import List, Optional, Tuple
+from utils.logger import logger
+from utils.format_selector import QUALITY_TIERS, DEFAULT_TIER, lower_tier
+from core.metrics import RateMeter
+
+# Разбирает пороги вида "3:720p,6:480p" в список (глубина очереди, уровень качества)
+def parse_queue_thresholds(value: str) -> List[Tuple[int, str]]:
+    thresholds = []
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        depth, tier = item.split(':', 1)
+        tier = tier.strip()
+        if tier not in QUALITY_TIERS:
+            logger.warning(f"Unknown quality tier in thresholds: {tier}")
+            continue
+        thresholds.append((int(depth), tier))
+    return sorted(thresholds)
+
+# Политика качества под нагрузкой.
+# Чем глубже очередь и ниже недавняя скорость загрузок, тем ниже потолок качества.
+# Уровень выбранный пользователем может только понизить итоговое качество
+class QualityPolicy:
+    def __init__(self, queue_thresholds: List[Tuple[int, str]], min_throughput_bps: float = 0):
+        self.queue_thresholds = queue_thresholds
+        self.min_throughput_bps = min_throughput_bps
+        self.throughput = RateMeter()
+
+    # Сообщает политике о завершенной загрузке
+    def record_download(self, size_bytes: int, seconds: float):
+        self.throughput.record(size_bytes, seconds)
+
+    # Потолок качества при текущей нагрузке
+    def current_cap(self, queue_depth: int) -> str:
+        cap = DEFAULT_TIER
+        for depth, tier in self.queue_thresholds:
+            if queue_depth >= depth:
+                cap = tier
+
+        # Если загрузки идут медленно, опускаемся еще на один уровень
+        rate = self.throughput.rate
+        if self.min_throughput_bps and rate is not None and rate < self.min_throughput_bps:
+            order = list(QUALITY_TIERS)
+            cap = order[min(order.index(cap) + 1, len(order) - 1)]
+        return cap
+
+    # Итоговый уровень качества для задачи
+    def resolve(self, user_tier: Optional[str], queue_depth: int) -> str:
+        return lower_tier(user_tier, self.current_cap(queue_depth))
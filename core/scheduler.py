@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, List, Optional, Tuple
+from core.admission import DEFAULT_BASE_COST
+
+# Полосы очереди по оценке стоимости задачи (секунды работы воркера): короткие задачи
+# (рилсы, твиты) обгоняют длинные (часовые видео, подкасты в аудио)
+LANES = (
+    ('short', 30.0),
+    ('medium', 180.0),
+    ('long', float('inf')),
+)
+
+def lane_for(cost: float) -> str:
+    return next(name for name, limit in LANES if cost <= limit)
+
+# Очередь загрузок с приоритетом коротких задач (shortest job first) и старением.
+# Ключ задачи - время постановки плюс задержка, пропорциональная её стоимости, но не больше max_delay:
+# короткая задача обгоняет длинную, поставленную незадолго до неё, а длинная задача ждет
+# сверх обычной очереди не больше max_delay секунд и не голодает.
+# Задачи лежат в куче, put и get - O(log n). Уточнение оценки и отмена не ищут задачу в куче:
+# актуальная запись задачи хранится в _entries, а устаревшие записи кучи пропускаются при выдаче.
+# Места в очереди нужны только статусным сообщениям, поэтому они считаются по отсортированному
+# снимку, который обновляется не чаще раза в positions_interval секунд.
+# Интерфейс asyncio.Queue (put_nowait, get, task_done, qsize, maxsize) сохранен
+class JobQueue(asyncio.Queue):
+    def __init__(self, maxsize: int = 0, aging_factor: float = 1.0, max_delay: float = 600.0, positions_interval: float = 3.0):
+        self.aging_factor = aging_factor
+        self.max_delay = max_delay
+        self.positions_interval = positions_interval
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        # Куча (ключ, порядковый номер, request_id), в том числе устаревшие записи
+        self._queue: List[Tuple[float, int, str]] = []
+        # request_id -> (ключ, порядковый номер, задача): актуальная запись задачи
+        self._entries: Dict[str, Tuple[float, int, dict]] = {}
+        self._counter = itertools.count()
+        self._positions: Dict[str, int] = {}
+        self._positions_at = float('-inf')
+
+    def _key(self, job: dict) -> float:
+        enqueued_at = job.get('enqueued_at_ns') or time.time_ns()
+        cost = job.get('cost') or DEFAULT_BASE_COST
+        return enqueued_at / 1e9 + min(cost * self.aging_factor, self.max_delay)
+
+    def _discard(self, request_id: str) -> Optional[dict]:
+        entry = self._entries.pop(request_id, None)
+        if entry is None:
+            return None
+        # Запись в куче остается и будет пропущена. Если устаревших записей стало больше живых,
+        # куча пересобирается, чтобы не расти от частых уточнений и отмен
+        if len(self._queue) > 2 * len(self._entries) + 16:
+            self._queue = [(key, seq, rid) for rid, (key, seq, _) in self._entries.items()]
+            heapq.heapify(self._queue)
+        return entry[2]
+
+    def _push(self, job: dict):
+        self._discard(job['request_id'])
+        key, seq = self._key(job), next(self._counter)
+        self._entries[job['request_id']] = (key, seq, job)
+        heapq.heappush(self._queue, (key, seq, job['request_id']))
+
+    def _put(self, job: dict):
+        self._push(job)
+
+    def _get(self) -> dict:
+        while True:
+            key, seq, request_id = heapq.heappop(self._queue)
+            entry = self._entries.get(request_id)
+            if entry and entry[1] == seq:
+                del self._entries[request_id]
+                return entry[2]
+
+    def qsize(self) -> int:
+        return len(self._entries)
+
+    def empty(self) -> bool:
+        return not self._entries
+
+    # Уточняет стоимость задачи, которая еще ждет в очереди. Возвращает False, если её уже взяли
+    def update_cost(self, request_id: str, cost: float) -> bool:
+        entry = self._entries.get(request_id)
+        if not entry:
+            return False
+        job = entry[2]
+        job['cost'] = cost
+        self._push(job)
+        return True
+
+    # Убирает ждущую задачу из очереди (например, отмененную). Возвращает задачу или None, если её уже взяли
+    def remove(self, request_id: str) -> Optional[dict]:
+        job = self._discard(request_id)
+        if job is None:
+            return None
+        # Задача не будет обработана воркером: закрываем её для join и освобождаем место ждущим put
+        self.task_done()
+        self._wakeup_next(self._putters)
+        return job
+
+    # Места задач в очереди (с 1) в порядке выдачи - для статусных сообщений.
+    # Снимок может отставать от очереди на positions_interval секунд
+    def positions(self, refresh: bool = False) -> Dict[str, int]:
+        now = time.monotonic()
+        if refresh or now - self._positions_at >= self.positions_interval:
+            order = sorted((key, seq, request_id) for request_id, (key, seq, _) in self._entries.items())
+            self._positions = {request_id: position for position, (_, _, request_id) in enumerate(order, start=1)}
+            self._positions_at = now
+        return self._positions
+
+    # Место задачи в очереди. Задачи, которой еще нет в снимке (только что поставленной), снимок обновляется
+    def position(self, request_id: str) -> Optional[int]:
+        if request_id not in self._entries:
+            return None
+        position = self.positions().get(request_id)
+        if position is None:
+            position = self.positions(refresh=True).get(request_id)
+        return position
+
+    # Забирает все ждущие задачи в порядке выдачи (например, чтобы передать их при остановке)
+    def take_all(self) -> List[dict]:
+        jobs = []
+        while not self.empty():
+            jobs.append(self.get_nowait())
+            self.task_done()
+        return jobs
+
+    # Число ждущих задач в каждой полосе
+    def lane_sizes(self) -> Dict[str, int]:
+        sizes = {name: 0 for name, _ in LANES}
+        for _, _, job in self._entries.values():
+            sizes[lane_for(job.get('cost') or DEFAULT_BASE_COST)] += 1
+        return sizes
@@ -0,0 +1,243 @@
+import asyncio
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+from telegram import Bot, Message
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from config import UPLOAD_TIMEOUT
+from core.metrics import RateMeter
+from utils.downloader_base import DownloadResult
+from utils.logger import logger
+from utils.tracing import span
+
+# Сколько параллельных загрузок держит один помощник
+HELPER_CONNECTIONS = 8
+# Во сколько раз падает оценка скорости помощника после 429
+THROTTLE_PENALTY = 0.5
+# Пауза для помощника после ошибки, не связанной с лимитами (секунды)
+ERROR_COOLDOWN = 30
+# Предполагаемая скорость помощника без замеров (байт в секунду). Она выше типичной,
+# чтобы новый помощник попробовали, но делится на его загрузки, как и измеренная
+PRIOR_THROUGHPUT = 10 * 1024 * 1024
+# Сколько раз повторять пересылку после ошибки, не связанной с лимитами
+FORWARD_ATTEMPTS = 3
+# Телеграм пропускает в одну группу или канал около 20 сообщений в минуту
+CHANNEL_MESSAGES_PER_MINUTE = 20
+
+# Помощник загрузил файл, но основной бот не смог его переслать.
+# Повторно загружать файл нельзя: он уже загружен, а 429 от повторов только вырастет
+class UploadForwardError(Exception):
+    pass
+
+# Читает файл и превью для отправки. Клиент телеграма все равно читает файл в память целиком
+# (синхронно, прямо в event loop), поэтому читаем сами и в потоке, а отдаем уже байты
+def read_media_files(result: DownloadResult) -> Tuple[bytes, Optional[bytes]]:
+    media = Path(result.filepath).read_bytes()
+    thumbnail = Path(result.thumbnail).read_bytes() if result.thumbnail else None
+    return media, thumbnail
+
+# Бот-помощник: свой токен, а значит свои лимиты телеграма и своя полоса на загрузку
+class UploadShard:
+    def __init__(self, bot: Bot, name: str):
+        self.bot = bot
+        self.name = name
+        # Недавняя скорость загрузки в байтах в секунду
+        self.throughput = RateMeter(alpha=0.3)
+        self.inflight = 0
+        self.cooldown_until = 0.0
+        self.uploads = 0
+        self.throttled = 0
+
+    def available(self, now: float) -> bool:
+        return self.cooldown_until <= now
+
+    # Ожидаемая скорость для новой загрузки: скорость помощника делится между его текущими загрузками.
+    # У помощника без замеров берется PRIOR_THROUGHPUT, поэтому альбом расходится по всем помощникам,
+    # а не ложится целиком на первого еще не измеренного
+    def score(self) -> float:
+        rate = self.throughput.rate if self.throughput.rate is not None else PRIOR_THROUGHPUT
+        return rate / (self.inflight + 1)
+
+    def penalize(self, seconds: float):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+        if self.throughput.rate is not None:
+            self.throughput.rate *= THROTTLE_PENALTY
+
+# Загрузка файлов через ботов-помощников.
+# Лимиты и полоса загрузки телеграма считаются на токен, поэтому тяжелые файлы загружают
+# помощники в приватный канал-хранилище, выбирая помощника по недавней скорости и 429.
+# file_id у каждого бота свой, поэтому основной бот пересылает сообщение помощника внутри канала
+# (без загрузки, на стороне телеграма) и отправляет пользователю файл уже по своему file_id.
+# Основной бот и все помощники должны быть администраторами каналов.
+# Каждая загрузка - два сообщения в канале (файл и пересылка), а в канал телеграм пропускает
+# около 20 сообщений в минуту, то есть один канал - около 10 загрузок в минуту. Несколько каналов
+# поднимают этот предел: загрузка идет в канал, где за последнюю минуту было меньше сообщений
+class UploadPool:
+    def __init__(self, tokens: List[str], storage_chat_ids: List[int], min_bytes: int = 0):
+        self.storage_chat_ids = storage_chat_ids
+        self.min_bytes = min_bytes
+        # Время недавних сообщений в каждом канале
+        self._channel_messages: Dict[int, Deque[float]] = {chat_id: deque() for chat_id in storage_chat_ids}
+        self.shards = [
+            UploadShard(Bot(token, request=HTTPXRequest(
+                connection_pool_size=HELPER_CONNECTIONS,
+                read_timeout=UPLOAD_TIMEOUT,
+                write_timeout=UPLOAD_TIMEOUT
+            )), f"helper{index}")
+            for index, token in enumerate(tokens, start=1)
+        ]
+
+    # Проверяет токены помощников. Помощник с нерабочим токеном просто не используется
+    async def start(self):
+        for shard in list(self.shards):
+            try:
+                await shard.bot.initialize()
+                shard.name = shard.bot.username
+            except Exception as e:
+                logger.error(f"Helper bot {shard.name} is unavailable, skipping it: {e}")
+                self.shards.remove(shard)
+        logger.info(f"Upload pool started with {len(self.shards)} helper bot(s): {', '.join(shard.name for shard in self.shards)}")
+
+    async def stop(self):
+        for shard in self.shards:
+            try:
+                await shard.bot.shutdown()
+            except Exception as e:
+                logger.warning(f"Failed to shut down helper bot {shard.name}: {e}")
+
+    # Маленькие файлы быстрее отправить напрямую, чем загружать и пересылать
+    def should_shard(self, filepath: str) -> bool:
+        try:
+            return os.path.getsize(filepath) >= self.min_bytes
+        except OSError:
+            return False
+
+    # Свободный помощник с лучшей ожидаемой скоростью
+    def _choose(self, exclude: List[UploadShard]) -> Optional[UploadShard]:
+        now = time.monotonic()
+        candidates = [shard for shard in self.shards if shard.available(now) and shard not in exclude]
+        return max(candidates, key=lambda shard: shard.score(), default=None)
+
+    # Канал с наименьшим числом сообщений за последнюю минуту
+    def _choose_channel(self) -> int:
+        now = time.monotonic()
+        for messages in self._channel_messages.values():
+            while messages and now - messages[0] > 60:
+                messages.popleft()
+        chat_id = min(self.storage_chat_ids, key=lambda chat_id: len(self._channel_messages[chat_id]))
+        if len(self._channel_messages[chat_id]) >= CHANNEL_MESSAGES_PER_MINUTE:
+            logger.warning("Storage channels are near the per-chat message limit, add more channels to STORAGE_CHAT_ID")
+        return chat_id
+
+    def _count_message(self, chat_id: int):
+        self._channel_messages[chat_id].append(time.monotonic())
+
+    # Загружает файл через помощника и возвращает file_id основного бота.
+    # None - загрузить не удалось (все помощники заняты лимитами или упали), файл надо отправить напрямую.
+    # Если файл уже загружен помощником, повторной загрузки не будет: при неудачной пересылке - UploadForwardError
+    async def upload(self, main_bot: Bot, command_type: str, platform: str, result: DownloadResult) -> Optional[str]:
+        tried: List[UploadShard] = []
+        while True:
+            shard = self._choose(tried)
+            if not shard:
+                return None
+            tried.append(shard)
+            chat_id = self._choose_channel()
+            stored = await self._upload_with(shard, chat_id, command_type, platform, result)
+            if not stored:
+                continue
+            forwarded = await self._forward(main_bot, chat_id, stored.message_id)
+            media = forwarded.video or forwarded.audio
+            if not media:
+                raise UploadForwardError(f"Forwarded upload {stored.message_id} has no media")
+            return media.file_id
+
+    # Пересылка внутри канала: так у основного бота появляется свой file_id.
+    # После 429 ждем, сколько сказал телеграм, и повторяем
+    async def _forward(self, main_bot: Bot, chat_id: int, message_id: int) -> Message:
+        deadline = time.monotonic() + UPLOAD_TIMEOUT
+        attempts = 0
+        while True:
+            try:
+                self._count_message(chat_id)
+                return await main_bot.forward_message(
+                    chat_id=chat_id,
+                    from_chat_id=chat_id,
+                    message_id=message_id,
+                    disable_notification=True
+                )
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                if time.monotonic() + retry_after > deadline:
+                    raise UploadForwardError(f"Forward of stored upload {message_id} throttled for {retry_after}s") from e
+                logger.warning(f"Forward in storage channel {chat_id} throttled for {retry_after}s, waiting")
+                await asyncio.sleep(retry_after)
+            except Exception as e:
+                attempts += 1
+                if attempts >= FORWARD_ATTEMPTS:
+                    raise UploadForwardError(f"Failed to forward stored upload {message_id}: {e}") from e
+                logger.warning(f"Failed to forward stored upload {message_id}, retrying: {e}")
+                await asyncio.sleep(attempts)
+
+    async def _upload_with(self, shard: UploadShard, chat_id: int, command_type: str, platform: str, result: DownloadResult) -> Optional[Message]:
+        shard.inflight += 1
+        started_at = time.monotonic()
+        try:
+            media_file, thumbnail = await asyncio.get_running_loop().run_in_executor(None, read_media_files, result)
+            size = len(media_file)
+            filename = os.path.basename(result.filepath)
+            self._count_message(chat_id)
+            with span('upload.shard', bot=shard.name, bytes=size):
+                if command_type == "video":
+                    message = await shard.bot.send_video(
+                        chat_id=chat_id,
+                        video=media_file,
+                        filename=filename,
+                        width=result.width,
+                        height=result.height,
+                        duration=result.duration,
+                        thumbnail=thumbnail,
+                        supports_streaming=True,
+                        disable_notification=True
+                    )
+                else:
+                    message = await shard.bot.send_audio(
+                        chat_id=chat_id,
+                        audio=media_file,
+                        filename=filename,
+                        title=result.title,
+                        performer=f"from {platform}",
+                        duration=result.duration,
+                        thumbnail=thumbnail,
+                        disable_notification=True
+                    )
+            seconds = time.monotonic() - started_at
+            shard.throughput.record(size, seconds)
+            shard.uploads += 1
+            logger.info(f"Helper {shard.name} uploaded {size / (1024 * 1024):.1f}MB in {seconds:.1f}s")
+            return message
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            shard.throttled += 1
+            shard.penalize(retry_after)
+            logger.warning(f"Helper {shard.name} throttled for {retry_after}s")
+        except Exception as e:
+            shard.penalize(ERROR_COOLDOWN)
+            logger.warning(f"Helper {shard.name} failed to upload {result.filepath}: {e}")
+        finally:
+            shard.inflight -= 1
+        return None
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            shard.name: {
+                'uploads': shard.uploads,
+                'throttled': shard.throttled,
+                'inflight': shard.inflight,
+                'throughput_kbps': (shard.throughput.rate or 0) / 1024,
+            }
+            for shard in self.shards
+        }
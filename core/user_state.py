@@ -0,0 +1,81 @@
+import sys
+import time
+from typing import Any, Dict, Iterator
+
+_MISSING = object()
+
+# Компактное состояние пользователя вместо dict по умолчанию в PTB.
+# Фиксированный набор полей в __slots__, но интерфейс как у dict,
+# поэтому обработчики продолжают работать с context.user_data как раньше
+class UserState:
+    __slots__ = ('action_type', 'quality', 'pending_link', 'last_seen', 'loaded')
+
+    # Поля, которые сохраняются в хранилище
+    FIELDS = ('action_type', 'quality', 'pending_link')
+
+    def __init__(self):
+        self.action_type = None
+        self.quality = None
+        # Ссылка, присланная до выбора видео/аудио
+        self.pending_link = None
+        self.last_seen = time.time()
+        # Загружено ли состояние из хранилища (после выгрузки из памяти грузится лениво)
+        self.loaded = False
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key not in self.FIELDS:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        if key not in self.FIELDS:
+            raise KeyError(f"Unknown user state field: {key}")
+        setattr(self, key, value)
+
+    def __delitem__(self, key: str):
+        self[key] = None
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.to_dict())
+
+    def __len__(self) -> int:
+        return len(self.to_dict())
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        value = self.get(key, default)
+        if key in self.FIELDS:
+            setattr(self, key, None)
+        return value
+
+    def clear(self):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def touch(self):
+        self.last_seen = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+
+    def update_from(self, data: Dict[str, Any]):
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field))
+
+    # Приблизительный размер записи в памяти (без общих строк-констант)
+    def approx_size(self) -> int:
+        size = sys.getsizeof(self)
+        for field in self.__slots__:
+            value = getattr(self, field)
+            if isinstance(value, str):
+                size += sys.getsizeof(value)
+        return size
@@ -1,30 +1,64 @@
 import asyncio
+import math
 import os
-from typing import Tuple, Optional, Union
+import time
+from contextlib import aclosing
+from pathlib import Path
+from typing import List, Optional, Tuple
+from telegram import InputMediaAudio, InputMediaVideo, Message
 from telegram.ext import Application
 from utils.logger import logger, request_context
-from utils.get_video_info import get_video_info
-from utils.downloader_base import DownloadError
-from utils.downloader_youtube import YouTubeDownloader
-from utils.downloader_twitter import TwitterDownloader
-from utils.downloader_instagram import InstagramDownloader
+from utils.tracing import span, record_span
+from utils.memory import current_rss, format_mb
+from ui.keyboards import get_job_cancel_markup
+from config import EXTRACT_TIMEOUT, DOWNLOAD_TIMEOUT, POSTPROCESS_TIMEOUT, UPLOAD_TIMEOUT, BATCH_MAX_ITEMS
+from utils.downloader_base import BaseDownloader, DownloadError, DownloadResult, DownloadSession
+from utils.job_control import JobControl, JobCancelledError
+from core.downloaders import select_downloader
+from core.jobs import JobHandle, JobRegistry
+from core.progress import StatusReporter, render_status
+from core.process_pool import DownloadProcessPool
+from core.quality_policy import QualityPolicy
+from core.file_id_cache import FileIdCache, CachedMedia, make_cache_key
+from core.prefetch import InfoPrefetcher
+from core.media_cache import MediaCache
+from core.admission import AdmissionController
+from core.scheduler import JobQueue, lane_for
+from core.upload_pool import UploadPool, read_media_files
+from core.local_media import LocalVideo, LocalVideos
+from core.proxy_pool import OUTCOME_OK, OUTCOME_THROTTLED, ProxyPool, classify_error
+from utils.audio_track import extract_audio_track, split_audio
 from utils.constants import (
     UNAVAILABLE_REELS,
     NOT_IMPLEMENTED_MESSAGE,
     DOWNLOAD_ERROR_MESSAGE,
     TECHNICAL_ERROR_MESSAGE,
-    FILE_TOO_LARGE_MESSAGE
+    FILE_TOO_LARGE_MESSAGE,
+    JOB_TIMEOUT_MESSAGE,
+    BATCH_PARTIAL_MESSAGE,
+    BATCH_STATUS_PREFIX,
+    AUDIO_PARTS_MESSAGE
 )
 
-# Инициализация downloader'ов
-youtube_downloader = YouTubeDownloader()
-twitter_downloader = TwitterDownloader()
-instagram_downloader = InstagramDownloader()
+# Запасной общий таймаут задачи на случай, если завис сам дочерний процесс пула
+# (внутри загрузки стадии ограничиваются своими таймаутами)
+JOB_TIMEOUT = EXTRACT_TIMEOUT + DOWNLOAD_TIMEOUT + POSTPROCESS_TIMEOUT + 30
+
+# Максимум файлов в одном альбоме телеграма
+MEDIA_GROUP_SIZE = 10
 
 # Воркер для обработки очереди
 # Обрабатывает задачи из очереди бота
-async def download_worker(application: Application, queue: asyncio.Queue):
+async def download_worker(application: Application, queue: JobQueue):
     loop = asyncio.get_running_loop()
+    job_registry: Optional[JobRegistry] = application.bot_data.get('job_registry')
+    status_reporter: Optional[StatusReporter] = application.bot_data.get('status_reporter')
+    file_id_cache: Optional[FileIdCache] = application.bot_data.get('file_id_cache')
+    admission: Optional[AdmissionController] = application.bot_data.get('admission')
+    local_videos: Optional[LocalVideos] = application.bot_data.get('local_videos')
+    prefetcher: Optional[InfoPrefetcher] = application.bot_data.get('info_prefetcher')
+    # Задачи в работе: при остановке недоделанные передаются следующему экземпляру
+    running_jobs: dict = application.bot_data.setdefault('running_jobs', {})
     logger.info("Download worker started")
 
     while True:
@@ -38,45 +72,69 @@ async def download_worker(application: Application, queue: asyncio.Queue):
             platform = job['platform']
             request_id = job['request_id']
 
-            with request_context(request_id):
-                logger.info(f"Processing job: [{command_type}] for {url} from chat {chat_id}")
+            # Ожидание в очереди от постановки задачи до начала работы
+            if job.get('enqueued_at_ns'):
+                record_span('queue.wait', job['enqueued_at_ns'], request_id=request_id)
+
+            with request_context(request_id), span('job', type=command_type, platform=platform, batch=bool(job.get('items')), cost=job.get('cost')) as job_span:
+                logger.info(
+                    f"Processing job: [{command_type}] for {url} from chat {chat_id} "
+                    f"(cost {job.get('cost') or 0:.0f}, lane {lane_for(job.get('cost') or 0)}, {queue.qsize()} waiting)"
+                )
 
-                filepath = None
-                title = "Untitled"
+                filepaths: List[str] = []
+                handle = job_registry.get(request_id) if job_registry else None
+                # Время работы над задачей для калибровки оценок контроля нагрузки
+                started_at = time.monotonic()
+                completed = False
+                # Выдача из кеша или аудио из уже скачанного видео не говорит о скорости работы
+                calibrate = True
+                # Память основного процесса до задачи: по разнице видно, какие задачи ее не отдают
+                rss_before = current_rss()
+                running_jobs[request_id] = job
 
                 try:
+                    # Задача отменена пока стояла в очереди
+                    if handle and handle.cancelled:
+                        logger.info("Job was cancelled while queued, skipping")
+                        continue
+
+                    # Пакетная задача: несколько ссылок или плейлист в одном сообщении
+                    if job.get('items'):
+                        await _process_batch(application, loop, queue, job, handle, filepaths)
+                        completed = True
+                        continue
+
                     # Получаем правильный downloader для платформы
-                    downloader = _select_downloader(platform)
+                    downloader = select_downloader(platform)
                     if not downloader:
                         logger.warning(f"Unsupported platform: {platform}")
                         await application.bot.send_message(chat_id=chat_id, text=NOT_IMPLEMENTED_MESSAGE.format(platform))
-                        queue.task_done()
                         continue
 
                     # Скачивание
-                    filepath, title = await _download_media(downloader, url, command_type, request_id)
-                    if not filepath or not title:
+                    result = await _fetch_media(application, loop, queue, job, downloader, url, platform, handle)
+                    if not result:
                         logger.warning(f"Unsupported command: {command_type}")
                         await application.bot.send_message(chat_id=chat_id, text=TECHNICAL_ERROR_MESSAGE)
-                        queue.task_done()
+                        continue
+                    filepaths.extend(path for path in (result.filepath, result.thumbnail) if path)
+                    calibrate = not result.from_cache
+
+                    # Длинное аудио больше лимита телеграма уходит частями
+                    size_bytes = await loop.run_in_executor(None, os.path.getsize, result.filepath)
+                    if command_type == "audio" and size_bytes > downloader.MAX_FILE_SIZE_BYTES:
+                        await _send_audio_parts(application, chat_id, platform, result, request_id, size_bytes, downloader, filepaths)
+                        completed = True
                         continue
 
-                    # Проверка на существование файла
-                    exists = await loop.run_in_executor(None, os.path.exists, filepath)
-                    if not exists:
-                        raise DownloadError("Downloaded file not found")
-
-                    # Отправляет файл клиенту
-                    await _send_media(
-                        application,
-                        loop,
-                        chat_id,
-                        command_type,
-                        platform,
-                        filepath,
-                        title,
-                        request_id
-                    )
+                    # Отправляет файл клиенту и запоминает его file_id
+                    message = await _send_media(application, chat_id, command_type, platform, result, request_id)
+                    _remember_file_id(file_id_cache, url, command_type, message, result.title)
+                    completed = True
+
+                except JobCancelledError:
+                    logger.info(f"Job for {url} in chat {chat_id} was cancelled")
 
                 except DownloadError as e:
                     await _handle_download_error(e, application, url, chat_id)
@@ -89,8 +147,30 @@ async def download_worker(application: Application, queue: asyncio.Queue):
                         logger.error(f"Failed to send error message to chat {chat_id}: {send_err}")
 
                 finally:
-                    # Очистка директории temp от файла
-                    await _cleanup(filepath, loop)
+                    running_jobs.pop(request_id, None)
+                    # Статусное сообщение больше не нужно (у отмененной задачи оставляем текст об отмене)
+                    if status_reporter and handle and handle.status_message_id:
+                        await status_reporter.close(chat_id, handle.status_message_id, delete=not handle.cancelled)
+                    if job_registry:
+                        job_registry.remove(request_id)
+                    if file_id_cache:
+                        file_id_cache.discard_pending(make_cache_key(url, command_type))
+                    # Предзагрузка, которую задача не забрала (отмена, ошибка до загрузки)
+                    if prefetcher:
+                        prefetcher.discard(url)
+                    if admission:
+                        admission.finish(request_id, time.monotonic() - started_at if completed and calibrate else None)
+                    # Очистка директории temp от файлов задачи
+                    with span('cleanup', files=len(filepaths)):
+                        for filepath in filepaths:
+                            if local_videos:
+                                local_videos.discard(filepath)
+                            await _cleanup(filepath, loop)
+                    rss_after = current_rss()
+                    logger.info(f"Job finished, main process RSS {format_mb(rss_after)} ({'+' if rss_after >= rss_before else ''}{format_mb(rss_after - rss_before)})")
+                    if job_span:
+                        job_span.set_attribute('rss_bytes', rss_after)
+                        job_span.set_attribute('rss_delta_bytes', rss_after - rss_before)
                     # Сообщаем воркееру что задача обработана
                     worker_job_done(job, request_id, queue)
 
@@ -112,86 +192,536 @@ async def download_worker(application: Application, queue: asyncio.Queue):
                      logger.error(f"Failed to call task_done() after critical error: {td_err}")
             await asyncio.sleep(5) # Пауза перед следующей итерацией
 
-# Выбирает подходящий downloader для заданной платформы
-def _select_downloader(
-    platform: str
-) -> Union[YouTubeDownloader, TwitterDownloader, InstagramDownloader, None]:
-    if platform == 'YouTube':
-        return youtube_downloader
-    elif platform == 'Twitter':
-        return twitter_downloader
-    elif platform == 'Instagram':
-        return instagram_downloader
-    else:
-        return None
-
-# Загружает медиафайл видео или аудио с помощью downloader'a
-async def _download_media(
-    downloader: Union[YouTubeDownloader, TwitterDownloader, InstagramDownloader],
+# Скачивает один медиафайл задачи: управление отменой, прогресс, качество и таймаут.
+# Возвращает None если тип задачи не поддерживается
+async def _fetch_media(
+    application: Application,
+    loop: asyncio.AbstractEventLoop,
+    queue: JobQueue,
+    job: dict,
+    downloader: BaseDownloader,
     url: str,
-    command_type: str,
-    request_id: str
-) -> Tuple[Optional[str], Optional[str]]:
-    if command_type == "video":
-        filepath, title = await downloader.download_video(url, request_id=request_id)
-        return filepath, title
-    elif command_type == "audio":
-        filepath, title = await downloader.download_audio(url, request_id=request_id)
-        return filepath, title
-    else:
-       return None, None
+    platform: str,
+    handle: Optional[JobHandle],
+    session: Optional[DownloadSession] = None
+) -> Optional[DownloadResult]:
+    process_pool: Optional[DownloadProcessPool] = application.bot_data.get('process_pool')
+    quality_policy: Optional[QualityPolicy] = application.bot_data.get('quality_policy')
+    job_registry: Optional[JobRegistry] = application.bot_data.get('job_registry')
+    status_reporter: Optional[StatusReporter] = application.bot_data.get('status_reporter')
+    prefetcher: Optional[InfoPrefetcher] = application.bot_data.get('info_prefetcher')
+    media_cache: Optional[MediaCache] = application.bot_data.get('media_cache')
+    local_videos: Optional[LocalVideos] = application.bot_data.get('local_videos')
+    proxy_pool: Optional[ProxyPool] = application.bot_data.get('proxy_pool')
+    command_type = job['type']
+    request_id = job['request_id']
 
-# Четние и отправка медиа в чат с клиентом
-async def _send_media(
+    # Управление задачей: отмена и прогресс (общие с дочерним процессом, если есть пул)
+    control = process_pool.create_control() if process_pool else JobControl()
+    if handle:
+        handle.status = 'running'
+        handle.attach_control(control)
+
+    # Остальные задачи сдвинулись в очереди, а по этой начинаем показывать прогресс
+    progress_task = None
+    if status_reporter and job_registry:
+        _report_queue_positions(job_registry, status_reporter, queue)
+        if handle and handle.status_message_id:
+            progress_task = asyncio.create_task(_track_progress(status_reporter, handle, control))
+
+    try:
+        # Итоговое качество: выбор пользователя, ограниченный текущей нагрузкой
+        quality = job.get('quality')
+        if quality_policy:
+            quality = quality_policy.resolve(quality, queue.qsize())
+        if command_type == "video" and quality:
+            logger.info(f"Quality tier for job: {quality} (queue depth {queue.qsize()})")
+
+        download_started_at = time.monotonic()
+        try:
+            result = await asyncio.wait_for(
+                _download_media(
+                    process_pool, downloader, platform, url, command_type, request_id, quality, control, session,
+                    prefetcher, media_cache, local_videos, proxy_pool
+                ),
+                timeout=JOB_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            control.cancel()
+            raise DownloadError(f"Job timed out after {JOB_TIMEOUT:.0f}s")
+        except asyncio.CancelledError:
+            # Воркер отменили (остановка бота): загрузка в потоке или процессе пула должна остановиться сама
+            control.cancel()
+            raise
+        if not result or not result.filepath or not result.title:
+            return None
+        # Пока видео лежит во временной папке, из него можно взять аудио для задачи по той же ссылке
+        if local_videos and command_type == "video":
+            local_videos.register(url, LocalVideo(result.filepath, result.title, result.duration))
+
+        # Проверка на существование файла
+        exists = await loop.run_in_executor(None, os.path.exists, result.filepath)
+        if not exists:
+            raise DownloadError("Downloaded file not found")
+
+        # Сообщаем политике качества о скорости загрузки (выдача из кеша не в счет)
+        if quality_policy and not result.from_cache:
+            size_bytes = await loop.run_in_executor(None, os.path.getsize, result.filepath)
+            quality_policy.record_download(size_bytes, time.monotonic() - download_started_at)
+
+        # Отмена могла прийти уже после завершения загрузки
+        control.check()
+        control.set_stage('upload')
+        return result
+    finally:
+        if progress_task:
+            progress_task.cancel()
+
+# Обрабатывает пакетную задачу: разворачивает плейлисты, скачивает элементы
+# с общей cookie jar и отправляет результаты альбомами
+async def _process_batch(
     application: Application,
     loop: asyncio.AbstractEventLoop,
+    queue: JobQueue,
+    job: dict,
+    handle: Optional[JobHandle],
+    filepaths: List[str]
+):
+    chat_id = job['chat_id']
+    command_type = job['type']
+    # Части длинного аудио в альбом не вставить: такие элементы отсекаются еще до загрузки
+    session = DownloadSession(cookiefile=str(Path('temp') / f"cookies_{job['request_id']}.txt"), audio_parts=False)
+    filepaths.append(session.cookiefile)
+
+    # Разворачиваем плейлисты в список отдельных ссылок.
+    # Плейлист, который не удалось развернуть, считается одним неудачным элементом, остальные ссылки качаются
+    items = []
+    failed = 0
+    for item in job['items']:
+        if item.get('playlist'):
+            try:
+                downloader = select_downloader(item['platform'])
+                entries = await downloader.expand_playlist(item['url'], BATCH_MAX_ITEMS, session=session)
+            except JobCancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Failed to expand playlist {item['url']}: {e}")
+                failed += 1
+                continue
+            items.extend({'url': entry_url, 'platform': item['platform']} for entry_url in entries)
+        else:
+            items.append(item)
+    items = items[:BATCH_MAX_ITEMS]
+    logger.info(f"Processing batch of {len(items)} item(s)")
+
+    results: List[Tuple[DownloadResult, dict]] = []
+    for index, item in enumerate(items, start=1):
+        if handle:
+            if handle.cancelled:
+                raise JobCancelledError("Batch cancelled")
+            handle.batch_position = (index, len(items))
+        try:
+            downloader = select_downloader(item['platform'])
+            result = await _fetch_media(application, loop, queue, job, downloader, item['url'], item['platform'], handle, session)
+            if not result:
+                failed += 1
+                continue
+            filepaths.extend(path for path in (result.filepath, result.thumbnail) if path)
+            # Оценка до загрузки могла ошибиться: в альбом части длинного аудио не вставить
+            size_bytes = await loop.run_in_executor(None, os.path.getsize, result.filepath)
+            if size_bytes > downloader.MAX_FILE_SIZE_BYTES:
+                raise DownloadError(f"File is too large: {size_bytes / (1024 * 1024):.1f}MB")
+            results.append((result, item))
+        except DownloadError as e:
+            # Ошибка одного элемента не должна ломать весь пакет
+            logger.warning(f"Batch item {item['url']} failed: {e}")
+            failed += 1
+
+    if results:
+        await _send_media_group(application, chat_id, command_type, results)
+    if failed:
+        await application.bot.send_message(chat_id=chat_id, text=BATCH_PARTIAL_MESSAGE.format(len(results), len(results) + failed))
+
+# Отправляет результаты пакета альбомами по 10 файлов (ограничение телеграма).
+# Если альбом отправить не удалось, файлы отправляются по одному
+async def _send_media_group(
+    application: Application,
     chat_id: int,
     command_type: str,
-    platform: str,
-    filepath: str,
-    title: str,
-    request_id: str
+    results: List[Tuple[DownloadResult, dict]]
 ):
-    logger.info(f"Sending {command_type} from {platform} to chat {chat_id}")
-    if command_type == "video":
-        # Получаем размеры видео
-        width, height = await loop.run_in_executor(None, get_video_info, filepath)
+    file_id_cache: Optional[FileIdCache] = application.bot_data.get('file_id_cache')
+    for start in range(0, len(results), MEDIA_GROUP_SIZE):
+        chunk = results[start:start + MEDIA_GROUP_SIZE]
+        # Файлы альбома загружают помощники параллельно, каждый на своем токене.
+        # Файл, который помощник загрузил, но не смог передать основному боту, повторно не загружается:
+        # он выпадает из альбома, а пользователь получает сообщение об ошибке
+        uploads = await asyncio.gather(*(
+            _upload_via_helpers(application, command_type, item['platform'], result) for result, item in chunk
+        ), return_exceptions=True)
+        uploaded = []
+        for (result, item), upload in zip(chunk, uploads):
+            if isinstance(upload, BaseException):
+                logger.error(f"Helper upload of {result.filepath} failed: {upload}")
+                await application.bot.send_message(chat_id=chat_id, text=TECHNICAL_ERROR_MESSAGE)
+                continue
+            uploaded.append(((result, item), upload))
+        if not uploaded:
+            continue
+        chunk = [entry for entry, _ in uploaded]
+        file_ids = [file_id for _, file_id in uploaded]
+        if len(chunk) == 1:
+            result, item = chunk[0]
+            message = await _send_media(application, chat_id, command_type, item['platform'], result, None, file_ids[0])
+            _remember_file_id(file_id_cache, item['url'], command_type, message, result.title)
+            continue
 
         try:
-            # Открываем файл и отправляем его пользователю
-            with open(filepath, 'rb') as video_file_to_send:
-                await application.bot.send_video(
+            media = []
+            loop = asyncio.get_running_loop()
+            for (result, item), file_id in zip(chunk, file_ids):
+                filename = None
+                if file_id:
+                    media_file, thumbnail = file_id, None
+                else:
+                    media_file, thumbnail = await loop.run_in_executor(None, read_media_files, result)
+                    filename = os.path.basename(result.filepath)
+                if command_type == "video":
+                    media.append(InputMediaVideo(
+                        media_file,
+                        width=result.width,
+                        height=result.height,
+                        duration=result.duration,
+                        thumbnail=thumbnail,
+                        supports_streaming=True,
+                        filename=filename
+                    ))
+                else:
+                    media.append(InputMediaAudio(
+                        media_file,
+                        title=result.title,
+                        performer=f"from {item['platform']}",
+                        duration=result.duration,
+                        thumbnail=thumbnail,
+                        filename=filename
+                    ))
+            with span('upload', type=command_type, files=len(media)):
+                messages = await application.bot.send_media_group(
                     chat_id=chat_id,
-                    video=video_file_to_send,
-                    width=width,
-                    height=height,
-                    supports_streaming=True
+                    media=media,
+                    read_timeout=UPLOAD_TIMEOUT,
+                    write_timeout=UPLOAD_TIMEOUT
                 )
-                logger.info(f"Successfully sent video to chat {chat_id} ({filepath})")
-        except FileNotFoundError:
-            logger.error(f"File {filepath} not found before sending")
-            await application.bot.send_message(chat_id=chat_id, text=TECHNICAL_ERROR_MESSAGE)
+            logger.info(f"Successfully sent media group of {len(chunk)} files to chat {chat_id}")
+            for (result, item), message in zip(chunk, messages):
+                _remember_file_id(file_id_cache, item['url'], command_type, message, result.title)
         except Exception as send_err:
-            logger.error(f"Error sending video file from path {filepath} to chat {chat_id}: {send_err}", exc_info=True)
-            await application.bot.send_message(chat_id=chat_id, text=TECHNICAL_ERROR_MESSAGE)
+            logger.error(f"Error sending media group to chat {chat_id}: {send_err}, falling back to single sends", exc_info=True)
+            # Уже загруженные помощниками файлы отправляются по file_id, без повторной загрузки
+            for (result, item), file_id in zip(chunk, file_ids):
+                message = await _send_media(application, chat_id, command_type, item['platform'], result, None, file_id)
+                _remember_file_id(file_id_cache, item['url'], command_type, message, result.title)
+
+# Обновляет место в очереди у всех ожидающих задач
+def _report_queue_positions(job_registry: JobRegistry, status_reporter: StatusReporter, queue: JobQueue):
+    positions = queue.positions()
+    queued = [handle for handle in job_registry.active() if handle.status == 'queued' and handle.request_id in positions]
+    for handle in queued:
+        position = positions[handle.request_id]
+        if handle.status_message_id:
+            status_reporter.update(
+                handle.chat_id,
+                handle.status_message_id,
+                render_status({'stage': 'queued'}, position),
+                get_job_cancel_markup(handle.request_id)
+            )
 
-    else: # audio
+# Периодически переносит прогресс задачи из JobControl в статусное сообщение.
+# Частоту реальных правок ограничивает StatusReporter
+async def _track_progress(status_reporter: StatusReporter, handle: JobHandle, control: JobControl, interval: float = 1.0):
+    loop = asyncio.get_running_loop()
+    # Правки чаще min_interval все равно не уйдут, а в режиме пула каждое чтение прогресса -
+    # IPC с менеджером, поэтому оно идет в потоке и не чаще правок
+    interval = max(interval, status_reporter.min_interval)
+    try:
+        while True:
+            if control.shared:
+                progress = await loop.run_in_executor(None, control.progress.copy)
+            else:
+                progress = control.progress.copy()
+            # Пока идет загрузка задачу еще можно отменить
+            markup = None if progress.get('stage') == 'upload' else get_job_cancel_markup(handle.request_id)
+            text = render_status(progress)
+            if handle.batch_position:
+                text = BATCH_STATUS_PREFIX.format(*handle.batch_position) + text
+            status_reporter.update(handle.chat_id, handle.status_message_id, text, markup)
+            await asyncio.sleep(interval)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.warning(f"Progress tracking stopped: {e}")
+
+# Загружает медиафайл видео или аудио с помощью downloader'a.
+# Сначала смотрит в дисковый кеш готовых файлов, и только при промахе запускает загрузку.
+# Если включен пул процессов, загрузка уходит в дочерний процесс
+async def _download_media(
+    process_pool: Optional[DownloadProcessPool],
+    downloader: BaseDownloader,
+    platform: str,
+    url: str,
+    command_type: str,
+    request_id: str,
+    quality: Optional[str] = None,
+    control: Optional[JobControl] = None,
+    session: Optional[DownloadSession] = None,
+    prefetcher: Optional[InfoPrefetcher] = None,
+    media_cache: Optional[MediaCache] = None,
+    local_videos: Optional[LocalVideos] = None,
+    proxy_pool: Optional[ProxyPool] = None
+) -> Optional[DownloadResult]:
+    if command_type not in ("video", "audio"):
+        return None
+    loop = asyncio.get_running_loop()
+
+    cache_key = media_cache.make_key(url, command_type, quality) if media_cache else None
+    if cache_key:
+        cached = await loop.run_in_executor(None, media_cache.get, cache_key, downloader.temp_dir, request_id)
+        if cached:
+            stats = media_cache.stats()
+            logger.info(f"Media cache hit for {url} (hit ratio {stats['hit_ratio']:.0%} of {stats['hits'] + stats['misses']})")
+            filepath, title, metadata = cached
+            return DownloadResult(filepath, title, **metadata, from_cache=True)
+
+    # Аудио по ссылке, видео которой уже есть локально: вынимаем дорожку без сети и перекодирования
+    if command_type == "audio":
+        result = await _derive_audio(downloader, url, request_id, control, media_cache, local_videos)
+        if result:
+            await _store_in_cache(loop, media_cache, cache_key, result)
+            return result
+
+    # Информация о ссылке, которую начали получать еще до выбора видео/аудио
+    prefetched = None
+    if prefetcher:
+        if control:
+            control.set_stage('extract')
+        prefetched = await prefetcher.take(url, timeout=EXTRACT_TIMEOUT)
+        if control:
+            control.check()
+        if prefetched:
+            logger.info("Using prefetched media info")
+    info = prefetched.info if prefetched else None
+
+    # Исходящий адрес задачи из пула. Ссылки на файлы в информации привязаны к адресу, с которого
+    # её получили (у YouTube в них зашит IP), поэтому с предзагруженной информацией качаем через тот же адрес.
+    # Если платформа ограничила адрес, задача один раз повторяется через другой
+    lease = None
+    if proxy_pool:
+        if info and prefetched.proxy:
+            lease = proxy_pool.lease(platform, prefetched.proxy)
+        else:
+            lease = proxy_pool.acquire(platform)
+    for attempt in range(2):
+        job_session = lease.entry.session(session) if lease else session
+        started_at = time.monotonic()
         try:
-            # Открываем файл и отправляем его пользователю
-            with open(filepath, 'rb') as audio_file_to_send:
-                await application.bot.send_audio(
+            if process_pool:
+                result = await process_pool.download(platform, url, command_type, request_id, quality, control, job_session, info)
+            elif command_type == "video":
+                result = await downloader.download_video(url, request_id=request_id, quality=quality, control=control, session=job_session, info=info)
+            else:
+                result = await downloader.download_audio(url, request_id=request_id, control=control, session=job_session, info=info)
+        except DownloadError as e:
+            if not lease:
+                raise
+            outcome = classify_error(str(e))
+            proxy_pool.release(lease, outcome)
+            if attempt > 0 or outcome != OUTCOME_THROTTLED or (control and control.cancelled):
+                raise
+            throttled, lease = lease.entry, proxy_pool.acquire(platform, exclude=lease.entry)
+            if not lease:
+                raise
+            logger.warning(f"{platform} throttled address {throttled}, retrying through {lease.entry}: {e}")
+            # Информация получена через ограниченный адрес, извлекаем заново
+            info = None
+            continue
+        except BaseException:
+            if lease:
+                proxy_pool.release(lease, None)
+            raise
+        if lease:
+            seconds = time.monotonic() - started_at
+            size_mb = 0
+            if result and os.path.exists(result.filepath):
+                size_mb = await loop.run_in_executor(None, os.path.getsize, result.filepath) / (1024 * 1024)
+            proxy_pool.release(lease, OUTCOME_OK, seconds / max(size_mb, 1))
+        break
+
+    await _store_in_cache(loop, media_cache, cache_key, result)
+    return result
+
+# Сохраняет готовый файл в кеш. Ошибка кеша не должна ломать задачу
+async def _store_in_cache(loop: asyncio.AbstractEventLoop, media_cache: Optional[MediaCache], cache_key: Optional[str], result: Optional[DownloadResult]):
+    if not cache_key or not result:
+        return
+    try:
+        metadata = {'duration': result.duration, 'width': result.width, 'height': result.height}
+        await loop.run_in_executor(None, media_cache.put, cache_key, result.filepath, result.title, metadata)
+    except Exception as e:
+        logger.warning(f"Failed to store {result.filepath} in media cache: {e}")
+
+# Ищет видео этой ссылки во временной папке (задача, которая еще отправляет его) или в кеше
+# и копирует из него аудио дорожку. None - локального видео нет или дорожку не получить
+async def _derive_audio(
+    downloader: BaseDownloader,
+    url: str,
+    request_id: str,
+    control: Optional[JobControl],
+    media_cache: Optional[MediaCache],
+    local_videos: Optional[LocalVideos]
+) -> Optional[DownloadResult]:
+    loop = asyncio.get_running_loop()
+    video = local_videos.get(url) if local_videos else None
+    origin = 'temp'
+    if not video and media_cache:
+        cached = await loop.run_in_executor(None, media_cache.find, url, 'video')
+        if cached:
+            filepath, title, metadata = cached
+            video, origin = LocalVideo(filepath, title, metadata.get('duration')), 'cache'
+    if not video:
+        return None
+
+    if control:
+        control.set_stage('postprocess')
+    with span('derive_audio', source=origin):
+        started_at = time.monotonic()
+        audio_path = await extract_audio_track(video.filepath, downloader.temp_dir, request_id)
+    if control:
+        control.check()
+    if not audio_path:
+        return None
+    logger.info(f"Audio for {url} extracted from {origin} video in {time.monotonic() - started_at:.2f}s, skipping download")
+    # Файл получен без сети, в статистику скорости загрузок он не идет
+    return DownloadResult(audio_path, video.title, duration=video.duration, from_cache=True)
+
+# Запоминает file_id отправленного файла, чтобы отдавать его повторно без загрузки
+def _remember_file_id(file_id_cache: Optional[FileIdCache], url: str, command_type: str, message: Optional[Message], title: Optional[str]):
+    if not file_id_cache or not message:
+        return
+    if message.video:
+        file_id_cache.put(make_cache_key(url, command_type), CachedMedia(message.video.file_id, 'video', title))
+    elif message.audio:
+        file_id_cache.put(make_cache_key(url, command_type), CachedMedia(message.audio.file_id, 'audio', title))
+
+# Четние и отправка медиа в чат с клиентом.
+# Длительность, размеры и превью берутся из стадии метаданных загрузки.
+# Возвращает отправленное сообщение или None, если отправить не удалось
+async def _send_media(
+    application: Application,
+    chat_id: int,
+    command_type: str,
+    platform: str,
+    result: DownloadResult,
+    request_id: Optional[str],
+    file_id: Optional[str] = None
+) -> Optional[Message]:
+    filepath = result.filepath
+    logger.info(f"Sending {command_type} from {platform} to chat {chat_id}")
+    try:
+        # Читаем файл (и превью, если есть) и отправляем его пользователю.
+        # Тяжелый файл загружает бот-помощник, тогда отправляем уже по file_id
+        with span('upload', type=command_type, from_cache=result.from_cache):
+            if not file_id:
+                file_id = await _upload_via_helpers(application, command_type, platform, result)
+            filename = None
+            if file_id:
+                media_file, thumbnail = file_id, None
+            else:
+                # Файл читается в потоке, чтобы не блокировать event loop
+                media_file, thumbnail = await asyncio.get_running_loop().run_in_executor(None, read_media_files, result)
+                filename = os.path.basename(filepath)
+            if command_type == "video":
+                message = await application.bot.send_video(
                     chat_id=chat_id,
-                    audio=audio_file_to_send,
-                    title=title,
-                    performer=f"from {platform}"
+                    video=media_file,
+                    filename=filename,
+                    width=result.width,
+                    height=result.height,
+                    duration=result.duration,
+                    thumbnail=thumbnail,
+                    supports_streaming=True,
+                    read_timeout=UPLOAD_TIMEOUT,
+                    write_timeout=UPLOAD_TIMEOUT
                 )
-                logger.info(f"Successfully sent audio to chat {chat_id} ({filepath})")
-        except FileNotFoundError:
-            logger.error(f"File {filepath} not found before sending")
-            await application.bot.send_message(chat_id=chat_id, text=TECHNICAL_ERROR_MESSAGE)
-        except Exception as send_err:
-            logger.error(f"Error sending audio file from path {filepath} to chat {chat_id}: {send_err}", exc_info=True)
-            await application.bot.send_message(chat_id=chat_id, text=TECHNICAL_ERROR_MESSAGE)
+            else: # audio
+                message = await application.bot.send_audio(
+                    chat_id=chat_id,
+                    audio=media_file,
+                    filename=filename,
+                    title=result.title,
+                    performer=f"from {platform}",
+                    duration=result.duration,
+                    thumbnail=thumbnail,
+                    read_timeout=UPLOAD_TIMEOUT,
+                    write_timeout=UPLOAD_TIMEOUT
+                )
+        logger.info(f"Successfully sent {command_type} to chat {chat_id} ({filepath})")
+        return message
+    except FileNotFoundError:
+        logger.error(f"File {filepath} not found before sending")
+        await application.bot.send_message(chat_id=chat_id, text=TECHNICAL_ERROR_MESSAGE)
+    except Exception as send_err:
+        logger.error(f"Error sending {command_type} file from path {filepath} to chat {chat_id}: {send_err}", exc_info=True)
+        await application.bot.send_message(chat_id=chat_id, text=TECHNICAL_ERROR_MESSAGE)
+    return None
+
+# Режет длинное аудио на части под лимит телеграма (без перекодирования) и отправляет каждую,
+# как только она готова, пока следующие еще режутся.
+# Резать начинаем только после полной загрузки (и перекодирования в mp3, если оно было):
+# первая часть приходит пользователю не раньше, чем скачан весь файл
+async def _send_audio_parts(
+    application: Application,
+    chat_id: int,
+    platform: str,
+    result: DownloadResult,
+    request_id: str,
+    size_bytes: int,
+    downloader: BaseDownloader,
+    filepaths: List[str]
+):
+    # Длительность части по среднему битрейту файла, с запасом на переменный битрейт
+    duration = result.duration or size_bytes * 8 / (128 * 1000)
+    part_seconds = max(60, int(duration * downloader.MAX_FILE_SIZE_BYTES * 0.9 / size_bytes))
+    total = math.ceil(duration / part_seconds)
+    logger.info(f"Audio is {size_bytes / (1024 * 1024):.1f}MB, sending it as {total} part(s) of {part_seconds}s")
+    await application.bot.send_message(chat_id=chat_id, text=AUDIO_PARTS_MESSAGE.format(total))
+
+    index = 0
+    with span('split_audio', parts=total, part_seconds=part_seconds):
+        async with aclosing(split_audio(result.filepath, part_seconds, downloader.temp_dir, request_id)) as parts:
+            async for part_path, part_duration in parts:
+                filepaths.append(part_path)
+                index += 1
+                part = result._replace(
+                    filepath=part_path,
+                    title=f"{result.title} ({index}/{max(total, index)})",
+                    duration=int(part_duration) or None
+                )
+                if not await _send_media(application, chat_id, "audio", platform, part, request_id):
+                    # Об ошибке пользователю уже сообщили, остальные части не отправляем
+                    break
+    logger.info(f"Sent {index} audio part(s) to chat {chat_id}")
+
+# Загружает файл через ботов-помощников, если они настроены и файл достаточно большой.
+# Возвращает file_id основного бота или None, если файл нужно отправить напрямую.
+# UploadForwardError (файл загружен, но не переслан) пробрасывается: отправлять файл второй раз нельзя
+async def _upload_via_helpers(application: Application, command_type: str, platform: str, result: DownloadResult) -> Optional[str]:
+    upload_pool: Optional[UploadPool] = application.bot_data.get('upload_pool')
+    if not upload_pool or not upload_pool.should_shard(result.filepath):
+        return None
+    file_id = await upload_pool.upload(application.bot, command_type, platform, result)
+    if not file_id:
+        logger.info(f"Helper bots could not upload {result.filepath}, sending directly")
+    return file_id
 
 # Обработка ошибок возникших при загрузке
 async def _handle_download_error(
@@ -215,6 +745,9 @@ async def _handle_download_error(
         except:
             # Если не удалось извлечь размер
             reply_text = FILE_TOO_LARGE_MESSAGE.format("?")
+    # Проверяем таймауты и зависшие загрузки
+    elif "timed out" in error_message_text.lower() or "stalled" in error_message_text.lower():
+        reply_text = JOB_TIMEOUT_MESSAGE
     elif "file not found" in error_message_text.lower():
         logger.error(f"Downloaded file missing error for {url}")
     else:
@@ -237,7 +770,7 @@ async def _cleanup(filepath: Optional[str], loop: asyncio.AbstractEventLoop):
             logger.error(f"Error removing temporary file {filepath}: {e}")
 
 # Говорим воркеру что задача завершена
-def worker_job_done(job: Optional[asyncio.Task], request_id: str, queue: asyncio.Queue):
+def worker_job_done(job: Optional[asyncio.Task], request_id: str, queue: JobQueue):
     if job:
         queue.task_done()
         logger.info(f"[{request_id}] Job task done.")
@@ -0,0 +1,61 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from config import ADMIN_USER_IDS
+from utils.logger import logger
+from utils.memory import AllocationTracker, current_rss, format_mb
+from handlers.common import unknown_command
+from utils.constants import (
+    MEMORY_REPORT_MESSAGE,
+    MEMORY_TRACE_STARTED_MESSAGE,
+    MEMORY_SNAPSHOT_MESSAGE,
+    MEMORY_TRACE_STOPPED_MESSAGE
+)
+
+# Лимит длины сообщения телеграма
+MESSAGE_LIMIT = 4096
+
+def _memory_report(context: ContextTypes.DEFAULT_TYPE, tracker: AllocationTracker) -> str:
+    process_pool = context.bot_data.get('process_pool')
+    pool_stats = process_pool.memory_stats() if process_pool else None
+    if pool_stats and pool_stats['processes']:
+        processes = ', '.join(
+            f"{pid}: {format_mb(rss)} ({'+' if growth >= 0 else ''}{format_mb(growth)})"
+            for pid, (rss, growth) in sorted(pool_stats['processes'].items())
+        )
+    else:
+        processes = '-'
+    traced = tracker.traced()
+    tracing = f"{format_mb(traced[0])}, пик {format_mb(traced[1])}" if traced else 'выключен'
+    return MEMORY_REPORT_MESSAGE.format(
+        format_mb(current_rss()),
+        processes,
+        pool_stats['recycles'] if pool_stats else '-',
+        tracing
+    )
+
+# /memory - RSS основного процесса и процессов пула,
+# /memory snapshot - снимок tracemalloc (первый вызов включает трассировку), /memory stop - выключает ее
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_USER_IDS:
+        await unknown_command(update, context)
+        return
+
+    tracker: AllocationTracker = context.bot_data.setdefault('allocation_tracker', AllocationTracker())
+    action = context.args[0].lower() if context.args else None
+    logger.info(f"Admin {user_id} requested memory report ({action or 'summary'})")
+
+    if action == 'snapshot':
+        started = not tracker.tracing
+        lines = tracker.snapshot()
+        if started:
+            text = MEMORY_TRACE_STARTED_MESSAGE
+        else:
+            text = MEMORY_SNAPSHOT_MESSAGE.format('\n'.join(lines) or '-')
+    elif action == 'stop':
+        tracker.stop()
+        text = MEMORY_TRACE_STOPPED_MESSAGE
+    else:
+        text = _memory_report(context, tracker)
+
+    await update.message.reply_text(text[:MESSAGE_LIMIT])
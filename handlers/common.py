@@ -2,9 +2,13 @@ from telegram import Update
 from telegram.ext import ContextTypes
 from utils.logger import logger
 from ui.keyboards import send_main_keyboard
+from utils.format_selector import QUALITY_TIERS, DEFAULT_TIER
 from utils.constants import (
     HELP_MESSAGE,
-    UNKNOWN_COMMAND_MESSAGE
+    UNKNOWN_COMMAND_MESSAGE,
+    QUALITY_CURRENT_MESSAGE,
+    QUALITY_SET_MESSAGE,
+    QUALITY_UNKNOWN_MESSAGE
 )
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -19,3 +23,20 @@ async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Не проверяем state, так как handle_link должен был обработать ссылку
     logger.info(f"Unknown command: {update.message.text} from {update.effective_user.id}")
     await send_main_keyboard(update, update.message.chat_id, UNKNOWN_COMMAND_MESSAGE)
+
+# Выбор уровня качества видео: /quality показывает текущий, /quality 480p устанавливает новый
+async def quality_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    available = ', '.join(QUALITY_TIERS)
+    if not context.args:
+        current = context.user_data.get('quality') or DEFAULT_TIER
+        await send_main_keyboard(update, update.message.chat_id, QUALITY_CURRENT_MESSAGE.format(current, available))
+        return
+
+    tier = context.args[0].strip().lower()
+    if tier not in QUALITY_TIERS:
+        await send_main_keyboard(update, update.message.chat_id, QUALITY_UNKNOWN_MESSAGE.format(available))
+        return
+
+    context.user_data['quality'] = tier
+    logger.info(f"User {update.effective_user.id} set quality tier: {tier}")
+    await send_main_keyboard(update, update.message.chat_id, QUALITY_SET_MESSAGE.format(tier))
@@ -1,3 +1,7 @@
+import asyncio
+import math
+import time
+from typing import List, Optional, Tuple
 from telegram import Update
 from telegram.ext import (
     ContextTypes,
@@ -10,15 +14,30 @@ from utils.constants import (
     ACTION_EMPTY, USE_BUTTONS_WARN, VIDEO_BUTTON_TEXT, AUDIO_BUTTON_TEXT, CANCEL_BUTTON_TEXT,
     WAIT_FOR_LINK, ACTION_CANCEL, QUEUE_MESSAGE, HELP_MESSAGE,
     TECHNICAL_ERROR_MESSAGE, NOT_IMPLEMENTED_MESSAGE,
-    SUPPORTED_DOMAINS
+    SUPPORTED_DOMAINS, JOBS_CANCELLED_MESSAGE, BATCH_QUEUE_MESSAGE, LINK_RECEIVED_MESSAGE,
+    QUEUE_ETA_MESSAGE, QUEUE_BUSY_MESSAGE, TOO_MANY_JOBS_MESSAGE, DRAINING_MESSAGE, JOB_CANCELLED_MESSAGE,
+    BATCH_SKIPPED_MESSAGE, BATCH_LIMIT_SKIPPED_MESSAGE
 )
-from utils.validate_url import validate_url
+from config import BATCH_MAX_ITEMS, BATCH_EXPAND_PLAYLISTS, CONVERSATION_TIMEOUT, ADMISSION_MAX_WAIT, ADMISSION_ETA_NOTICE, EXTRACT_TIMEOUT
+from utils.validate_url import validate_url, extract_urls, is_playlist_url
 from utils.logger import logger, request_context
-from ui.keyboards import get_main_keyboard_markup, get_cancel_keyboard_markup
+from utils.tracing import span
+from core.progress import render_status
+from core.admission import estimate_from_info
+from core.jobs import withdraw_queued_job
+from ui.keyboards import get_main_keyboard_markup, get_cancel_keyboard_markup, get_job_cancel_markup
 
 # Возможные состояния
 CHOOSING_ACTION, AWAITING_LINK = range(2)
 
+# Сообщение со ссылкой
+LINK_PATTERN = r'https?://'
+
+# Сбрасывает состояние диалога, не трогая настройки пользователя (например, качество)
+def _reset_conversation_state(context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop('action_type', None)
+    context.user_data.pop('pending_link', None)
+
 # Функции-обработчики для состояний
 async def ask_for_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало диалога или возврат к выбору действия."""
@@ -29,7 +48,7 @@ async def ask_for_action(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def ask_for_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Пользователь выбрал действие (Видео/Аудио), просим ссылку."""
-    with request_context():
+    with request_context() as request_id:
         action = update.message.text
         user_id = update.effective_user.id
 
@@ -44,6 +63,11 @@ async def ask_for_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             await update.message.reply_text(USE_BUTTONS_WARN, reply_markup=get_main_keyboard_markup())
             return CHOOSING_ACTION
 
+        # Ссылку уже прислали раньше: сразу ставим задачу
+        pending_link = context.user_data.pop('pending_link', None)
+        if pending_link:
+            return await _enqueue_links(update, context, pending_link, context.user_data['action_type'], request_id)
+
         await update.message.reply_text(WAIT_FOR_LINK, reply_markup=get_cancel_keyboard_markup())
         return AWAITING_LINK
 
@@ -51,7 +75,6 @@ async def handle_link_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Пользователь отправил текст, когда бот ожидал ссылку."""
     with request_context() as request_id:
         url = update.message.text
-        chat_id = update.message.chat_id
         user_id = update.effective_user.id
         action_type = context.user_data.get('action_type')
 
@@ -59,58 +82,233 @@ async def handle_link_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if not action_type:
             logger.error(f"User {user_id} in AWAITING_LINK state without action_type.")
             await update.message.reply_text(TECHNICAL_ERROR_MESSAGE, reply_markup=get_main_keyboard_markup())
-            context.user_data.clear()
+            _reset_conversation_state(context)
             return ConversationHandler.END
 
         # Обработка кнопки "Отмена" внутри состояния ожидания ссылки
         if url == CANCEL_BUTTON_TEXT:
             logger.info(f"User {user_id} cancelled action '{action_type}'")
             await update.message.reply_text(ACTION_CANCEL, reply_markup=get_main_keyboard_markup())
-            context.user_data.clear()
+            _reset_conversation_state(context)
             return ConversationHandler.END
 
         logger.info(f"[{request_id}] Received potential link '{url}' from user {user_id} for action '{action_type}'")
+        return await _enqueue_links(update, context, url, action_type, request_id, restore_keyboard=True)
 
+async def handle_link_first(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Пользователь прислал ссылку раньше, чем выбрал видео или аудио."""
+    with request_context():
+        text = update.message.text
+        user_id = update.effective_user.id
+        logger.info(f"Received link '{text}' from user {user_id} before action selection")
+
+        items, error_message, _, _ = _collect_items(text, user_id)
+        if not items:
+            await update.message.reply_text(error_message, reply_markup=get_main_keyboard_markup())
+            return CHOOSING_ACTION
+
+        # Пока пользователь выбирает видео или аудио, информация о ссылках уже загружается
+        context.user_data['pending_link'] = text
+        prefetcher = context.bot_data.get('info_prefetcher')
+        if prefetcher:
+            for item in items:
+                if not item['playlist']:
+                    prefetcher.start(item['url'], item['platform'])
+
+        await update.message.reply_text(LINK_RECEIVED_MESSAGE, reply_markup=get_main_keyboard_markup())
+        return CHOOSING_ACTION
+
+# Достает и проверяет ссылки из сообщения.
+# Возвращает (элементы задачи, текст первой ошибки, пакетная ли задача, заметка о пропущенных ссылках)
+def _collect_items(text: str, user_id: int) -> Tuple[List[dict], Optional[str], bool, Optional[str]]:
+    # Несколько ссылок или плейлист - пакетная задача
+    urls = extract_urls(text) or [text]
+    is_batch = len(urls) > 1 or (BATCH_EXPAND_PLAYLISTS and is_playlist_url(urls[0]))
+
+    items = []
+    error_message = None
+    invalid = 0
+    for candidate in urls[:BATCH_MAX_ITEMS]:
         # Валидация ссылки
-        is_valid, error_message, platform = validate_url(url)
+        is_valid, candidate_error, platform = validate_url(candidate)
         if not is_valid:
-            logger.warning(f"Invalid URL from {user_id}: {url}. Reason: {error_message}")
-            await update.message.reply_text(error_message, reply_markup=get_cancel_keyboard_markup())
-            return AWAITING_LINK # Ждем ссылку
+            logger.warning(f"Invalid URL from {user_id}: {candidate}. Reason: {candidate_error}")
+            error_message = error_message or candidate_error
+            invalid += 1
+            continue
 
         # Валидация платформы
         supported_platforms = list(SUPPORTED_DOMAINS.values())
         if platform not in supported_platforms:
-            logger.warning(f"Unsupported platform from {user_id}: {platform} ({url})")
-            await update.message.reply_text(NOT_IMPLEMENTED_MESSAGE.format(platform or 'Unknown'), reply_markup=get_cancel_keyboard_markup())
-            return AWAITING_LINK # Ждём ссылку
+            logger.warning(f"Unsupported platform from {user_id}: {platform} ({candidate})")
+            error_message = error_message or NOT_IMPLEMENTED_MESSAGE.format(platform or 'Unknown')
+            invalid += 1
+            continue
 
-        # Ставим задачу в очередь воркера
-        try:
-            download_queue = context.bot_data['download_queue']
-            job = {
-                'chat_id': chat_id,
-                'url': url,
-                'type': action_type,
-                'platform': platform,
-                'request_id': request_id
-            }
-            await download_queue.put(job)
-            logger.info(f"Job for {url} added to queue.")
-            await update.message.reply_text(QUEUE_MESSAGE, reply_markup=get_main_keyboard_markup()) # Возвращаем основную клавиатуру
-
-        except KeyError:
-            logger.critical("Download queue not found!")
-            await update.message.reply_text(TECHNICAL_ERROR_MESSAGE, reply_markup=get_main_keyboard_markup())
-        except Exception as e:
-            logger.error(f"[{request_id}] Error adding job to queue: {e}", exc_info=True)
-            await update.message.reply_text(TECHNICAL_ERROR_MESSAGE, reply_markup=get_main_keyboard_markup())
+        items.append({
+            'url': candidate,
+            'platform': platform,
+            'playlist': BATCH_EXPAND_PLAYLISTS and is_playlist_url(candidate)
+        })
 
-        # Очищаем состояние пользователя
-        context.user_data.clear()
-        # Завершаем диалог
+    # Пользователь должен знать, какие ссылки не попали в задачу
+    skipped_notes = []
+    if items and invalid:
+        skipped_notes.append(BATCH_SKIPPED_MESSAGE.format(invalid, error_message))
+    if len(urls) > BATCH_MAX_ITEMS:
+        skipped_notes.append(BATCH_LIMIT_SKIPPED_MESSAGE.format(len(urls) - BATCH_MAX_ITEMS, BATCH_MAX_ITEMS))
+    return items, error_message, is_batch, '\n'.join(skipped_notes) or None
+
+# Ставит задачу по ссылкам из сообщения в очередь воркера и завершает диалог
+async def _enqueue_links(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    text: str,
+    action_type: str,
+    request_id: str,
+    restore_keyboard: bool = False
+) -> int:
+    chat_id = update.message.chat_id
+    user_id = update.effective_user.id
+
+    # Бот останавливается: новые задачи примет следующий экземпляр
+    if context.bot_data.get('draining'):
+        logger.info(f"Bot is draining, link from {user_id} rejected")
+        await update.message.reply_text(DRAINING_MESSAGE, reply_markup=get_main_keyboard_markup())
+        _reset_conversation_state(context)
         return ConversationHandler.END
 
+    items, error_message, is_batch, skipped_note = _collect_items(text, user_id)
+    if not items:
+        await update.message.reply_text(error_message, reply_markup=get_cancel_keyboard_markup())
+        return AWAITING_LINK # Ждем ссылку
+    url, platform = items[0]['url'], items[0]['platform']
+
+    # Ставим задачу в очередь воркера
+    try:
+        download_queue = context.bot_data['download_queue']
+        job = {
+            'chat_id': chat_id,
+            'url': url,
+            'type': action_type,
+            'platform': platform,
+            'request_id': request_id,
+            'quality': context.user_data.get('quality')
+        }
+        if is_batch:
+            job['items'] = items
+        job_registry = context.bot_data.get('job_registry')
+
+        # Оценка стоимости задачи: по ней очередь пропускает короткие задачи вперед.
+        # Если информация о ссылке уже предзагружена, учитываем длительность и размер
+        prefetcher = context.bot_data.get('info_prefetcher')
+        info = prefetcher.peek(url) if prefetcher and not is_batch else None
+        cost = estimate_from_info(job, info, playlist_size=BATCH_MAX_ITEMS)
+        job['cost'] = cost
+
+        # Контроль нагрузки: оцениваем ожидание, при перегрузке не принимаем
+        admission = context.bot_data.get('admission')
+        decision = None
+        if admission:
+            user_jobs = len(job_registry.for_user(user_id)) if job_registry else 0
+            decision = admission.check(cost, user_jobs)
+            if not decision.admitted:
+                logger.warning(f"Job rejected ({decision.reason}): cost {cost:.0f}, eta {decision.eta:.0f}s, user jobs {user_jobs}")
+                if decision.reason == 'user_limit':
+                    reject_message = TOO_MANY_JOBS_MESSAGE.format(user_jobs)
+                else:
+                    reject_message = QUEUE_BUSY_MESSAGE.format(math.ceil(ADMISSION_MAX_WAIT / 60))
+                await update.message.reply_text(reject_message, reply_markup=get_main_keyboard_markup())
+                _reset_conversation_state(context)
+                return ConversationHandler.END
+
+        # Очередь ограничена: при переполнении задачу не ставим
+        try:
+            job['enqueued_at_ns'] = time.time_ns()
+            with span('enqueue', type=action_type, platform=platform, links=len(items)):
+                download_queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logger.warning(f"Download queue is full ({download_queue.qsize()}), job rejected")
+            await update.message.reply_text(
+                QUEUE_BUSY_MESSAGE.format(math.ceil(ADMISSION_MAX_WAIT / 60)),
+                reply_markup=get_main_keyboard_markup()
+            )
+            _reset_conversation_state(context)
+            return ConversationHandler.END
+        # Регистрируем задачу, чтобы её можно было отменить
+        handle = job_registry.register(request_id, chat_id, user_id) if job_registry else None
+        if decision:
+            admission.admit(request_id, decision.cost)
+        if prefetcher and not is_batch:
+            # Предзагруженная информация нужна загрузке, пока задача ждет в очереди
+            prefetcher.pin(url)
+            # Длительность еще неизвестна: уточняем место задачи в очереди в фоне
+            if not info:
+                _start_background_task(context.bot_data, _refine_job_cost(context.bot_data, job), request_id)
+
+        logger.info(f"Job for {url} added to queue ({len(items)} link(s)).")
+        queue_message = BATCH_QUEUE_MESSAGE.format(len(items)) if is_batch else QUEUE_MESSAGE
+        if decision and decision.eta >= ADMISSION_ETA_NOTICE:
+            queue_message = QUEUE_ETA_MESSAGE.format(math.ceil(decision.eta / 60))
+        if skipped_note:
+            queue_message = f"{queue_message}\n{skipped_note}"
+        if not handle:
+            await update.message.reply_text(queue_message, reply_markup=get_main_keyboard_markup()) # Возвращаем основную клавиатуру
+        else:
+            # Одно сообщение о задаче: статус с inline кнопкой отмены.
+            # Воркер потом редактирует его: место в очереди, процент загрузки, отправка.
+            # У сообщения может быть только одна клавиатура, поэтому если вместо основной
+            # показана клавиатура отмены, основную возвращает отдельное сообщение
+            status_text = render_status({'stage': 'queued'}, download_queue.position(request_id) or download_queue.qsize())
+            if restore_keyboard:
+                await update.message.reply_text(queue_message, reply_markup=get_main_keyboard_markup())
+            else:
+                status_text = f"{queue_message}\n{status_text}"
+            status_message = await update.message.reply_text(status_text, reply_markup=get_job_cancel_markup(request_id))
+            handle.status_message_id = status_message.message_id
+
+    except KeyError:
+        logger.critical("Download queue not found!")
+        await update.message.reply_text(TECHNICAL_ERROR_MESSAGE, reply_markup=get_main_keyboard_markup())
+    except Exception as e:
+        logger.error(f"[{request_id}] Error adding job to queue: {e}", exc_info=True)
+        await update.message.reply_text(TECHNICAL_ERROR_MESSAGE, reply_markup=get_main_keyboard_markup())
+
+    # Очищаем состояние пользователя
+    _reset_conversation_state(context)
+    # Завершаем диалог
+    return ConversationHandler.END
+
+# Запускает фоновую задачу обработчика и держит на нее ссылку в bot_data, пока она не закончится
+# (иначе сборщик мусора может удалить её на середине). Ошибки задачи пишутся в лог
+def _start_background_task(bot_data: dict, coro, request_id: str):
+    tasks = bot_data.setdefault('background_tasks', set())
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+
+    def _done(finished: asyncio.Task):
+        tasks.discard(finished)
+        if not finished.cancelled() and finished.exception():
+            logger.warning(f"[{request_id}] Background task failed: {finished.exception()!r}")
+
+    task.add_done_callback(_done)
+    return task
+
+# Уточняет оценку задачи по длительности и размеру медиа: из идущей предзагрузки, если она есть,
+# иначе по дешевой оценке без полной обработки yt-dlp
+async def _refine_job_cost(bot_data: dict, job: dict):
+    prefetcher = bot_data['info_prefetcher']
+    info = await prefetcher.wait(job['url'], timeout=EXTRACT_TIMEOUT)
+    if not info:
+        info = await prefetcher.probe(job['url'], job['platform'], timeout=EXTRACT_TIMEOUT)
+    if not info:
+        return
+    cost = estimate_from_info(job, info)
+    if bot_data['download_queue'].update_cost(job['request_id'], cost):
+        logger.info(f"[{job['request_id']}] Job cost refined: {cost:.0f} (duration {info.get('duration')})")
+        if bot_data.get('admission'):
+            bot_data['admission'].update(job['request_id'], cost)
+
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка команды /cancel во время диалога."""
     with request_context():
@@ -122,11 +320,35 @@ async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE
         if action:
             log_msg += f" during action '{action}'"
         else:
-            log_msg += " without an active action selection."
-            reply_text = ACTION_EMPTY
+            # Вне диалога /cancel отменяет задачи пользователя в очереди и в работе
+            job_registry = context.bot_data.get('job_registry')
+            status_reporter = context.bot_data.get('status_reporter')
+            cancelled = [
+                handle for handle in (job_registry.for_user(user_id) if job_registry else [])
+                if job_registry.cancel(handle.request_id)
+            ]
+            # Задачи из очереди убираем сразу. В статусных сообщениях - текст об отмене,
+            # который прогресс задачи уже не перезапишет
+            for handle in cancelled:
+                withdrawn = handle.status == 'queued' and withdraw_queued_job(context.bot_data, handle.request_id)
+                if not status_reporter or not handle.status_message_id:
+                    continue
+                status_reporter.finalize(handle.chat_id, handle.status_message_id)
+                try:
+                    await context.bot.edit_message_text(JOB_CANCELLED_MESSAGE, chat_id=handle.chat_id, message_id=handle.status_message_id)
+                except Exception as e:
+                    logger.debug(f"Failed to mark status message {handle.status_message_id} as cancelled: {e}")
+                if withdrawn:
+                    await status_reporter.close(handle.chat_id, handle.status_message_id, delete=False)
+            if cancelled:
+                log_msg += f" and cancelled {len(cancelled)} job(s)."
+                reply_text = JOBS_CANCELLED_MESSAGE.format(len(cancelled))
+            else:
+                log_msg += " without an active action selection."
+                reply_text = ACTION_EMPTY
 
         logger.info(log_msg)
-        context.user_data.clear()
+        _reset_conversation_state(context)
         await update.message.reply_text(reply_text, reply_markup=get_main_keyboard_markup())
         return ConversationHandler.END
 
@@ -151,11 +373,14 @@ def get_conversation_handler() -> ConversationHandler:
             CommandHandler('start', ask_for_action),
             CommandHandler('help', ask_for_action),
             # Нажатие кнопок Видео/Аудио начинает диалог, если он не активен
-            MessageHandler(filters.Regex(f'^({VIDEO_BUTTON_TEXT}|{AUDIO_BUTTON_TEXT})$'), ask_for_link)
+            MessageHandler(filters.Regex(f'^({VIDEO_BUTTON_TEXT}|{AUDIO_BUTTON_TEXT})$'), ask_for_link),
+            # Ссылка без выбранного действия: спросим видео или аудио, а пока начнем разбирать ссылку
+            MessageHandler(filters.Regex(LINK_PATTERN) & ~filters.COMMAND, handle_link_first)
         ],
         states={
             CHOOSING_ACTION: [
                 MessageHandler(filters.Regex(f'^({VIDEO_BUTTON_TEXT}|{AUDIO_BUTTON_TEXT})$'), ask_for_link),
+                MessageHandler(filters.Regex(LINK_PATTERN) & ~filters.COMMAND, handle_link_first),
                 # Можно добавить обработку других кнопок/текста на этом этапе, если нужно
             ],
             AWAITING_LINK: [
@@ -171,7 +396,10 @@ def get_conversation_handler() -> ConversationHandler:
             # Ловит вообще все остальное
             MessageHandler(filters.ALL, unexpected_input_in_conversation),
         ],
-        # Может понадобиться для отладки
-        # persistent=True, name="download_conversation"
+        # Состояние диалога сохраняется в хранилище и переживает перезапуск бота
+        persistent=True,
+        name="download_conversation",
+        # Брошенный диалог сбрасывается, чтобы не копить состояния
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
     return conv_handler
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from typing import List
+from telegram import (
+    Update,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedAudio,
+    InlineQueryResultCachedVideo,
+    InlineQueryResultsButton,
+    InputTextMessageContent
+)
+from telegram.ext import ContextTypes
+from config import INLINE_DEBOUNCE, INLINE_CACHE_TIME
+from core.file_id_cache import FileIdCache, make_cache_key
+from core.admission import estimate_job_cost
+from utils.validate_url import validate_url, extract_urls
+from utils.logger import logger, request_context
+from utils.constants import (
+    INLINE_VIDEO_TITLE,
+    INLINE_DEFAULT_TITLE,
+    INLINE_PROCESSING_TITLE,
+    INLINE_PROCESSING_DESCRIPTION,
+    INLINE_START_BUTTON_TEXT,
+    INLINE_BUSY_TITLE
+)
+
+# Результаты inline запроса из кеша file_id: видео и/или аудио
+def _cached_results(file_id_cache: FileIdCache, url: str) -> List:
+    results = []
+    video = file_id_cache.get(make_cache_key(url, 'video'))
+    if video:
+        results.append(InlineQueryResultCachedVideo(
+            id='video',
+            video_file_id=video.file_id,
+            title=INLINE_VIDEO_TITLE.format(video.title or INLINE_DEFAULT_TITLE)
+        ))
+    audio = file_id_cache.get(make_cache_key(url, 'audio'))
+    if audio:
+        # У закешированного аудио телеграм не принимает заголовок: в выдаче показываются исполнитель и название из файла
+        results.append(InlineQueryResultCachedAudio(id='audio', audio_file_id=audio.file_id))
+    return results
+
+# Ставит фоновую задачу в очередь с учетом контроля нагрузки. Возвращает False, если задача не принята
+def _admit(context: ContextTypes.DEFAULT_TYPE, job: dict, user_id: int) -> bool:
+    if context.bot_data.get('draining'):
+        return False
+    admission = context.bot_data.get('admission')
+    job_registry = context.bot_data.get('job_registry')
+    cost = estimate_job_cost(job)
+    job['cost'] = cost
+    job['enqueued_at_ns'] = time.time_ns()
+    if admission:
+        user_jobs = len(job_registry.for_user(user_id)) if job_registry else 0
+        if not admission.check(cost, user_jobs).admitted:
+            return False
+    try:
+        context.bot_data['download_queue'].put_nowait(job)
+    except asyncio.QueueFull:
+        return False
+    # Регистрируем задачу, чтобы она учитывалась в лимите пользователя и отменялась через /cancel
+    if job_registry:
+        job_registry.register(job['request_id'], job['chat_id'], user_id)
+    if admission:
+        admission.admit(job['request_id'], cost)
+    return True
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Inline запрос "@bot ссылка" из любого чата."""
+    query = update.inline_query
+    urls = extract_urls(query.query)
+    if not urls:
+        return
+    url = urls[0]
+    is_valid, _, platform = validate_url(url)
+    if not is_valid:
+        return
+
+    # Быстрый путь: файл уже загружался, отвечаем без ожидания
+    file_id_cache: FileIdCache = context.bot_data['file_id_cache']
+    results = _cached_results(file_id_cache, url)
+    if results:
+        await query.answer(results, cache_time=INLINE_CACHE_TIME)
+        return
+
+    # Пока пользователь печатает, телеграм шлет запрос на каждый символ.
+    # Обрабатываем только последний запрос пользователя после паузы
+    latest_queries = context.bot_data.setdefault('inline_latest_queries', {})
+    user_id = query.from_user.id
+    latest_queries[user_id] = query.id
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    if latest_queries.get(user_id) != query.id:
+        return
+    latest_queries.pop(user_id, None)
+
+    with request_context() as request_id:
+        # Загрузка в фоне: файл уйдет в личный чат с ботом, а его file_id попадет в кеш
+        cache_key = make_cache_key(url, 'video')
+        title, description = INLINE_PROCESSING_TITLE, INLINE_PROCESSING_DESCRIPTION
+        if cache_key and file_id_cache.mark_pending(cache_key):
+            job = {
+                'chat_id': user_id,
+                'url': url,
+                'type': 'video',
+                'platform': platform,
+                'request_id': request_id,
+                'quality': context.user_data.get('quality') if context.user_data is not None else None
+            }
+            if _admit(context, job, user_id):
+                logger.info(f"Inline query from user {user_id}: {url} queued for background download")
+            else:
+                file_id_cache.discard_pending(cache_key)
+                title, description = INLINE_BUSY_TITLE, None
+                logger.warning(f"Inline query from user {user_id}: {url} rejected, bot is busy")
+        else:
+            logger.info(f"Inline query from user {user_id}: {url} is already downloading")
+
+        await query.answer(
+            [InlineQueryResultArticle(
+                id='processing',
+                title=title,
+                description=description,
+                input_message_content=InputTextMessageContent(url)
+            )],
+            cache_time=0,
+            is_personal=True,
+            # Бот не может написать тому, кто его еще не запускал
+            button=InlineQueryResultsButton(text=INLINE_START_BUTTON_TEXT, start_parameter='inline')
+        )
@@ -0,0 +1,39 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from core.jobs import withdraw_queued_job
+from utils.logger import logger, request_context
+from utils.constants import (
+    CANCEL_JOB_CALLBACK_PREFIX,
+    JOB_CANCELLED_MESSAGE,
+    JOB_ALREADY_FINISHED_MESSAGE
+)
+
+async def cancel_job_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Нажатие inline кнопки отмены задачи."""
+    query = update.callback_query
+    request_id = query.data[len(CANCEL_JOB_CALLBACK_PREFIX):]
+
+    with request_context(request_id):
+        job_registry = context.bot_data.get('job_registry')
+        handle = job_registry.get(request_id) if job_registry else None
+
+        # Отменять задачу может только тот, кто её поставил
+        if not handle or handle.user_id != query.from_user.id or not job_registry.cancel(request_id):
+            logger.info(f"User {query.from_user.id} tried to cancel inactive job")
+            await query.answer(JOB_ALREADY_FINISHED_MESSAGE)
+            await query.edit_message_reply_markup(reply_markup=None)
+            return
+
+        logger.info(f"User {query.from_user.id} cancelled job ({handle.status})")
+        # Задача еще в очереди: убираем её сразу, не дожидаясь воркера
+        withdrawn = handle.status == 'queued' and withdraw_queued_job(context.bot_data, request_id)
+        await query.answer()
+        # Прогресс задачи больше не должен перезаписывать текст об отмене
+        status_reporter = context.bot_data.get('status_reporter')
+        message = query.message
+        if status_reporter:
+            status_reporter.finalize(message.chat_id, message.message_id)
+        await query.edit_message_text(JOB_CANCELLED_MESSAGE)
+        # Снятую задачу воркер не увидит, сообщение закрываем сами
+        if status_reporter and withdrawn:
+            await status_reporter.close(message.chat_id, message.message_id, delete=False)
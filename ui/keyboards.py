@@ -1,10 +1,12 @@
 from typing import Union
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import Application
 from utils.constants import (
     VIDEO_BUTTON_TEXT,
     AUDIO_BUTTON_TEXT,
-    CANCEL_BUTTON_TEXT
+    CANCEL_BUTTON_TEXT,
+    JOB_CANCEL_BUTTON_TEXT,
+    CANCEL_JOB_CALLBACK_PREFIX
 )
 
 # Создает разметку основной клавиатуры.
@@ -17,6 +19,11 @@ def get_cancel_keyboard_markup() -> ReplyKeyboardMarkup:
     keyboard = [[KeyboardButton(CANCEL_BUTTON_TEXT)]]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
 
+# Создает inline кнопку отмены задачи в очереди
+def get_job_cancel_markup(request_id: str) -> InlineKeyboardMarkup:
+    button = InlineKeyboardButton(JOB_CANCEL_BUTTON_TEXT, callback_data=f"{CANCEL_JOB_CALLBACK_PREFIX}{request_id}")
+    return InlineKeyboardMarkup([[button]])
+
 # Отправляет сообщение с основной клавиатурой
 async def send_main_keyboard(app_or_update: Union[Application, Update], chat_id: int, text: str):
     markup = get_main_keyboard_markup()
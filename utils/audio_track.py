@@ -0,0 +1,142 @@
+import asyncio
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+from utils.logger import logger
+
+# Контейнер для аудио дорожки по кодеку. Телеграм проигрывает как аудио только MP3 и M4A,
+# дорожки в других кодеках без перекодирования не вытащить - для них качаем аудио как обычно
+AUDIO_CONTAINERS = {
+    'aac': 'm4a',
+    'mp3': 'mp3',
+}
+FFMPEG_TIMEOUT = 120
+# Как часто проверять список готовых частей при нарезке (секунды)
+SPLIT_POLL_INTERVAL = 0.5
+
+async def _run(*args: str) -> tuple:
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), FFMPEG_TIMEOUT)
+    finally:
+        # Таймаут или отмена задачи: процесс не должен остаться висеть
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    return process.returncode, stdout.decode(errors='replace').strip(), stderr.decode(errors='replace').strip()
+
+# Кодек первой аудио дорожки файла или None, если дорожки нет
+async def probe_audio_codec(filepath: str) -> Optional[str]:
+    code, stdout, stderr = await _run(
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'a:0',
+        '-show_entries', 'stream=codec_name',
+        '-of', 'csv=p=0',
+        filepath
+    )
+    if code != 0:
+        logger.warning(f"ffprobe failed for {filepath}: {stderr}")
+        return None
+    return stdout.splitlines()[0].strip() if stdout else None
+
+# Вынимает аудио дорожку из уже скачанного видео без перекодирования (-c:a copy).
+# Возвращает путь к аудио файлу в target_dir или None, если дорожку так не получить
+async def extract_audio_track(video_path: str, target_dir: Path, prefix: str) -> Optional[str]:
+    try:
+        codec = await probe_audio_codec(video_path)
+        container = AUDIO_CONTAINERS.get(codec)
+        if not container:
+            logger.info(f"Audio codec {codec} of {video_path} can't be sent as is, skipping local extraction")
+            return None
+
+        target = target_dir / f"{prefix}_{uuid.uuid4().hex[:8]}.{container}"
+        code, _, stderr = await _run(
+            'ffmpeg', '-nostdin', '-v', 'error', '-y',
+            '-i', video_path,
+            '-map', '0:a:0', '-vn', '-c:a', 'copy',
+            # moov в начале, чтобы m4a проигрывался до полной загрузки
+            *(['-movflags', '+faststart'] if container == 'm4a' else []),
+            str(target)
+        )
+        if code != 0:
+            logger.warning(f"ffmpeg failed to extract audio from {video_path}: {stderr}")
+            target.unlink(missing_ok=True)
+            return None
+        return str(target)
+    except Exception as e:
+        # ffmpeg не найден, таймаут, файл пропал - просто качаем аудио по сети
+        logger.warning(f"Local audio extraction from {video_path} failed: {e}")
+        return None
+
+# Читает список готовых частей (csv сегментного муксера: имя,начало,конец).
+# ffmpeg дописывает список, пока мы его читаем: недописанная последняя строка пропускается
+# и будет прочитана на следующей проверке
+def _read_segment_list(list_path: Path) -> List[Tuple[str, float, float]]:
+    try:
+        with open(list_path, encoding='utf-8') as list_file:
+            lines = list_file.readlines()
+    except FileNotFoundError:
+        return []
+    segments = []
+    for line in lines:
+        if not line.endswith('\n'):
+            break
+        row = line.strip().rsplit(',', 2)
+        try:
+            name, start, end = row
+            segments.append((name, float(start), float(end)))
+        except ValueError:
+            continue
+    return segments
+
+# Режет аудио на части по part_seconds секунд сегментным муксером ffmpeg без перекодирования (-c copy),
+# разрезы приходятся на границы фреймов. Отдает (путь, длительность) каждой части, как только
+# ffmpeg её закрыл и записал в список частей, поэтому первую часть можно отправлять, пока режутся остальные.
+# Неотданные части удаляются, отданные удаляет вызывающий
+async def split_audio(filepath: str, part_seconds: float, target_dir: Path, prefix: str) -> AsyncIterator[Tuple[str, float]]:
+    ext = Path(filepath).suffix.lstrip('.') or 'mp3'
+    list_path = target_dir / f"{prefix}_parts.csv"
+    args = [
+        'ffmpeg', '-nostdin', '-v', 'error', '-y',
+        '-i', filepath,
+        '-map', '0:a:0', '-c', 'copy',
+        '-f', 'segment',
+        '-segment_time', f"{part_seconds:.0f}",
+        '-reset_timestamps', '1',
+        '-segment_list', str(list_path),
+        '-segment_list_type', 'csv',
+    ]
+    if ext == 'm4a':
+        args += ['-segment_format', 'ipod', '-segment_format_options', 'movflags=+faststart']
+    args.append(str(target_dir / f"{prefix}_part%03d.{ext}"))
+
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    yielded = set()
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(process.wait(), SPLIT_POLL_INTERVAL)
+                finished = True
+            except asyncio.TimeoutError:
+                finished = False
+            for name, start, end in _read_segment_list(list_path):
+                if name not in yielded:
+                    yielded.add(name)
+                    yield str(target_dir / name), end - start
+            if finished:
+                break
+        if process.returncode != 0:
+            stderr = (await process.stderr.read()).decode(errors='replace').strip()
+            raise RuntimeError(f"ffmpeg failed to split {filepath}: {stderr}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        list_path.unlink(missing_ok=True)
+        for leftover in target_dir.glob(f"{prefix}_part*.{ext}"):
+            if leftover.name not in yielded:
+                leftover.unlink(missing_ok=True)
@@ -8,9 +8,12 @@ HELP_MESSAGE = """
 Привет! Я могу помочь тебе скачать видео или аудио из YouTube, Twitter и Instagram.
 
 Просто нажми на нужную кнопку и следом отправь мне ссылку.
+Или сначала отправь ссылку, а потом выбери видео или аудио.
 Например: https://www.youtube.com/watch?v=dQw4w9WgXcQ
 
 Пожалуйста, учти ограничения Telegram на размер файла (~49MB). Я постараюсь выбрать наилучшее качество в рамках этого лимита.
+Качество видео можно ограничить командой /quality.
+В любом чате можно написать @имя_бота и ссылку, чтобы сразу отправить уже загруженное видео.
 """
 
 FILE_TOO_LARGE_MESSAGE = "☹️ Ошибка: Файл слишком большой ({}) для отправки через Telegram (лимит ~49MB)."
@@ -23,6 +26,7 @@ QUEUE_MESSAGE = "⏳ Загружаю, пожалуйста подожди"
 ACTION_CANCEL="☝️Действие отменено"
 ACTION_EMPTY="👇 Нечего отменять"
 WAIT_FOR_LINK="🔗 Отправь ссылку в чат"
+LINK_RECEIVED_MESSAGE = "🔗 Ссылку получил. Что скачать: видео или аудио?"
 
 USE_BUTTONS_WARN = "⚠️ Пожалуйста, используй кнопки."
 NOT_IMPLEMENTED_MESSAGE = "☹️ Скачивание с платформы {} пока не поддерживается."
@@ -38,3 +42,62 @@ SUPPORTED_DOMAINS = {
     'x.com': 'Twitter',
     'instagram.com': 'Instagram'
 }
+
+QUALITY_CURRENT_MESSAGE = """🎚 Текущее качество видео: {}
+
+Доступные варианты: {}
+Например: /quality 480p
+
+В часы пик бот может временно понижать качество, чтобы быстрее обработать очередь."""
+QUALITY_SET_MESSAGE = "🎚 Качество видео установлено: {}"
+QUALITY_UNKNOWN_MESSAGE = "☹️ Неизвестное качество. Доступные варианты: {}"
+
+JOB_CANCEL_BUTTON_TEXT = "Отменить ✖️"
+JOB_CANCELLED_MESSAGE = "🚫 Задача отменена"
+JOB_ALREADY_FINISHED_MESSAGE = "Задача уже завершена"
+JOB_TIMEOUT_MESSAGE = "☹️ Ошибка: Загрузка заняла слишком много времени и была остановлена. Попробуй позже."
+JOBS_CANCELLED_MESSAGE = "🚫 Отменено задач: {}"
+
+# Префикс callback_data кнопки отмены задачи
+CANCEL_JOB_CALLBACK_PREFIX = "cancel_job:"
+
+# Статусы задачи в сообщении о прогрессе
+STATUS_QUEUED_MESSAGE = "🕓 В очереди: {} место. Задачу можно отменить кнопкой ниже."
+STATUS_EXTRACT_MESSAGE = "🔎 Получаю информацию о медиа..."
+STATUS_DOWNLOAD_MESSAGE = "⬇️ Загрузка: {}"
+STATUS_POSTPROCESS_MESSAGE = "⚙️ Обработка файла..."
+STATUS_UPLOAD_MESSAGE = "⬆️ Отправляю файл..."
+STATUS_RESTART_MESSAGE = "🔄 Бот перезапускается. Задача сохранена и продолжится сразу после перезапуска."
+
+BATCH_QUEUE_MESSAGE = "⏳ Принял ссылок: {}. Загружаю, пожалуйста подожди"
+BATCH_PARTIAL_MESSAGE = "☹️ Удалось скачать {} из {} файлов."
+BATCH_SKIPPED_MESSAGE = "⚠️ Пропустил ссылок: {}. Первая причина: {}"
+BATCH_LIMIT_SKIPPED_MESSAGE = "⚠️ Пропустил ссылок: {} (за один раз можно не больше {})"
+BATCH_STATUS_PREFIX = "📦 {} из {}\n"
+
+# Inline режим (@bot ссылка в любом чате)
+INLINE_VIDEO_TITLE = "🎬 {}"
+INLINE_DEFAULT_TITLE = "Отправить"
+INLINE_PROCESSING_TITLE = "⏳ Загружаю, повтори запрос через минуту"
+INLINE_PROCESSING_DESCRIPTION = "Файла еще нет в кеше. Как только загрузка закончится, он появится здесь"
+INLINE_START_BUTTON_TEXT = "Открыть бота"
+
+# Контроль нагрузки
+QUEUE_ETA_MESSAGE = "⏳ Загружаю, пожалуйста подожди. Сейчас много задач, будет готово примерно через {} мин."
+QUEUE_BUSY_MESSAGE = "😮‍💨 Сейчас слишком много задач (ожидание больше {} мин). Попробуй позже."
+TOO_MANY_JOBS_MESSAGE = "✋ У тебя уже есть задач в работе: {}. Дождись их завершения или отмени командой /cancel."
+INLINE_BUSY_TITLE = "😮‍💨 Сейчас слишком много задач, попробуй позже"
+# Бот останавливается и новые ссылки не принимает
+DRAINING_MESSAGE = "🔄 Бот перезапускается. Пришли ссылку еще раз через минуту."
+
+# Отчет о памяти для администратора (/memory)
+MEMORY_REPORT_MESSAGE = """🧠 Память
+Основной процесс: {}
+Процессы пула: {}
+Перезапусков пула: {}
+tracemalloc: {}"""
+MEMORY_TRACE_STARTED_MESSAGE = "🧠 tracemalloc включен. Повтори /memory snapshot позже, чтобы увидеть рост памяти."
+MEMORY_SNAPSHOT_MESSAGE = "🧠 Рост памяти с прошлого снимка:\n{}"
+MEMORY_TRACE_STOPPED_MESSAGE = "🧠 tracemalloc выключен"
+
+AUDIO_PARTS_MESSAGE = "🎧 Аудио длинное, отправлю его частями: {}"
@@ -1,20 +1,170 @@
 import asyncio
 import functools
 import os
+import shutil
+import threading
+import time
 import yt_dlp
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Tuple, Dict
-from utils.logger import logger
+from typing import Awaitable, Dict, List, NamedTuple, Optional, Tuple
+from config import (
+    FRAGMENT_CONCURRENCY, MAX_FRAGMENT_CONNECTIONS, EXTERNAL_DOWNLOADER,
+    EXTRACT_TIMEOUT, DOWNLOAD_TIMEOUT, POSTPROCESS_TIMEOUT, STALL_TIMEOUT, YDL_CACHE_DIR, AUDIO_MAX_PARTS
+)
+from utils.logger import logger, request_id_var
+from utils.tracing import span, PostprocessorSpans
+from utils.ydl_pool import ydl_pool
+from utils.job_control import JobControl, JobCancelledError
+from utils.format_selector import FormatChoice, get_quality_tier, is_single_file_fallback, select_format
+from utils.media_metadata import MediaMetadata, collect_metadata
 
 class DownloadError(Exception):
     pass
 
+# Битрейт mp3 для аудио задач (кбит/с)
+AUDIO_BITRATE_KBPS = 128
+
+# Поля info dict, которые не нужны ни боту, ни yt-dlp для загрузки без субтитров.
+# У YouTube это самая тяжелая часть: субтитры на сотне языков в нескольких форматах каждый.
+# description остается: у Instagram это запасной заголовок
+UNUSED_INFO_FIELDS = (
+    'automatic_captions', 'subtitles', 'requested_subtitles', 'heatmap', 'chapters',
+    'comments', 'tags', 'categories', 'storyboards',
+)
+
+# Поля, которые нужны от дешевой оценки медиа (probe_info)
+PROBE_FIELDS = ('id', 'title', 'duration', 'filesize', 'filesize_approx')
+
+# Убирает из info dict одного видео неиспользуемые поля (на месте) и возвращает его
+def slim_info(info: dict) -> dict:
+    if isinstance(info, dict) and info.get('_type', 'video') == 'video':
+        for field in UNUSED_INFO_FIELDS:
+            info.pop(field, None)
+    return info
+
+# Результат загрузки. Маленькая сериализуемая запись вместо объектов yt-dlp,
+# чтобы её можно было вернуть из дочернего процесса пула
+class DownloadResult(NamedTuple):
+    filepath: str
+    title: str
+    # Метаданные для отправки (см. MediaMetadata)
+    duration: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    thumbnail: Optional[str] = None
+    # Файл выдан из локального кеша, а не скачан заново
+    from_cache: bool = False
+
+# Общая сессия нескольких загрузок (например, пакетной задачи): одна cookie jar на всех.
+# Также задает исходящий адрес задачи: прокси или локальный адрес источника.
+# audio_parts - длинное аудио можно отправить частями (в альбом пакета части не вставить)
+class DownloadSession(NamedTuple):
+    cookiefile: Optional[str] = None
+    proxy: Optional[str] = None
+    source_address: Optional[str] = None
+    audio_parts: bool = True
+
+    # Опции yt-dlp, которые задает сессия
+    def ydl_options(self) -> Dict:
+        options = {}
+        if self.cookiefile:
+            options['cookiefile'] = self.cookiefile
+        if self.proxy:
+            options['proxy'] = self.proxy
+        if self.source_address:
+            options['source_address'] = self.source_address
+        return options
+
+# Профиль загрузчика: сколько фрагментов DASH/HLS качать параллельно в одной задаче
+# и каким внешним загрузчиком пользоваться (None - встроенный загрузчик yt-dlp)
+class DownloaderProfile(NamedTuple):
+    concurrent_fragments: int = FRAGMENT_CONCURRENCY
+    external_downloader: Optional[str] = EXTERNAL_DOWNLOADER or None
+
+# Общий на процесс бюджет соединений для фрагментных загрузок.
+# Не дает одной задаче занять всю полосу: задача получает не больше свободных соединений,
+# а если свободных нет - ждет, пока освободится хотя бы одно
+class ConnectionBudget:
+    def __init__(self, total: int):
+        self.total = max(1, total)
+        self._available = self.total
+        self._condition = threading.Condition()
+
+    # Меняет общий лимит (например, при делении бюджета между процессами пула)
+    def resize(self, total: int):
+        with self._condition:
+            total = max(1, total)
+            self._available += total - self.total
+            self.total = total
+            self._condition.notify_all()
+
+    # Выдает от 1 до wanted соединений, блокируя поток пока нет ни одного свободного
+    def acquire(self, wanted: int) -> int:
+        with self._condition:
+            while self._available < 1:
+                self._condition.wait()
+            granted = max(1, min(wanted, self._available))
+            self._available -= granted
+            return granted
+
+    def release(self, granted: int):
+        with self._condition:
+            self._available += granted
+            self._condition.notify_all()
+
+connection_budget = ConnectionBudget(MAX_FRAGMENT_CONNECTIONS)
+
+# Замер склейки дорожек постпроцессором Merger: время и размер итогового файла
+class MergeStats:
+    def __init__(self):
+        self.started_at: Optional[float] = None
+        self.seconds: Optional[float] = None
+        self.output_bytes: Optional[int] = None
+
+    # Хук постпроцессоров yt-dlp
+    def hook(self, d: dict):
+        if d.get('postprocessor') != 'Merger':
+            return
+        if d.get('status') == 'started':
+            self.started_at = time.monotonic()
+        elif d.get('status') == 'finished' and self.started_at is not None:
+            self.seconds = time.monotonic() - self.started_at
+            filepath = (d.get('info_dict') or {}).get('filepath')
+            if filepath and os.path.exists(filepath):
+                self.output_bytes = os.path.getsize(filepath)
+
+# Удаляет превью, собранное для неудавшейся загрузки
+def _discard_thumbnail(task: asyncio.Future):
+    if task.cancelled() or task.exception():
+        return
+    thumbnail = task.result().thumbnail
+    if thumbnail:
+        Path(thumbnail).unlink(missing_ok=True)
+
 class BaseDownloader(ABC):
-    def __init__(self, temp_dir: Path = Path('temp')):
+    # Функция выбора формата, общая для всех платформ. Можно подменить на свою с той же сигнатурой
+    format_selector = staticmethod(select_format)
+
+    # Таймауты стадий задачи (секунды)
+    STAGE_TIMEOUTS = {
+        'extract': EXTRACT_TIMEOUT,
+        'download': DOWNLOAD_TIMEOUT,
+        'postprocess': POSTPROCESS_TIMEOUT,
+    }
+
+    def __init__(self, temp_dir: Path = Path('temp'), profile: Optional[DownloaderProfile] = None):
         self.temp_dir = temp_dir
         self.temp_dir.mkdir(exist_ok=True) # на всякий случай создаем директорию
         self.MAX_FILE_SIZE_BYTES = 49 * 1024 * 1024 # 49 MB (лимит телеграма 50mb)
+        # Аудио больше лимита не выбрасывается, а отправляется частями
+        self.MAX_AUDIO_SIZE_BYTES = self.MAX_FILE_SIZE_BYTES * max(1, AUDIO_MAX_PARTS)
+        self.profile = profile or DownloaderProfile()
+
+        # Внешний загрузчик используем только если он реально установлен
+        if self.profile.external_downloader and not shutil.which(self.profile.external_downloader):
+            logger.warning(f"External downloader '{self.profile.external_downloader}' not found, using yt-dlp native downloader")
+            self.profile = self.profile._replace(external_downloader=None)
 
     # Вспомогательный метод для запуска синхронных функций в отдельном потоке
     async def _run_sync(self, func, *args, **kwargs):
@@ -22,25 +172,105 @@ class BaseDownloader(ABC):
         partial_func = functools.partial(func, *args, **kwargs)
         return await loop.run_in_executor(None, partial_func)
 
+    # Запускает синхронную стадию в потоке и следит за ней:
+    # отмена пользователем, общий таймаут стадии и отсутствие данных дольше STALL_TIMEOUT.
+    # Поток yt-dlp нельзя убить, поэтому при срабатывании выставляется флаг отмены,
+    # и хук прогресса прерывает загрузку при следующем вызове (а socket_timeout - зависший сокет)
+    async def _run_stage(self, func, control: Optional[JobControl]):
+        future = asyncio.ensure_future(self._run_sync(func))
+        # Результат брошенного потока никому не нужен, но исключение нужно забрать
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if control is None:
+            return await future
+
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=1.0)
+            if future in done:
+                return future.result()
+
+            control.check()
+            stage = control.stage
+            timeout = self.STAGE_TIMEOUTS.get(stage)
+            if timeout and control.stage_elapsed() > timeout:
+                control.cancel()
+                raise DownloadError(f"Stage '{stage}' timed out after {timeout:.0f}s")
+            if stage == 'download' and control.idle_for() > STALL_TIMEOUT:
+                control.cancel()
+                raise DownloadError(f"Download stalled: no data for {STALL_TIMEOUT:.0f}s")
+
     # Асинхронно получает информацию о медиафайле с помощью yt-dlp.
-    async def _get_info(self, url: str, options: Dict = None) -> dict:
-        ydl_opts = {'quiet': True, 'no_warnings': True, **(options or {})}
+    async def _get_info(
+        self,
+        url: str,
+        options: Dict = None,
+        control: Optional[JobControl] = None,
+        session: Optional[DownloadSession] = None,
+        process: bool = True
+    ) -> dict:
+        if control:
+            control.check()
+            control.set_stage('extract')
 
         def extract_info_sync():
             # Эта функция будет выполняться в другом потоке
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            with ydl_pool.session(type(self).__name__, self._session_params(session), options or {}) as ydl:
                 try:
-                    return ydl.extract_info(url, download=False)
+                    return ydl.extract_info(url, download=False, process=process)
                 except yt_dlp.utils.DownloadError as e:
                     # Преобразуем ошибку yt-dlp в нашу ошибку
                     raise DownloadError(f"yt-dlp info extraction failed: {e}")
                 except Exception as e:
                      raise DownloadError(f"Unexpected error during info extraction: {e}")
 
-        return await self._run_sync(extract_info_sync)
+        with span('extract', downloader=type(self).__name__):
+            return slim_info(await self._run_stage(extract_info_sync, control))
+
+    # Общие параметры экземпляров YoutubeDL: к ним добавляются опции вызова
+    # (для извлечения - флаги вроде extract_flat, для загрузки - формат, шаблон имени, постпроцессоры)
+    def _session_params(self, session: Optional[DownloadSession] = None) -> Dict:
+        return {
+            'quiet': True,
+            'no_warnings': True,
+            'socket_timeout': STALL_TIMEOUT,
+            'cachedir': YDL_CACHE_DIR,
+            **(session.ydl_options() if session else {}),
+        }
+
+    # Опции yt-dlp для параллельной загрузки фрагментов с учетом выданных соединений
+    def _fragment_options(self, connections: int) -> Dict:
+        options = {'concurrent_fragment_downloads': connections}
+        downloader = self.profile.external_downloader
+        if downloader:
+            options['external_downloader'] = {'default': downloader}
+            if downloader == 'aria2c':
+                # -x/-s ограничивают число соединений aria2c тем же бюджетом
+                options['external_downloader_args'] = {
+                    'aria2c': ['-x', str(connections), '-s', str(connections), '-k', '1M', '--summary-interval=0']
+                }
+        return options
+
+    # Информация о медиа для предзагрузки, пока пользователь выбирает видео или аудио.
+    # Оставляем только сериализуемые поля: её передают между процессами пула и потом в загрузку
+    async def extract_info(self, url: str, session: Optional[DownloadSession] = None) -> dict:
+        info = await self._get_info(url, session=session)
+        return yt_dlp.YoutubeDL.sanitize_info(info)
+
+    # Дешевая оценка медиа для очереди: только метаданные страницы, без обработки и выбора форматов
+    # (process=False) и без разворачивания плейлистов. Возвращает только поля для оценки стоимости
+    async def probe_info(self, url: str, session: Optional[DownloadSession] = None) -> dict:
+        info = await self._get_info(url, {'extract_flat': 'in_playlist'}, session=session, process=False)
+        return {key: info.get(key) for key in PROBE_FIELDS}
 
     # Асинхронно скачивает файл с указанными опциями yt-dlp.
-    async def _download_with_options(self, url: str, options: Dict) -> str:
+    # Если передана уже полученная информация об одном видео, повторно страницу не разбираем
+    async def _download_with_options(
+        self,
+        url: str,
+        options: Dict,
+        control: Optional[JobControl] = None,
+        session: Optional[DownloadSession] = None,
+        info: Optional[dict] = None
+    ) -> str:
         # Сохраняем исходный шаблон и формируем полный путь
         original_outtmpl_pattern = options.get('outtmpl', '%(id)s.%(ext)s')
 
@@ -56,15 +286,33 @@ class BaseDownloader(ABC):
         # Обновляем шаблон имени выходного файла для передачи в yt-dlp
         options['outtmpl'] = full_path_tmpl_str
 
+        # Хуки прогресса: через них отменяем загрузку и следим за зависанием
+        if control:
+            control.check()
+            control.set_stage('download')
+            options['progress_hooks'] = [*options.get('progress_hooks', []), control.progress_hook]
+            options['postprocessor_hooks'] = [*options.get('postprocessor_hooks', []), control.postprocessor_hook]
+        # Спаны постпроцессоров: хуки вызываются в потоке загрузки, куда контекст не копируется
+        options['postprocessor_hooks'] = [*options.get('postprocessor_hooks', []), PostprocessorSpans(request_id_var.get(None)).hook]
+
         def download_sync():
+            # Берем соединения из общего бюджета на время загрузки
+            connections = connection_budget.acquire(self.profile.concurrent_fragments)
+            logger.debug(f"Fragment connections granted: {connections}")
             try:
-                with yt_dlp.YoutubeDL(options) as ydl:
+                call_options = {**options, **self._fragment_options(connections)}
+                # Загрузка всегда получает новый экземпляр (в опциях формат, имя файла и хуки задачи),
+                # из пула переиспользуются только экземпляры для извлечения. Кеш плеера общий через YDL_CACHE_DIR
+                with ydl_pool.session(type(self).__name__, self._session_params(session), call_options) as ydl:
                     # Скачиваем
-                    info = ydl.extract_info(url, download=True)
+                    if info and info.get('_type', 'video') == 'video':
+                        result_info = ydl.process_ie_result(info, download=True)
+                    else:
+                        result_info = ydl.extract_info(url, download=True)
 
                     # yt-dlp может изменить имя файла (например, при постпроцессинге)
                     # Получаем реальный путь из информации после скачивания
-                    downloaded_path = ydl.prepare_filename(info)
+                    downloaded_path = ydl.prepare_filename(result_info)
 
                     # Если при постпроцессинге имя файла изменилось, то пробуем подобрать новое с правильным разрешением
                     # Обычно такое происходит при загрузке аудио потому скачивается mp4 видео и из него извлекается mp3 аудио
@@ -74,7 +322,7 @@ class BaseDownloader(ABC):
                         standard_path_base = os.path.splitext(full_path_tmpl_str)[0]
 
                         # смотрим на расширения скачанного файла
-                        possible_exts = [info.get('ext')]
+                        possible_exts = [result_info.get('ext')]
 
                         # Проверяем, был ли постпроцессор для аудио
                         # И добавляем кодек из постпроцессора, если да
@@ -100,7 +348,12 @@ class BaseDownloader(ABC):
                     # Возвращаем найденный путь
                     return downloaded_path
 
+            except JobCancelledError:
+                 raise
             except yt_dlp.utils.DownloadError as e:
+                 # Исключение из хука прогресса yt-dlp может обернуть в свою ошибку
+                 if control and control.cancelled:
+                     raise JobCancelledError("Job cancelled during download")
                  # Проверяем специфичные ошибки yt-dlp
                  if "File is larger than max-filesize" in str(e):
                      raise DownloadError(f"File is too large (yt-dlp check): {e}")
@@ -108,14 +361,40 @@ class BaseDownloader(ABC):
                      raise DownloadError("Content requires login (private or restricted).")
                  raise DownloadError(f"yt-dlp download failed: {e}")
             except Exception as e:
+                 if control and control.cancelled:
+                     raise JobCancelledError("Job cancelled during download")
                  raise DownloadError(f"Unexpected error during download: {e}")
+            finally:
+                connection_budget.release(connections)
 
-        actual_path = await self._run_sync(download_sync)
+        with span('download', downloader=type(self).__name__, prefetched_info=info is not None):
+            actual_path = await self._run_stage(download_sync, control)
         logger.debug(f"Download successful. Actual path: {actual_path}")
         return actual_path
 
+    # Скачивает файл (download - корутина загрузки) и проверяет его размер,
+    # а параллельно собирает метаданные для отправки: длительность, размеры и превью.
+    # Если загрузка не удалась, стадия метаданных отменяется и превью удаляется
+    async def _download_with_metadata(
+        self,
+        download: Awaitable[str],
+        info: dict,
+        format_spec: Optional[str] = None,
+        with_dimensions: bool = True,
+        max_bytes: Optional[int] = None
+    ) -> Tuple[str, float, MediaMetadata]:
+        metadata_task = asyncio.ensure_future(collect_metadata(info, self.temp_dir, format_spec, with_dimensions))
+        try:
+            output_path = await download
+            size_mb = await self._check_file_size(output_path, max_bytes)
+        except BaseException:
+            metadata_task.cancel()
+            metadata_task.add_done_callback(_discard_thumbnail)
+            raise
+        return output_path, size_mb, await metadata_task
+
     # Асинхронно проверяет размер файла и удаляет его, если он слишком большой.
-    async def _check_file_size(self, filepath: str) -> float:
+    async def _check_file_size(self, filepath: str, max_bytes: Optional[int] = None) -> float:
         try:
             size_bytes = await self._run_sync(os.path.getsize, filepath)
         except FileNotFoundError:
@@ -124,7 +403,7 @@ class BaseDownloader(ABC):
              raise DownloadError(f"Could not get file size for {filepath}: {e}")
 
         size_mb = size_bytes / (1024 * 1024)
-        if size_bytes > self.MAX_FILE_SIZE_BYTES:
+        if size_bytes > (max_bytes or self.MAX_FILE_SIZE_BYTES):
             try:
                 await self._run_sync(os.remove, filepath)
             except Exception as e:
@@ -135,10 +414,119 @@ class BaseDownloader(ABC):
             raise DownloadError(f"File is too large: {size_mb:.1f}MB")
         return size_mb
 
+    # Аргументы ffmpeg для склейки в mp4 с moov атомом в начале файла.
+    # +faststart дописывает moov в конец и потом переписывает весь файл второй раз,
+    # а -moov_size резервирует место под moov в начале и файл пишется за один проход.
+    # Индекс занимает порядка 16 байт на сэмпл (кадр видео или AAC фрейм, ~47 в секунду),
+    # берем двойной запас: неиспользованное место остается пустым free атомом
+    def _merge_postprocessor_args(self, info: dict) -> Dict:
+        return {'merger': ['-moov_size', str(self._moov_reservation(info))]}
+
+    # Размер места под moov, резервируемого при склейке (в байтах)
+    def _moov_reservation(self, info: dict) -> int:
+        duration = info.get('duration') or 600
+        fps = max((fmt.get('fps') or 0 for fmt in info.get('formats') or []), default=0) or 60
+        return int(duration * (fps + 48) * 16 * 2) + 64 * 1024
+
+    # Предел размера аудио: с отправкой частями - AUDIO_MAX_PARTS лимитов телеграма, иначе один лимит
+    def _audio_limit(self, session: Optional[DownloadSession]) -> int:
+        if session and not session.audio_parts:
+            return self.MAX_FILE_SIZE_BYTES
+        return self.MAX_AUDIO_SIZE_BYTES
+
+    # Отказ до загрузки, если по длительности аудио заведомо больше max_bytes
+    def _check_audio_estimate(self, info: dict, max_bytes: int):
+        estimated_bytes = (info.get('duration') or 0) * AUDIO_BITRATE_KBPS * 1000 / 8
+        if estimated_bytes > max_bytes:
+            raise DownloadError(f"File is too large: ~{estimated_bytes / (1024 * 1024):.1f}MB")
+
+    # Формат и постпроцессор для аудио задачи. Обычно это mp3 128 кбит/с.
+    # Если mp3 все равно не влезет в один файл и пойдет частями, берем AAC дорожку как есть (m4a):
+    # для длинного аудио перекодирование занимает минуты, а части режутся и без него
+    def _audio_options(self, info: dict) -> Dict:
+        duration = info.get('duration') or 0
+        if duration * AUDIO_BITRATE_KBPS * 1000 / 8 > self.MAX_FILE_SIZE_BYTES:
+            return {
+                'format': 'bestaudio[ext=m4a]/bestaudio/best',
+                # Для AAC источника yt-dlp только копирует дорожку, остальные кодеки перекодирует
+                'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'm4a'}],
+            }
+        return {
+            'format': 'bestaudio/best',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': str(AUDIO_BITRATE_KBPS),
+            }],
+        }
+
+    # Выбирает формат видео из info['formats'] под лимит телеграма и уровень качества.
+    # Возвращает выбор и info, в котором остались только выбранные форматы (и единые файлы под лимит для запасного best):
+    # остальные сотни записей больше не нужны, а info живет до конца загрузки. info может быть общим (предзагруженным),
+    # поэтому список форматов урезается в копии. reserve_bytes - место в лимите, которое займут не дорожки
+    # (например, зарезервированный при склейке moov), на единые файлы запасного best оно не распространяется
+    def _select_format(
+        self,
+        info: dict,
+        quality: Optional[str] = None,
+        reserve_bytes: int = 0
+    ) -> Tuple[Optional[FormatChoice], dict]:
+        choice = self.format_selector(
+            info.get('formats') or [],
+            self.MAX_FILE_SIZE_BYTES - reserve_bytes,
+            get_quality_tier(quality),
+            duration=info.get('duration'),
+        )
+        if choice:
+            formats = info.get('formats') or []
+            format_ids = set(choice.format_spec.replace('/', '+').split('+'))
+            # Спецификация может оказаться фильтром, а не списком id - тогда ничего не трогаем
+            if any(fmt.get('format_id') in format_ids for fmt in formats):
+                # Единые файлы под лимит остаются для запасного формата best
+                selected = [
+                    fmt for fmt in formats
+                    if fmt.get('format_id') in format_ids
+                    or is_single_file_fallback(fmt, self.MAX_FILE_SIZE_BYTES, info.get('duration'))
+                ]
+                info = {**info, 'formats': selected}
+        return choice, info
+
+    # Разворачивает плейлист в список ссылок на элементы (без загрузки самих элементов).
+    # Для ссылки, которая не является плейлистом, возвращает её саму
+    async def expand_playlist(self, url: str, limit: int, session: Optional[DownloadSession] = None) -> List[str]:
+        info = await self._get_info(url, {'extract_flat': 'in_playlist', 'playlistend': limit}, session=session)
+        if info.get('_type') != 'playlist':
+            return [url]
+
+        urls = []
+        for entry in info.get('entries') or []:
+            entry_url = entry.get('url') or entry.get('webpage_url')
+            if entry_url and not entry_url.startswith('http'):
+                # Для YouTube в плоском режиме url может быть просто id видео
+                entry_url = f"https://www.youtube.com/watch?v={entry_url}"
+            if entry_url:
+                urls.append(entry_url)
+        return urls[:limit]
+
     @abstractmethod
-    async def download_video(self, url: str, request_id: str = None) -> Tuple[str, str]:
+    async def download_video(
+        self,
+        url: str,
+        request_id: str = None,
+        quality: str = None,
+        control: JobControl = None,
+        session: DownloadSession = None,
+        info: dict = None
+    ) -> DownloadResult:
         pass
 
     @abstractmethod
-    async def download_audio(self, url: str, request_id: str = None) -> Tuple[str, str]:
+    async def download_audio(
+        self,
+        url: str,
+        request_id: str = None,
+        control: JobControl = None,
+        session: DownloadSession = None,
+        info: dict = None
+    ) -> DownloadResult:
         pass
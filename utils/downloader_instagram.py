@@ -1,7 +1,7 @@
-from typing import Tuple
 from contextlib import nullcontext
 from utils.logger import logger, request_context
-from utils.downloader_base import BaseDownloader, DownloadError
+from utils.job_control import JobControl, JobCancelledError
+from utils.downloader_base import BaseDownloader, DownloadError, DownloadResult, DownloadSession
 
 class InstagramDownloader(BaseDownloader):
     def __init__(self):
@@ -14,13 +14,21 @@ class InstagramDownloader(BaseDownloader):
             # 'cookiefile': 'instagram_cookies.txt'
         }
 
-    async def download_video(self, url: str, request_id: str = None) -> Tuple[str, str]:
+    async def download_video(
+        self,
+        url: str,
+        request_id: str = None,
+        quality: str = None,
+        control: JobControl = None,
+        session: DownloadSession = None,
+        info: dict = None
+    ) -> DownloadResult:
         with request_context(request_id) if request_id else nullcontext():
             try:
                 logger.info(f"Starting Instagram video download: {url}")
 
-                # Получаем информацию для заголовка и ID
-                info = await self._get_info(url, {'extract_flat': True})
+                # Получаем информацию для заголовка и ID (если её не предзагрузили заранее)
+                info = info or await self._get_info(url, {'extract_flat': True}, control=control, session=session)
                 video_id = info['id']
 
                 # Instagram часто не имеет title, используем описание или ID
@@ -28,21 +36,35 @@ class InstagramDownloader(BaseDownloader):
                 if len(title) > 100: # Обрезаем длинное описание
                      title = title[:97] + "..."
 
+                # Выбираем формат под лимит и уровень качества,
+                # если размеры форматов неизвестны - полагаемся на фильтр yt-dlp
+                selected_format, info = self._select_format(info, quality)
+                if selected_format:
+                    format_spec = selected_format.format_spec
+                    logger.debug(f"Selected format: {format_spec}, Height: {selected_format.height}, Quality tier: {quality or 'best'}")
+                else:
+                    # Лучшее качество MP4, не превышающее лимит
+                    format_spec = f'best[ext=mp4][filesize<{self.MAX_FILE_SIZE_BYTES}]/best[ext=mp4]'
+
                 # Опции загрузчика
                 ydl_opts = {
                     **self.base_opts,
-                    # Лучшее качество MP4, не превышающее лимит
-                    'format': f'best[ext=mp4][filesize<{self.MAX_FILE_SIZE_BYTES}]/best[ext=mp4]',
+                    'format': format_spec,
                     'outtmpl': '%(id)s.%(ext)s',
                 }
 
                 logger.info("Attempting Instagram video download")
-                output_path = await self._download_with_options(url, ydl_opts)
-                size_mb = await self._check_file_size(output_path)
+                output_path, size_mb, metadata = await self._download_with_metadata(
+                    self._download_with_options(url, ydl_opts, control, session, info),
+                    info,
+                    format_spec
+                )
                 logger.info(f"Instagram video downloaded: {output_path} ({size_mb:.1f}MB)")
 
-                return output_path, title
+                return DownloadResult(output_path, title, *metadata)
 
+            except JobCancelledError:
+                raise
             except DownloadError as e:
                  # Проверяем специфичную ошибку Instagram о логине
                  if "Login required" in str(e):
@@ -54,13 +76,20 @@ class InstagramDownloader(BaseDownloader):
                 raise DownloadError(f"Instagram video download failed: {str(e)}")
 
 
-    async def download_audio(self, url: str, request_id: str = None) -> Tuple[str, str]:
+    async def download_audio(
+        self,
+        url: str,
+        request_id: str = None,
+        control: JobControl = None,
+        session: DownloadSession = None,
+        info: dict = None
+    ) -> DownloadResult:
         with request_context(request_id) if request_id else nullcontext():
             try:
                 logger.info(f"Starting Instagram audio download: {url}")
 
-                # Получаем информацию для заголовка и ID
-                info = await self._get_info(url, {'extract_flat': True})
+                # Получаем информацию для заголовка и ID (если её не предзагрузили заранее)
+                info = info or await self._get_info(url, {'extract_flat': True}, control=control, session=session)
                 video_id = info['id']
 
                 # Instagram часто не имеет title, используем описание или ID
@@ -71,23 +100,28 @@ class InstagramDownloader(BaseDownloader):
                 # Опции загрузчика и настройки для извлечения аудио
                 ydl_opts = {
                     **self.base_opts,
-                    'format': 'bestaudio/best',
+                    **self._audio_options(info),
                     'outtmpl': f"{video_id}.%(ext)s",
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '128',
-                    }],
                     'keepvideo': False, # удаляем видео файл после извлечения аудио
                 }
 
+                # Аудио, которое заведомо не получится отправить, не качаем
+                max_bytes = self._audio_limit(session)
+                self._check_audio_estimate(info, max_bytes)
+
                 logger.info("Attempting Instagram audio download and extraction")
-                output_path = await self._download_with_options(url, ydl_opts)
-                size_mb = await self._check_file_size(output_path)
+                output_path, size_mb, metadata = await self._download_with_metadata(
+                    self._download_with_options(url, ydl_opts, control, session, info),
+                    info,
+                    with_dimensions=False,
+                    max_bytes=max_bytes
+                )
                 logger.info(f"Instagram audio extracted: {output_path} ({size_mb:.1f}MB)")
 
-                return output_path, title
+                return DownloadResult(output_path, title, *metadata)
 
+            except JobCancelledError:
+                raise
             except DownloadError as e:
                 # Проверяем специфичную ошибку Instagram о логине
                  if "Login required" in str(e):
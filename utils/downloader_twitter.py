@@ -1,7 +1,7 @@
-from typing import Tuple
 from contextlib import nullcontext
 from utils.logger import logger, request_context
-from utils.downloader_base import BaseDownloader, DownloadError
+from utils.job_control import JobControl, JobCancelledError
+from utils.downloader_base import BaseDownloader, DownloadError, DownloadResult, DownloadSession
 
 class TwitterDownloader(BaseDownloader):
     def __init__(self):
@@ -12,13 +12,21 @@ class TwitterDownloader(BaseDownloader):
             'no_warnings': True,
         }
 
-    async def download_video(self, url: str, request_id: str = None) -> Tuple[str, str]:
+    async def download_video(
+        self,
+        url: str,
+        request_id: str = None,
+        quality: str = None,
+        control: JobControl = None,
+        session: DownloadSession = None,
+        info: dict = None
+    ) -> DownloadResult:
         with request_context(request_id) if request_id else nullcontext():
             try:
                 logger.info(f"Starting Twitter video download: {url}")
 
-                # Получаем информацию для заголовка и ID
-                info = await self._get_info(url, options={'extract_flat': True})
+                # Получаем информацию для заголовка и ID (если её не предзагрузили заранее)
+                info = info or await self._get_info(url, options={'extract_flat': True}, control=control, session=session)
                 video_id = info['id']
 
                 # Твиты часто не имеют title, используем ID как fallback
@@ -27,34 +35,55 @@ class TwitterDownloader(BaseDownloader):
                 if len(title) > 100:
                     title = title[:97] + "..."
 
+                # Выбираем формат под лимит и уровень качества,
+                # если размеры форматов неизвестны - полагаемся на фильтр yt-dlp
+                selected_format, info = self._select_format(info, quality)
+                if selected_format:
+                    format_spec = selected_format.format_spec
+                    logger.debug(f"Selected format: {format_spec}, Height: {selected_format.height}, Quality tier: {quality or 'best'}")
+                else:
+                    # Лучшее качество MP4, не превышающее лимит
+                    format_spec = f'best[ext=mp4][filesize<{self.MAX_FILE_SIZE_BYTES}]/best[ext=mp4]'
+
                 # Опции загрузчика
                 ydl_opts = {
                     **self.base_opts,
-                     # Лучшее качество MP4, не превышающее лимит
-                    'format': f'best[ext=mp4][filesize<{self.MAX_FILE_SIZE_BYTES}]/best[ext=mp4]',
+                    'format': format_spec,
                     'outtmpl': '%(id)s.%(ext)s',
                 }
 
                 logger.info("Attempting Twitter video download")
-                output_path = await self._download_with_options(url, ydl_opts)
-                size_mb = await self._check_file_size(output_path)
+                output_path, size_mb, metadata = await self._download_with_metadata(
+                    self._download_with_options(url, ydl_opts, control, session, info),
+                    info,
+                    format_spec
+                )
                 logger.info(f"Twitter video downloaded: {output_path} ({size_mb:.1f}MB)")
 
-                return output_path, title
+                return DownloadResult(output_path, title, *metadata)
 
+            except JobCancelledError:
+                raise
             except DownloadError as e:
                  raise e
             except Exception as e:
                 logger.error(f"Unexpected Twitter video download error: {e}", exc_info=True)
                 raise DownloadError(f"Twitter video download failed: {str(e)}")
 
-    async def download_audio(self, url: str, request_id: str = None) -> Tuple[str, str]:
+    async def download_audio(
+        self,
+        url: str,
+        request_id: str = None,
+        control: JobControl = None,
+        session: DownloadSession = None,
+        info: dict = None
+    ) -> DownloadResult:
         with request_context(request_id) if request_id else nullcontext():
             try:
                 logger.info(f"Starting Twitter audio extraction: {url}")
 
-                # Получаем информацию для заголовка
-                info = await self._get_info(url, {'extract_flat': True})
+                # Получаем информацию для заголовка (если её не предзагрузили заранее)
+                info = info or await self._get_info(url, {'extract_flat': True}, control=control, session=session)
                 video_id = info['id']
 
                 # Твиты часто не имеют title, используем ID как fallback
@@ -67,23 +96,28 @@ class TwitterDownloader(BaseDownloader):
                 # Опции загрузчика и настройки для извлечения аудио
                 ydl_opts = {
                     **self.base_opts,
-                    'format': 'bestaudio/best',
+                    **self._audio_options(info),
                     'outtmpl': f"{video_id}.%(ext)s",
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '128',
-                    }],
                     'keepvideo': False, # удаляем видео файл после извлечения аудио
                 }
 
+                # Аудио, которое заведомо не получится отправить, не качаем
+                max_bytes = self._audio_limit(session)
+                self._check_audio_estimate(info, max_bytes)
+
                 logger.info("Attempting Twitter audio download and extraction")
-                output_path = await self._download_with_options(url, ydl_opts)
-                size_mb = await self._check_file_size(output_path)
+                output_path, size_mb, metadata = await self._download_with_metadata(
+                    self._download_with_options(url, ydl_opts, control, session, info),
+                    info,
+                    with_dimensions=False,
+                    max_bytes=max_bytes
+                )
                 logger.info(f"Twitter audio extracted: {output_path} ({size_mb:.1f}MB)")
 
-                return output_path, title
+                return DownloadResult(output_path, title, *metadata)
 
+            except JobCancelledError:
+                raise
             except DownloadError as e:
                  raise e
             except Exception as e:
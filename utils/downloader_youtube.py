@@ -1,7 +1,8 @@
-from typing import Tuple
 from contextlib import nullcontext
 from utils.logger import logger, request_context
-from utils.downloader_base import BaseDownloader, DownloadError
+from utils.job_control import JobControl, JobCancelledError
+from utils.downloader_base import BaseDownloader, DownloadError, DownloadResult, DownloadSession, MergeStats
+from utils.format_selector import smallest_expected_size
 
 class YouTubeDownloader(BaseDownloader):
     def __init__(self):
@@ -12,121 +13,138 @@ class YouTubeDownloader(BaseDownloader):
             'no_warnings': True,
         }
 
-    async def download_video(self, url: str, request_id: str = None) -> Tuple[str, str]:
+    async def download_video(
+        self,
+        url: str,
+        request_id: str = None,
+        quality: str = None,
+        control: JobControl = None,
+        session: DownloadSession = None,
+        info: dict = None
+    ) -> DownloadResult:
         with request_context(request_id) if request_id else nullcontext():
             try:
                 logger.info(f"Starting YouTube video download: {url}")
 
-                # Получаем информацию
-                info = await self._get_info(url)
+                # Получаем информацию (если её не предзагрузили заранее)
+                info = info or await self._get_info(url, control=control, session=session)
                 video_id = info['id']
                 title = info.get('title', 'Unknown Title')
 
-                 # Получаем размер аудио
-                audio_formats = [
-                    f for f in info.get('formats', [])
-                    if f.get('vcodec') == 'none' and f.get('ext') == 'm4a' and f.get('filesize')
-                ]
-                audio_size_bytes = min(
-                    (f.get('filesize', float('inf')) for f in audio_formats),
-                    default=float('inf')
-                )
-                audio_size_mb = audio_size_bytes / (1024 * 1024)
-                logger.debug(f"Found audio track size: {audio_size_mb:.1f}MB")
-
-                # Получаем размер видео по формуле (лимит телеграма - размер аудио)
-                max_video_size = self.MAX_FILE_SIZE_BYTES - audio_size_bytes
-                max_video_size_mb = max_video_size / (1024 * 1024)
-
-                # Фильтруем форматы оставляем только mp4 и с явным кодеком и с явным размером
-                formats_info = [
-                    {
-                        'format_id': f.get('format_id'),
-                        'ext': f.get('ext'),
-                        'filesize': f.get('filesize', 0),
-                        'height': f.get('height'),
-                        'vcodec': f.get('vcodec'),
-                    }
-                    for f in info.get('formats', [])
-                    if (f.get('ext') == 'mp4' and
-                        f.get('vcodec') != 'none' and
-                        f.get('filesize'))
-                ]
-
-                # Сортируем форматы по качеству (сверху самые тяжелые/качественные)
-                formats_info.sort(key=lambda x: (x.get('height', 0) or 0), reverse=True)
-
-                # Выбираем подходящий формат
-                # Из-за сортировки выберется лучшее качество подходящее под оставшийся после аудио размер в рамках лимита телеги
-                selected_format = next((fmt for fmt in formats_info if fmt['filesize'] <= max_video_size), None)
+                # Выбираем лучший формат, подходящий под лимит телеграма и уровень качества
+                # Раздельная видео дорожка комбинируется с самой легкой m4a аудио дорожкой.
+                # Место, зарезервированное под moov при склейке, входит в итоговый файл и вычитается из лимита
+                selected_format, info = self._select_format(info, quality, reserve_bytes=self._moov_reservation(info))
 
                 # Нет ни одного подходящего формата
                 if not selected_format:
-                    size_mb = (formats_info[-1]['filesize'] / (1024 * 1024)) + audio_size_mb
-                    raise DownloadError(f"File is too large: {size_mb:.1f}MB")
+                    smallest_size = smallest_expected_size(info.get('formats'), info.get('duration')) or 0
+                    raise DownloadError(f"File is too large: {smallest_size / (1024 * 1024):.1f}MB")
 
-                selected_format_video_size_mb = selected_format['filesize'] / (1024 * 1024)
                 logger.debug(
-                    f"Selected format: ID {selected_format['format_id']}, "
-                    f"Video Size: {selected_format_video_size_mb:.1f}MB, "
-                    f"Audio Size: {audio_size_mb:.1f}MB, "
-                    f"Total Expected: {(selected_format_video_size_mb + audio_size_mb):.1f}MB, "
-                    f"Height: {selected_format['height']}"
+                    f"Selected format: {selected_format.format_spec}, "
+                    f"Total Expected: {selected_format.expected_size / (1024 * 1024):.1f}MB, "
+                    f"Height: {selected_format.height}, "
+                    f"Quality tier: {quality or 'best'}"
                 )
 
                 # Загружаем видео
+                merge_stats = MergeStats()
                 ydl_opts = {
                     **self.base_opts,
-                    'format': f"{selected_format['format_id']}+bestaudio[ext=m4a]/best",
+                    # Если выбранные дорожки недоступны (например, ссылки на них истекли), берем лучший единый файл
+                    'format': f"{selected_format.format_spec}/best",
                     'outtmpl': f"{video_id}.mp4",
                     'merge_output_format': 'mp4',
-                    # на всякий случай явно указываем что бы телеграм схавал файл
-                    'postprocessor_args': {'ffmpeg': ['-movflags', '+faststart']}
+                    # moov атом в начале файла, чтобы телеграм мог стримить видео
+                    'postprocessor_args': self._merge_postprocessor_args(info),
+                    'postprocessor_hooks': [merge_stats.hook],
                 }
 
+                async def download_merged() -> str:
+                    try:
+                        return await self._download_with_options(url, {**ydl_opts}, control, session, info)
+                    except DownloadError as e:
+                        # Склейка с -moov_size упала: ffmpeg сообщает о нехватке места под moov по-разному,
+                        # а yt-dlp оставляет от его вывода только последнюю строку, поэтому текст ошибки не проверяем.
+                        # Любой сбой начатой и не завершенной склейки повторяем с +faststart.
+                        # Скачанные дорожки остаются на диске, повторяется только склейка
+                        if merge_stats.started_at is None or merge_stats.seconds is not None:
+                            raise
+                        logger.warning(f"Merge with reserved moov space failed, merging again with +faststart: {e}")
+                        merge_stats.started_at = None
+                        ydl_opts['postprocessor_args'] = {'merger': ['-movflags', '+faststart']}
+                        return await self._download_with_options(url, {**ydl_opts}, control, session, info)
+
                 logger.info(f"Attempting YouTube video download (format: {ydl_opts['format']})")
-                output_path = await self._download_with_options(url, ydl_opts)
-                size_mb = await self._check_file_size(output_path)
+                output_path, size_mb, metadata = await self._download_with_metadata(
+                    download_merged(),
+                    info,
+                    selected_format.format_spec
+                )
                 logger.info(f"YouTube video downloaded: {output_path} ({size_mb:.1f}MB)")
-
-                return output_path, title
-
+                if merge_stats.seconds is not None:
+                    # С +faststart ffmpeg переписывает файл еще раз, то есть пишет его дважды
+                    merge_args = ydl_opts['postprocessor_args']['merger']
+                    passes = 2 if '+faststart' in merge_args else 1
+                    logger.info(
+                        f"Merge took {merge_stats.seconds:.2f}s, "
+                        f"wrote {passes * (merge_stats.output_bytes or 0) / (1024 * 1024):.1f}MB "
+                        f"({' '.join(merge_args)})"
+                    )
+
+                return DownloadResult(output_path, title, *metadata)
+
+            except JobCancelledError:
+                raise
             except DownloadError as e:
                 raise e
             except Exception as e:
                 logger.error(f"Unexpected YouTube video download error: {e}", exc_info=True)
                 raise DownloadError(f"YouTube video download failed: {str(e)}")
 
-    async def download_audio(self, url: str, request_id: str = None) -> Tuple[str, str]:
+    async def download_audio(
+        self,
+        url: str,
+        request_id: str = None,
+        control: JobControl = None,
+        session: DownloadSession = None,
+        info: dict = None
+    ) -> DownloadResult:
         with request_context(request_id) if request_id else nullcontext():
             try:
                 logger.info(f"Starting YouTube audio extraction: {url}")
 
-                # Получаем базовую информацию для заголовка и ID
-                info = await self._get_info(url, options={'extract_flat': True})
+                # Получаем базовую информацию для заголовка и ID (если её не предзагрузили заранее)
+                info = info or await self._get_info(url, options={'extract_flat': True}, control=control, session=session)
                 video_id = info['id']
                 title = info.get('title', video_id)
 
                 # Настройки для извлечения аудио
                 ydl_opts = {
                     **self.base_opts,
-                    'format': 'bestaudio/best',
+                    **self._audio_options(info),
                     'outtmpl': f"{video_id}.%(ext)s",
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '128',
-                    }],
                     'keepvideo': False, # удаляем видео файл после извлечения аудио
                 }
 
+                # Аудио, которое заведомо не получится отправить, не качаем
+                max_bytes = self._audio_limit(session)
+                self._check_audio_estimate(info, max_bytes)
+
                 logger.info("Attempting YouTube audio download and extraction")
-                output_path = await self._download_with_options(url, ydl_opts)
-                size_mb = await self._check_file_size(output_path)
+                output_path, size_mb, metadata = await self._download_with_metadata(
+                    self._download_with_options(url, ydl_opts, control, session, info),
+                    info,
+                    with_dimensions=False,
+                    max_bytes=max_bytes
+                )
                 logger.info(f"YouTube audio extracted: {output_path} ({size_mb:.1f}MB)")
 
-                return output_path, title
+                return DownloadResult(output_path, title, *metadata)
 
+            except JobCancelledError:
+                raise
             except DownloadError as e:
                  raise e
             except Exception as e:
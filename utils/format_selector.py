@@ -0,0 +1,126 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Уровень качества: ограничение по высоте кадра и по суммарному битрейту (кбит/с)
+class QualityTier(NamedTuple):
+    name: str
+    max_height: Optional[int]
+    max_tbr: Optional[float]
+
+# Уровни качества от лучшего к худшему
+QUALITY_TIERS: Dict[str, QualityTier] = {
+    'best': QualityTier('best', None, None),
+    '720p': QualityTier('720p', 720, 2500),
+    '480p': QualityTier('480p', 480, 1200),
+    '360p': QualityTier('360p', 360, 700),
+}
+DEFAULT_TIER = 'best'
+
+# Выбранный формат: строка формата для yt-dlp и ожидаемый размер файла
+class FormatChoice(NamedTuple):
+    format_spec: str
+    height: Optional[int]
+    expected_size: int
+
+# Возвращает уровень качества по имени (неизвестное имя - лучшее качество)
+def get_quality_tier(name: Optional[str]) -> QualityTier:
+    return QUALITY_TIERS.get(name or DEFAULT_TIER, QUALITY_TIERS[DEFAULT_TIER])
+
+# Возвращает более низкий из двух уровней качества
+def lower_tier(first: Optional[str], second: Optional[str]) -> str:
+    order = list(QUALITY_TIERS)
+    first_index = order.index(get_quality_tier(first).name)
+    second_index = order.index(get_quality_tier(second).name)
+    return order[max(first_index, second_index)]
+
+# Оценивает размер формата: точный размер, приблизительный или по битрейту и длительности
+def estimate_format_size(fmt: dict, duration: Optional[float] = None) -> Optional[int]:
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+def _fits_tier(fmt: dict, tier: QualityTier) -> bool:
+    if tier.max_height and (fmt.get('height') or 0) > tier.max_height:
+        return False
+    if tier.max_tbr and fmt.get('tbr') and fmt['tbr'] > tier.max_tbr:
+        return False
+    return True
+
+def _is_audio_only(fmt: dict) -> bool:
+    return fmt.get('vcodec') == 'none' and fmt.get('acodec') != 'none'
+
+def _is_video_only(fmt: dict) -> bool:
+    return fmt.get('vcodec') not in (None, 'none') and fmt.get('acodec') == 'none'
+
+def _has_video(fmt: dict) -> bool:
+    return fmt.get('vcodec') != 'none'
+
+# Единый файл (видео со звуком), который помещается в max_bytes: из таких yt-dlp берет запасной формат best
+def is_single_file_fallback(fmt: dict, max_bytes: int, duration: Optional[float] = None) -> bool:
+    if not _has_video(fmt) or fmt.get('acodec') in (None, 'none'):
+        return False
+    size = estimate_format_size(fmt, duration)
+    return bool(size) and size <= max_bytes
+
+# Выбирает формат видео, который помещается в max_bytes и по возможности укладывается в уровень качества.
+# Раздельные видео дорожки (DASH/HLS) комбинируются с самой легкой аудио дорожкой того же контейнера.
+# Если в уровень качества не помещается ни один формат, берется самый легкий из подходящих по размеру.
+# Возвращает None, если ни один формат не помещается в лимит
+def select_format(
+    formats: Iterable[dict],
+    max_bytes: int,
+    tier: Optional[QualityTier] = None,
+    duration: Optional[float] = None,
+    ext: str = 'mp4'
+) -> Optional[FormatChoice]:
+    tier = tier or get_quality_tier(DEFAULT_TIER)
+    formats = list(formats or [])
+    audio_ext = 'm4a' if ext == 'mp4' else ext
+
+    # Самая легкая аудио дорожка для склейки с раздельным видео
+    audio_candidates = [
+        (size, f) for f in formats
+        if _is_audio_only(f) and f.get('ext') in (audio_ext, ext)
+        for size in [estimate_format_size(f, duration)] if size
+    ]
+    audio = min(audio_candidates, key=lambda item: item[0], default=None)
+
+    candidates: List[Tuple[FormatChoice, dict]] = []
+    for f in formats:
+        if f.get('ext') != ext or not _has_video(f):
+            continue
+        size = estimate_format_size(f, duration)
+        if not size:
+            continue
+        if _is_video_only(f):
+            # Видео без звука отдавать нельзя
+            if not audio:
+                continue
+            spec = f"{f['format_id']}+{audio[1]['format_id']}"
+            size += audio[0]
+        else:
+            spec = f['format_id']
+        candidates.append((FormatChoice(spec, f.get('height'), size), f))
+
+    # Сверху самые качественные, при равной высоте - самые легкие
+    candidates.sort(key=lambda item: (-(item[0].height or 0), item[0].expected_size))
+
+    fitting = [item for item in candidates if item[0].expected_size <= max_bytes]
+    if not fitting:
+        return None
+
+    within_tier = next((choice for choice, f in fitting if _fits_tier(f, tier)), None)
+    if within_tier:
+        return within_tier
+    return min(fitting, key=lambda item: item[0].expected_size)[0]
+
+# Минимальный ожидаемый размер среди форматов с видео (для сообщения об ошибке)
+def smallest_expected_size(formats: Iterable[dict], duration: Optional[float] = None) -> Optional[int]:
+    sizes = [
+        estimate_format_size(f, duration)
+        for f in formats or []
+        if _has_video(f)
+    ]
+    return min((size for size in sizes if size), default=None)
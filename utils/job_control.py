@@ -0,0 +1,83 @@
+import threading
+import time
+from typing import Optional
+
+# Задача отменена пользователем или остановлена по таймауту
+class JobCancelledError(Exception):
+    pass
+
+# Управление одной задачей загрузки: флаг отмены и состояние прогресса.
+# В режиме пула процессов cancel_event и progress - прокси multiprocessing.Manager,
+# поэтому объект можно передать в дочерний процесс и отменить загрузку оттуда же
+class JobControl:
+    # Как часто хуки yt-dlp обновляют прогресс и проверяют флаг отмены (через прокси это IPC)
+    HOOK_INTERVAL = 0.5
+
+    def __init__(self, cancel_event=None, progress=None):
+        self.cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        self.progress = progress if progress is not None else {}
+        self._last_hook_at = 0.0
+        self.set_stage('queued')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_last_hook_at'] = 0.0
+        return state
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    # Прогресс в прокси менеджера (пул процессов): каждое обращение - IPC
+    @property
+    def shared(self) -> bool:
+        return not isinstance(self.progress, dict)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    # Бросает JobCancelledError если задача отменена
+    def check(self):
+        if self.cancelled:
+            raise JobCancelledError("Job cancelled")
+
+    # Переключает стадию задачи (extract/download/postprocess/upload)
+    def set_stage(self, stage: str):
+        now = time.time()
+        self.progress.update({'stage': stage, 'stage_started_at': now, 'updated_at': now})
+
+    @property
+    def stage(self) -> Optional[str]:
+        return self.progress.get('stage')
+
+    # Время с начала текущей стадии
+    def stage_elapsed(self) -> float:
+        return time.time() - (self.progress.get('stage_started_at') or time.time())
+
+    # Время с последней активности (полученных байт или смены стадии)
+    def idle_for(self) -> float:
+        return time.time() - (self.progress.get('updated_at') or time.time())
+
+    # Хук прогресса yt-dlp. Исключение из хука прерывает загрузку внутри yt-dlp
+    def progress_hook(self, d: dict):
+        now = time.time()
+        if d.get('status') == 'downloading' and now - self._last_hook_at < self.HOOK_INTERVAL:
+            return
+        self._last_hook_at = now
+
+        update = {'updated_at': now}
+        if self.progress.get('stage') != 'download':
+            update.update({'stage': 'download', 'stage_started_at': now})
+        if d.get('downloaded_bytes') is not None:
+            update['downloaded'] = d['downloaded_bytes']
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        if total:
+            update['total'] = total
+        self.progress.update(update)
+        self.check()
+
+    # Хук постпроцессоров yt-dlp (склейка, извлечение аудио)
+    def postprocessor_hook(self, d: dict):
+        if d.get('status') == 'started':
+            self.set_stage('postprocess')
+        self.check()
@@ -1,4 +1,8 @@
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
+import queue
 import uuid
 from functools import wraps
 from contextlib import contextmanager
@@ -18,15 +22,29 @@ formatter = logging.Formatter(
     '%(asctime)s [%(request_id)s] - %(levelname)s %(name)s: - %(message)s'
 )
 
-# Создаем handler
+# Создаем handler. Запись в поток вывода может блокировать (медленный диск, переполненный pipe),
+# поэтому в основном процессе логгер только кладет запись в очередь, а пишет её отдельный поток.
+# Дочерние процессы пула завершаются через os._exit без atexit, и хвост очереди там терялся бы,
+# поэтому они пишут напрямую: их event loop все равно не блокирует
 handler = logging.StreamHandler()
 handler.setFormatter(formatter)
 handler.addFilter(RequestIdFilter())
+root_handler: logging.Handler = handler
+if multiprocessing.parent_process() is None:
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # request_id берется из контекста вызывающего кода, поэтому фильтр стоит до очереди
+    queue_handler.addFilter(RequestIdFilter())
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+    # При выходе дописываем оставшиеся в очереди записи
+    atexit.register(log_listener.stop)
+    root_handler = queue_handler
 
 # Настраиваем корневой логгер
 root_logger = logging.getLogger()
 root_logger.setLevel(logging.INFO)
-root_logger.addHandler(handler)
+root_logger.addHandler(root_handler)
 
 # Удаляем дефолтные хендлеры
 for old_handler in root_logger.handlers[:-1]:
@@ -0,0 +1,85 @@
+import asyncio
+import uuid
+from io import BytesIO
+from pathlib import Path
+from typing import NamedTuple, Optional
+import httpx
+from PIL import Image
+from utils.logger import logger
+from utils.tracing import span
+
+# Максимальная сторона превью и лимит его размера (ограничения телеграма)
+THUMBNAIL_MAX_SIDE = 320
+THUMBNAIL_MAX_BYTES = 200 * 1024
+THUMBNAIL_FETCH_TIMEOUT = 10
+
+# Метаданные для отправки в телеграм: длительность, размеры и превью
+class MediaMetadata(NamedTuple):
+    duration: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    thumbnail: Optional[str] = None # путь к JPEG превью
+
+# Размеры видео выбранного формата. Спецификация вида "vid+aid" или "id1/id2",
+# для спецификаций-фильтров берем размеры, которые yt-dlp выбрал по умолчанию
+def _video_dimensions(info: dict, format_spec: Optional[str]):
+    if format_spec:
+        formats = {fmt.get('format_id'): fmt for fmt in info.get('formats') or []}
+        for format_id in format_spec.split('/')[0].split('+'):
+            fmt = formats.get(format_id)
+            if fmt and fmt.get('width') and fmt.get('height'):
+                return fmt['width'], fmt['height']
+    return info.get('width'), info.get('height')
+
+# Ссылка на превью: самое маленькое не меньше THUMBNAIL_MAX_SIDE, чтобы качать меньше
+def _thumbnail_url(info: dict) -> Optional[str]:
+    thumbnails = [thumb for thumb in info.get('thumbnails') or [] if thumb.get('url')]
+    sized = [thumb for thumb in thumbnails if thumb.get('width') and thumb.get('height')]
+    large_enough = [thumb for thumb in sized if max(thumb['width'], thumb['height']) >= THUMBNAIL_MAX_SIDE]
+    if large_enough:
+        return min(large_enough, key=lambda thumb: thumb['width'] * thumb['height'])['url']
+    if info.get('thumbnail'):
+        return info['thumbnail']
+    if sized:
+        return max(sized, key=lambda thumb: thumb['width'] * thumb['height'])['url']
+    return thumbnails[-1]['url'] if thumbnails else None
+
+# Уменьшает картинку до JPEG со стороной не больше THUMBNAIL_MAX_SIDE
+def _make_thumbnail(data: bytes, target: Path) -> Optional[str]:
+    with Image.open(BytesIO(data)) as image:
+        image.thumbnail((THUMBNAIL_MAX_SIDE, THUMBNAIL_MAX_SIDE))
+        image = image.convert('RGB')
+        for quality in (85, 70, 50):
+            image.save(target, 'JPEG', quality=quality, optimize=True)
+            if target.stat().st_size <= THUMBNAIL_MAX_BYTES:
+                return str(target)
+    target.unlink(missing_ok=True)
+    return None
+
+# Скачивает превью и готовит JPEG для телеграма. Ошибки не критичны: вернется None
+async def fetch_thumbnail(url: str, temp_dir: Path) -> Optional[str]:
+    try:
+        async with httpx.AsyncClient(timeout=THUMBNAIL_FETCH_TIMEOUT, follow_redirects=True) as client:
+            response = await client.get(url)
+            response.raise_for_status()
+        target = temp_dir / f"thumb_{uuid.uuid4().hex}.jpg"
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _make_thumbnail, response.content, target)
+    except Exception as e:
+        logger.warning(f"Failed to prepare thumbnail from {url}: {e}")
+        return None
+
+# Стадия метаданных: все берется из info dict, файл не декодируется.
+# Превью качается параллельно с загрузкой самого файла
+async def collect_metadata(info: dict, temp_dir: Path, format_spec: Optional[str] = None, with_dimensions: bool = True) -> MediaMetadata:
+    duration = info.get('duration')
+    width, height = _video_dimensions(info, format_spec) if with_dimensions else (None, None)
+    thumbnail_url = _thumbnail_url(info)
+    with span('metadata', thumbnail=bool(thumbnail_url)):
+        thumbnail = await fetch_thumbnail(thumbnail_url, temp_dir) if thumbnail_url else None
+    return MediaMetadata(
+        duration=int(duration) if duration else None,
+        width=int(width) if width else None,
+        height=int(height) if height else None,
+        thumbnail=thumbnail
+    )
@@ -0,0 +1,65 @@
+import os
+import resource
+import tracemalloc
+from typing import List, Optional
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# Текущий RSS процесса в байтах. На Linux читаем /proc, иначе берем пиковый RSS из getrusage
+def current_rss() -> int:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss в килобайтах на Linux и в байтах на macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+def format_mb(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f}MB"
+
+# Снимки tracemalloc по запросу администратора.
+# Трассировка включается при первом снимке (она замедляет аллокации), каждый следующий снимок
+# сравнивается с предыдущим: видно, какие строки кода набрали память между снимками
+class AllocationTracker:
+    FRAMES = 5
+
+    def __init__(self):
+        self._previous: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    # Делает снимок и возвращает строки отчета: топ строк кода по росту памяти
+    def snapshot(self, limit: int = 15) -> List[str]:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.FRAMES)
+            self._previous = tracemalloc.take_snapshot()
+            return []
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        if self._previous is not None:
+            stats = snapshot.compare_to(self._previous, 'lineno')
+        else:
+            stats = snapshot.statistics('lineno')
+        self._previous = snapshot
+
+        lines = []
+        for stat in stats[:limit]:
+            frame = stat.traceback[0]
+            size_diff = getattr(stat, 'size_diff', stat.size)
+            lines.append(f"{size_diff / 1024:+.0f}KB ({stat.size / 1024:.0f}KB) {frame.filename}:{frame.lineno}")
+        return lines
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._previous = None
+
+    # Память, которую сейчас держит трассировка, и пик с момента включения
+    def traced(self) -> Optional[tuple]:
+        return tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else None
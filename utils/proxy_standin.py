@@ -0,0 +1,107 @@
+"""Локальный HTTP прокси для проверки пула исходящих адресов (PROXY_POOL).
+
+Прокси пропускает CONNECT и обычные HTTP запросы и умеет изображать проблемы:
+задержку, ограничение платформы (429 после N запросов) и случайные сбои соединения.
+
+Примеры:
+    python -m utils.proxy_standin --port 8081
+    python -m utils.proxy_standin --port 8082 --throttle-after 5
+    python -m utils.proxy_standin --port 8083 --delay 2 --fail-rate 0.3
+
+    PROXY_POOL="*=http://127.0.0.1:8081,http://127.0.0.1:8082,http://127.0.0.1:8083"
+"""
+import argparse
+import asyncio
+import random
+import sys
+from urllib.parse import urlsplit
+
+class ProxyStandin:
+    def __init__(self, delay: float = 0, throttle_after: int = 0, fail_rate: float = 0):
+        self.delay = delay
+        self.throttle_after = throttle_after
+        self.fail_rate = fail_rate
+        self.requests = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        request_line = head.split(b'\r\n', 1)[0].decode('latin-1')
+        self.requests += 1
+        print(f"#{self.requests} {request_line}", file=sys.stderr)
+
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.throttle_after and self.requests > self.throttle_after:
+            await self._reply(writer, b'429 Too Many Requests')
+            return
+        if random.random() < self.fail_rate:
+            writer.transport.abort()
+            return
+
+        method, target, _ = request_line.split(' ', 2)
+        try:
+            if method == 'CONNECT':
+                host, port = target.rsplit(':', 1)
+                upstream_reader, upstream_writer = await asyncio.open_connection(host, int(port))
+                writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+                await writer.drain()
+            else:
+                url = urlsplit(target)
+                upstream_reader, upstream_writer = await asyncio.open_connection(url.hostname, url.port or 80)
+                path = (url.path or '/') + (f'?{url.query}' if url.query else '')
+                upstream_writer.write(head.replace(target.encode('latin-1'), path.encode('latin-1'), 1))
+        except (OSError, ValueError) as e:
+            print(f"Upstream failed: {e}", file=sys.stderr)
+            await self._reply(writer, b'502 Bad Gateway')
+            return
+        await asyncio.gather(
+            self._pipe(reader, upstream_writer),
+            self._pipe(upstream_reader, writer)
+        )
+
+    @staticmethod
+    async def _reply(writer: asyncio.StreamWriter, status: bytes):
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while data := await reader.read(64 * 1024):
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+async def serve(host: str, port: int, standin: ProxyStandin):
+    server = await asyncio.start_server(standin.handle, host, port)
+    print(f"Proxy stand-in listening on http://{host}:{port}", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный прокси для проверки пула исходящих адресов")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--delay', type=float, default=0, help="задержка перед каждым запросом (секунды)")
+    parser.add_argument('--throttle-after', type=int, default=0, help="отвечать 429 после N запросов (0 - никогда)")
+    parser.add_argument('--fail-rate', type=float, default=0, help="доля запросов, на которых соединение обрывается")
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(serve(args.host, args.port, ProxyStandin(args.delay, args.throttle_after, args.fail_rate)))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
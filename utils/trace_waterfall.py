@@ -0,0 +1,103 @@
+"""Waterfall по спанам задач из файла трасс (TRACING_EXPORT=file).
+
+Примеры:
+    python -m utils.trace_waterfall data/traces.jsonl --min-duration 60
+    python -m utils.trace_waterfall data/traces.jsonl --request-id 1a2b3c4d
+"""
+import argparse
+import json
+import sys
+from collections import defaultdict
+from typing import Dict, List
+
+BAR_WIDTH = 60
+
+def _attributes(span: Dict) -> Dict[str, str]:
+    result = {}
+    for attribute in span.get('attributes') or []:
+        value = attribute.get('value') or {}
+        result[attribute['key']] = next(iter(value.values()), None)
+    return result
+
+# Читает спаны из файла JSON Lines (одна ExportTraceServiceRequest на строку) и группирует по трассам
+def load_traces(path: str) -> Dict[str, List[Dict]]:
+    traces = defaultdict(list)
+    with open(path, encoding='utf-8') as trace_file:
+        for line in trace_file:
+            if not line.strip():
+                continue
+            payload = json.loads(line)
+            for resource_spans in payload.get('resourceSpans') or []:
+                for scope_spans in resource_spans.get('scopeSpans') or []:
+                    for span in scope_spans.get('spans') or []:
+                        span['start'] = int(span['startTimeUnixNano'])
+                        span['end'] = int(span['endTimeUnixNano'])
+                        span['attrs'] = _attributes(span)
+                        traces[span['traceId']].append(span)
+    return traces
+
+# Порядок вывода: по времени начала, дочерние спаны под родителем
+def _ordered(spans: List[Dict]) -> List[tuple]:
+    by_id = {span['spanId']: span for span in spans}
+    children = defaultdict(list)
+    roots = []
+    for span in spans:
+        parent = span.get('parentSpanId')
+        if parent and parent in by_id:
+            children[parent].append(span)
+        else:
+            roots.append(span)
+
+    ordered = []
+    def walk(span, depth):
+        ordered.append((span, depth))
+        for child in sorted(children[span['spanId']], key=lambda item: item['start']):
+            walk(child, depth + 1)
+    for root in sorted(roots, key=lambda item: item['start']):
+        walk(root, 0)
+    return ordered
+
+def render_waterfall(spans: List[Dict]) -> str:
+    trace_start = min(span['start'] for span in spans)
+    trace_end = max(span['end'] for span in spans)
+    total = max(trace_end - trace_start, 1)
+    request_id = next((span['attrs'].get('request_id') for span in spans if span['attrs'].get('request_id')), '?')
+
+    lines = [f"request {request_id}  total {total / 1e9:.2f}s  spans {len(spans)}"]
+    for span, depth in _ordered(spans):
+        offset = int((span['start'] - trace_start) / total * BAR_WIDTH)
+        length = max(1, int((span['end'] - span['start']) / total * BAR_WIDTH))
+        bar = ' ' * offset + '█' * min(length, BAR_WIDTH - offset)
+        error = ' !' if (span.get('status') or {}).get('code') == 2 else ''
+        label = ('  ' * depth + span['name'])[:28]
+        lines.append(f"  {label:<28} {(span['end'] - span['start']) / 1e9:8.2f}s |{bar:<{BAR_WIDTH}}|{error}")
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Waterfall по спанам задач бота")
+    parser.add_argument('path', help="файл трасс (JSON Lines)")
+    parser.add_argument('--request-id', help="показать только эту задачу")
+    parser.add_argument('--min-duration', type=float, default=0, help="только задачи дольше N секунд")
+    parser.add_argument('--limit', type=int, default=10, help="сколько самых медленных задач показать")
+    args = parser.parse_args(argv)
+
+    traces = load_traces(args.path)
+    selected = []
+    for spans in traces.values():
+        duration = (max(span['end'] for span in spans) - min(span['start'] for span in spans)) / 1e9
+        if args.request_id and not any(span['attrs'].get('request_id') == args.request_id for span in spans):
+            continue
+        if duration < args.min_duration:
+            continue
+        selected.append((duration, spans))
+
+    if not selected:
+        print("No matching traces", file=sys.stderr)
+        return 1
+    for _, spans in sorted(selected, key=lambda item: item[0], reverse=True)[:args.limit]:
+        print(render_waterfall(spans))
+        print()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+import atexit
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from config import TRACING_EXPORT, TRACING_FILE, TRACING_OTLP_ENDPOINT
+from utils.logger import logger, request_id_var
+
+SERVICE_NAME = 'saver-telegram-bot'
+
+# Коды статуса и вида спана из OTLP
+STATUS_OK = 1
+STATUS_ERROR = 2
+SPAN_KIND_INTERNAL = 1
+
+# Текущий спан, чтобы вложенные стадии знали своего родителя
+current_span_var: ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+
+# trace_id выводится из request_id: спаны задачи из разных процессов пула попадают в одну трассу
+def trace_id_for(request_id: str) -> str:
+    return hashlib.sha256(request_id.encode()).hexdigest()[:32]
+
+def _new_span_id() -> str:
+    return os.urandom(8).hex()
+
+def _attribute(key: str, value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+# Спан одной стадии задачи
+class Span:
+    __slots__ = ('name', 'request_id', 'trace_id', 'span_id', 'parent_span_id', 'start_ns', 'end_ns', 'attributes', 'status', 'error')
+
+    def __init__(self, name: str, request_id: str, parent: Optional['Span'] = None, start_ns: Optional[int] = None, **attributes):
+        self.name = name
+        self.request_id = request_id
+        self.trace_id = trace_id_for(request_id)
+        self.span_id = _new_span_id()
+        # Родитель из другой трассы (другой задачи) не считается
+        self.parent_span_id = parent.span_id if parent and parent.trace_id == self.trace_id else None
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = {'request_id': request_id, **attributes}
+        self.status = STATUS_OK
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def end(self, end_ns: Optional[int] = None):
+        self.end_ns = end_ns or time.time_ns()
+        _exporter().export(self)
+
+    # Спан в формате OTLP JSON
+    def to_otlp(self) -> Dict:
+        data = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': SPAN_KIND_INTERNAL,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [_attribute(key, value) for key, value in self.attributes.items() if value is not None],
+            'status': {'code': self.status, **({'message': self.error} if self.error else {})},
+        }
+        if self.parent_span_id:
+            data['parentSpanId'] = self.parent_span_id
+        return data
+
+# Экспорт спанов в фоновом потоке пачками: в файл JSON Lines (одна ExportTraceServiceRequest на строку,
+# как у file exporter коллектора OpenTelemetry) или POST на OTLP/HTTP коллектор.
+# У каждого процесса пула свой экспортер, а файл общий. Буферизованный файл пишет длинную строку
+# несколькими вызовами write, и строки разных процессов перемешивались бы. Поэтому строка уходит
+# одним os.write в дескриптор с O_APPEND (дозапись в конец атомарна относительно других процессов),
+# а пачка делится на строки не длиннее MAX_LINE_BYTES
+class SpanExporter:
+    BATCH_SIZE = 100
+    FLUSH_INTERVAL = 2.0
+    MAX_LINE_BYTES = 256 * 1024
+
+    def __init__(self, mode: str, filepath: Optional[str] = None, endpoint: Optional[str] = None):
+        self.mode = mode
+        self.filepath = filepath
+        self.endpoint = endpoint
+        self._queue: 'queue.Queue[Optional[Span]]' = queue.Queue(maxsize=10000)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        if self.mode == 'file' and self.filepath:
+            Path(self.filepath).parent.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ('file', 'otlp')
+
+    def export(self, span: Span):
+        if not self.enabled:
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            # Коллектор не успевает: лучше потерять спаны, чем память
+            pass
+
+    # Дописывает все накопленные спаны и останавливает поток
+    def shutdown(self):
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    def _ensure_thread(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        batch: List[Span] = []
+        stopping = False
+        while not stopping:
+            deadline = time.monotonic() + self.FLUSH_INTERVAL
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    span = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if span is None:
+                    stopping = True
+                    break
+                batch.append(span)
+            if batch:
+                self._write(batch)
+                batch = []
+
+    @staticmethod
+    def _encode(spans: List[Span]) -> bytes:
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': [_attribute('service.name', SERVICE_NAME), _attribute('process.pid', os.getpid())]},
+                'scopeSpans': [{'scope': {'name': 'saver.tracing'}, 'spans': [span.to_otlp() for span in spans]}],
+            }]
+        }
+        return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+    # Делит пачку на строки не длиннее MAX_LINE_BYTES (спан, который не влезает даже один, выбрасывается)
+    def _lines(self, spans: List[Span]) -> List[bytes]:
+        line = self._encode(spans) + b'\n'
+        if len(line) <= self.MAX_LINE_BYTES:
+            return [line]
+        if len(spans) == 1:
+            logger.warning(f"Dropped span {spans[0].name} of {len(line)} bytes, over the trace line limit")
+            return []
+        middle = len(spans) // 2
+        return self._lines(spans[:middle]) + self._lines(spans[middle:])
+
+    def _append(self, spans: List[Span]):
+        fd = os.open(self.filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            for line in self._lines(spans):
+                written = os.write(fd, line)
+                if written < len(line):
+                    logger.warning(f"Short write to {self.filepath}: {written} of {len(line)} bytes")
+        finally:
+            os.close(fd)
+
+    def _write(self, spans: List[Span]):
+        try:
+            if self.mode == 'file':
+                self._append(spans)
+            else:
+                request = urllib.request.Request(
+                    self.endpoint,
+                    data=self._encode(spans),
+                    headers={'Content-Type': 'application/json'},
+                    method='POST'
+                )
+                with urllib.request.urlopen(request, timeout=5):
+                    pass
+        except Exception as e:
+            logger.warning(f"Failed to export {len(spans)} span(s): {e}")
+
+_exporter_instance: Optional[SpanExporter] = None
+
+# Экспортер процесса (создается лениво, в том числе в дочерних процессах пула)
+def _exporter() -> SpanExporter:
+    global _exporter_instance
+    if _exporter_instance is None:
+        _exporter_instance = SpanExporter(TRACING_EXPORT, TRACING_FILE, TRACING_OTLP_ENDPOINT)
+        atexit.register(_exporter_instance.shutdown)
+    return _exporter_instance
+
+def tracing_enabled() -> bool:
+    return _exporter().enabled
+
+# Спан вокруг стадии задачи. request_id берется из request_context, если не передан явно
+# (в потоках run_in_executor контекст не копируется, там его нужно передавать)
+@contextmanager
+def span(name: str, request_id: Optional[str] = None, **attributes):
+    request_id = request_id or request_id_var.get(None)
+    if not request_id or not tracing_enabled():
+        yield None
+        return
+
+    current = Span(name, request_id, parent=current_span_var.get(None), **attributes)
+    token = current_span_var.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = STATUS_ERROR
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span_var.reset(token)
+        current.end()
+
+# Записывает уже завершившийся интервал (например, ожидание в очереди)
+def record_span(name: str, start_ns: int, end_ns: Optional[int] = None, request_id: Optional[str] = None, **attributes):
+    request_id = request_id or request_id_var.get(None)
+    if not request_id or not tracing_enabled():
+        return
+    Span(name, request_id, parent=current_span_var.get(None), start_ns=start_ns, **attributes).end(end_ns)
+
+# Хук постпроцессоров yt-dlp: спан на каждый постпроцессор (склейка, извлечение аудио)
+class PostprocessorSpans:
+    def __init__(self, request_id: Optional[str]):
+        self.request_id = request_id
+        self._started: Dict[str, int] = {}
+
+    def hook(self, d: dict):
+        name = d.get('postprocessor') or 'unknown'
+        if d.get('status') == 'started':
+            self._started[name] = time.time_ns()
+        elif d.get('status') == 'finished' and name in self._started:
+            record_span('postprocess', self._started.pop(name), request_id=self.request_id, postprocessor=name)
+
+def shutdown_tracing():
+    if _exporter_instance:
+        _exporter_instance.shutdown()
@@ -1,6 +1,6 @@
 import re
-from urllib.parse import urlparse
-from typing import Tuple, Optional
+from urllib.parse import urlparse, parse_qs
+from typing import List, Tuple, Optional
 from utils.logger import logger
 from utils.constants import (
     INVALID_URL_MESSAGE,
@@ -8,18 +8,20 @@ from utils.constants import (
     SUPPORTED_DOMAINS
 )
 
+# Регулярные выражения компилируются один раз при импорте, а не на каждое сообщение
+_URL_PATTERN = re.compile(
+    r'^https?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+_URL_IN_TEXT = re.compile(r'https?://[^\s<>"]+')
+
 # Валидирует URL и возвращает (is_valid, error_message, platform)
 # platform будет None если URL не валиден
 def validate_url(url: str) -> Tuple[bool, str, Optional[str]]:
-    url_pattern = re.compile(
-        r'^https?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-
-    if not url_pattern.match(url):
+    if not _URL_PATTERN.match(url):
         return False, INVALID_URL_MESSAGE, None
 
     try:
@@ -37,3 +39,67 @@ def validate_url(url: str) -> Tuple[bool, str, Optional[str]]:
     except Exception as e:
         logger.error(f"Error parsing URL: {e}")
         return False, INVALID_URL_MESSAGE, None
+
+# Достает из текста все ссылки http(s) в порядке появления, без повторов
+def extract_urls(text: str) -> List[str]:
+    urls = []
+    for match in _URL_IN_TEXT.findall(text or ''):
+        url = match.rstrip('.,;:!?)]}\'"')
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+# Ссылка на плейлист YouTube (а не на видео, открытое из плейлиста)
+def is_playlist_url(url: str) -> bool:
+    try:
+        parsed_url = urlparse(url)
+    except Exception:
+        return False
+    domain = parsed_url.netloc.lower()
+    if domain.startswith('www.') or domain.startswith('m.'):
+        domain = domain.split('.', 1)[1]
+    if SUPPORTED_DOMAINS.get(domain) != 'YouTube':
+        return False
+    return parsed_url.path == '/playlist' and 'list' in parse_qs(parsed_url.query)
+
+_YOUTUBE_ID_PATH = re.compile(r'^/(?:shorts|embed|live|v)/([\w-]{11})')
+_TWITTER_STATUS_PATH = re.compile(r'/status(?:es)?/(\d+)')
+_INSTAGRAM_MEDIA_PATH = re.compile(r'^/(?:[\w.]+/)?(?:p|reel|reels|tv)/([\w-]+)')
+
+# Канонический ключ медиа по ссылке: разные формы одной ссылки
+# (youtu.be, shorts, www/m., трекинговые параметры) дают один ключ, например "youtube:dQw4w9WgXcQ"
+def canonicalize_url(url: str) -> Optional[str]:
+    try:
+        parsed_url = urlparse(url)
+    except Exception:
+        return None
+    domain = parsed_url.netloc.lower().split(':', 1)[0]
+    for prefix in ('www.', 'm.', 'mobile.', 'music.'):
+        if domain.startswith(prefix):
+            domain = domain[len(prefix):]
+            break
+    platform = SUPPORTED_DOMAINS.get(domain)
+    if not platform:
+        return None
+    path = parsed_url.path
+
+    media_id = None
+    if platform == 'YouTube':
+        if domain == 'youtu.be':
+            media_id = path.strip('/').split('/', 1)[0] or None
+        elif path == '/watch':
+            media_id = (parse_qs(parsed_url.query).get('v') or [None])[0]
+        else:
+            match = _YOUTUBE_ID_PATH.match(path)
+            media_id = match.group(1) if match else None
+    elif platform == 'Twitter':
+        match = _TWITTER_STATUS_PATH.search(path)
+        media_id = match.group(1) if match else None
+    elif platform == 'Instagram':
+        match = _INSTAGRAM_MEDIA_PATH.match(path)
+        media_id = match.group(1) if match else None
+
+    if media_id:
+        return f"{platform.lower()}:{media_id}"
+    # Незнакомая форма ссылки: ключ по домену и пути без параметров
+    return f"{platform.lower()}:{domain}{path.rstrip('/')}"
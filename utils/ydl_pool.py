@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+import yt_dlp
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+from utils.logger import logger
+
+# Опции, уникальные для одной загрузки (формат и имя файла видео, постпроцессоры, хуки задачи).
+# Вызов с ними получает собственный экземпляр YoutubeDL: у yt-dlp нет публичного способа
+# снять постпроцессоры и хуки с экземпляра, а пересобирать его внутренности ненадежно
+PER_CALL_OPTIONS = frozenset({'format', 'outtmpl', 'postprocessors', 'progress_hooks', 'postprocessor_hooks'})
+
+# Пул "прогретых" экземпляров YoutubeDL для извлечения информации.
+# Экземпляр хранит пул HTTP соединений, кеш плеера и функций подписи, поэтому пересоздавать
+# его на каждый вызов дорого. Экземпляр создается из полного набора опций и не меняется,
+# ключ пула - платформа и эти опции. Cookie файл пакетной задачи в ключ не входит:
+# он загружается в cookie jar экземпляра на время вызова и сохраняется обратно после.
+# Один экземпляр одновременно используется только одним потоком
+class YDLSessionPool:
+    def __init__(self, max_idle: int = 8, idle_ttl: float = 600, max_uses: int = 200):
+        self.max_idle = max_idle
+        self.idle_ttl = idle_ttl
+        # После стольких вызовов экземпляр пересоздается, чтобы его кеши не росли бесконечно
+        self.max_uses = max_uses
+        self._idle: List[Tuple[Hashable, yt_dlp.YoutubeDL, float]] = []
+        self._uses: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    # Выдает экземпляр YoutubeDL с опциями base_params и call_params.
+    # Загрузка (есть опции из PER_CALL_OPTIONS) получает новый экземпляр, извлечение - экземпляр из пула
+    @contextmanager
+    def session(self, key: Hashable, base_params: Dict, call_params: Dict) -> Iterator[yt_dlp.YoutubeDL]:
+        if PER_CALL_OPTIONS & call_params.keys():
+            ydl = yt_dlp.YoutubeDL({**base_params, **call_params})
+            try:
+                yield ydl
+            finally:
+                if ydl.params.get('cookiefile'):
+                    ydl.save_cookies()
+                ydl.close()
+            return
+
+        cookiefile = base_params.get('cookiefile')
+        params = {**{k: v for k, v in base_params.items() if k != 'cookiefile'}, **call_params}
+        pool_key = (key, tuple(sorted((k, repr(v)) for k, v in params.items())))
+        ydl = self._acquire(pool_key, params)
+        reusable = False
+        try:
+            _load_cookies(ydl, cookiefile)
+            yield ydl
+            reusable = True
+        except Exception:
+            # Ошибки извлечения (в т.ч. отмена) штатные, экземпляр остается рабочим
+            reusable = True
+            raise
+        finally:
+            # Прерванный на середине экземпляр (KeyboardInterrupt и т.п.) не переиспользуем
+            try:
+                _save_cookies(ydl, cookiefile)
+            except Exception as e:
+                reusable = False
+                logger.warning(f"Failed to save cookies to {cookiefile}: {e}")
+            self._release(pool_key, ydl, reusable)
+
+    def _acquire(self, pool_key: Hashable, params: Dict) -> yt_dlp.YoutubeDL:
+        with self._lock:
+            for index, (idle_key, ydl, _) in enumerate(self._idle):
+                if idle_key == pool_key:
+                    del self._idle[index]
+                    return ydl
+        logger.debug(f"Creating new YoutubeDL instance for {pool_key[0]}")
+        return yt_dlp.YoutubeDL(dict(params))
+
+    def _release(self, pool_key: Hashable, ydl: yt_dlp.YoutubeDL, reusable: bool):
+        uses = self._uses.get(id(ydl), 0) + 1
+
+        expired = []
+        with self._lock:
+            if reusable and uses < self.max_uses:
+                self._uses[id(ydl)] = uses
+                self._idle.append((pool_key, ydl, time.monotonic()))
+            else:
+                self._uses.pop(id(ydl), None)
+                expired.append(ydl)
+
+            # Убираем давно неиспользуемые экземпляры и лишние сверх лимита (самые старые)
+            now = time.monotonic()
+            while self._idle and (len(self._idle) > self.max_idle or now - self._idle[0][2] > self.idle_ttl):
+                _, old_ydl, _ = self._idle.pop(0)
+                self._uses.pop(id(old_ydl), None)
+                expired.append(old_ydl)
+
+        for old_ydl in expired:
+            try:
+                old_ydl.close()
+            except Exception as e:
+                logger.debug(f"Error closing YoutubeDL instance: {e}")
+
+# Подменяет cookies экземпляра на cookies пакетной задачи (через публичный API cookie jar)
+def _load_cookies(ydl: yt_dlp.YoutubeDL, cookiefile: Optional[str]):
+    if not cookiefile:
+        return
+    jar = ydl.cookiejar
+    jar.clear()
+    if os.path.exists(cookiefile):
+        jar.load(cookiefile, ignore_discard=True, ignore_expires=True)
+
+# Сохраняет cookies задачи в её файл и очищает cookie jar, чтобы они не достались следующей задаче
+def _save_cookies(ydl: yt_dlp.YoutubeDL, cookiefile: Optional[str]):
+    if not cookiefile:
+        return
+    jar = ydl.cookiejar
+    try:
+        jar.save(cookiefile, ignore_discard=True, ignore_expires=True)
+    finally:
+        jar.clear()
+
+# Пул на процесс (в режиме пула процессов у каждого дочернего процесса свой)
+ydl_pool = YDLSessionPool()